@@ -22,7 +22,11 @@ from .fields.geo_field import GeoField
 from .fields.dataframe_field import DataFrameField
 from .fields.datetime_field import DatetimeField
 from .fields.relationship import Relationship
+from .models.aggregates import Min, Max, Sum, Avg, Count
 from .models.base import Model, ModelBase
+from .models.expiry import ExpiryReaper
+from .models.expressions import Q
+from .models.identity_map import IdentityMap
 from .pubsub.publisher import Publisher
 from .pubsub.subscriber import Subscriber
 
@@ -51,6 +55,14 @@ __all__ = [
     "Relationship",
     "Model",
     "ModelBase",
+    "Q",
+    "ExpiryReaper",
+    "IdentityMap",
+    "Min",
+    "Max",
+    "Sum",
+    "Avg",
+    "Count",
     "Publisher",
     "Subscriber",
 ]
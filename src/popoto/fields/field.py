@@ -7,6 +7,7 @@ from ..exceptions import ModelException
 import logging
 
 from ..models.db_key import DB_key
+from ..models.key_sources import KeyList
 
 logger = logging.getLogger("POPOTO.field")
 
@@ -168,3 +169,17 @@ class Field(metaclass=FieldBase):
         raise QueryException(
             "Query filter not allowed on base Field. Consider using a KeyField"
         )
+
+    @classmethod
+    def get_filter_key_sources(
+        cls, model: "Model", field_name: str, **query_params
+    ) -> list:
+        """
+        server-side counterpart to filter_query, used when Meta.server_side_filters is on
+        :param model: the popoto.Model to query from
+        :param field_name: the name of the field being filtered on
+        :param query_params: dict of filter args and values
+        :return: list[KeySource, ..] to be intersected in Redis
+        Fields that cannot resolve a filter in Redis fall back to filter_query on the client.
+        """
+        return [KeyList(cls.filter_query(model, field_name, **query_params))]
@@ -3,6 +3,7 @@ import redis
 from .field import Field
 import logging
 from ..models.db_key import DB_key
+from ..models.key_sources import GeoRadius
 
 logger = logging.getLogger("POPOTO.GeoField")
 from ..redis_db import POPOTO_REDIS_DB
@@ -153,15 +154,10 @@ class GeoField(Field):
             return POPOTO_REDIS_DB.zrem(geo_db_key.redis_key, geo_member)
 
     @classmethod
-    def filter_query(cls, model: "Model", field_name: str, **query_params) -> set:
+    def get_query_geo_args(cls, model: "Model", field_name: str, **query_params):
         """
-        :param model: the popoto.Model to query from
-        :param field_name: the name of the field being filtered on
-        :param query_params: dict of filter args and values
-        :return: set{db_key, db_key, ..}
+        :return: coordinates, member, radius, unit for a GEORADIUS query
         """
-        field = model._meta.fields[field_name]
-        geo_db_key = cls.get_geo_db_key(model, field_name)
         coordinates = GeoField.Coordinates(None, None)
         member, radius, unit = None, 1, "m"
         for query_param, query_value in query_params.items():
@@ -202,6 +198,46 @@ class GeoField(Field):
                     raise QueryException(f"{query_param} must be one of m|km|ft|mi ")
                 unit = query_value
 
+        if not member and not (coordinates.latitude and coordinates.longitude):
+            from ..models.query import QueryException
+
+            raise QueryException(
+                f"missing one or more required parameters. "
+                f"geofilter requires either coordinates or instance of the same model"
+            )
+        return coordinates, member, radius, unit
+
+    @classmethod
+    def get_filter_key_sources(
+        cls, model: "Model", field_name: str, **query_params
+    ) -> list:
+        coordinates, member, radius, unit = cls.get_query_geo_args(
+            model, field_name, **query_params
+        )
+        return [
+            GeoRadius(
+                cls.get_geo_db_key(model, field_name).redis_key,
+                radius=radius,
+                unit=unit,
+                longitude=coordinates.longitude,
+                latitude=coordinates.latitude,
+                member=member.db_key.redis_key if member else None,
+            )
+        ]
+
+    @classmethod
+    def filter_query(cls, model: "Model", field_name: str, **query_params) -> set:
+        """
+        :param model: the popoto.Model to query from
+        :param field_name: the name of the field being filtered on
+        :param query_params: dict of filter args and values
+        :return: set{db_key, db_key, ..}
+        """
+        geo_db_key = cls.get_geo_db_key(model, field_name)
+        coordinates, member, radius, unit = cls.get_query_geo_args(
+            model, field_name, **query_params
+        )
+
         if member:
             redis_db_keys_list = POPOTO_REDIS_DB.georadiusbymember(
                 geo_db_key.redis_key,
@@ -210,7 +246,7 @@ class GeoField(Field):
                 unit=unit,  # , withdist=True, sort='asc'
             )
 
-        elif coordinates.latitude and coordinates.longitude:
+        else:
             # logger.debug(f"geo query on {dict(model=model._meta.db_class_key, longitude=coordinates.longitude, latitude=coordinates.latitude, radius=radius, unit=unit)}")
             redis_db_keys_list = POPOTO_REDIS_DB.georadius(
                 geo_db_key.redis_key,
@@ -220,12 +256,5 @@ class GeoField(Field):
                 unit=unit,  # , withdist=True, sort='asc'
             )
             # logger.debug(f"geo query returned {redis_db_keys_list}")
-        else:
-            from ..models.query import QueryException
-
-            raise QueryException(
-                f"missing one or more required parameters. "
-                f"geofilter requires either coordinates or instance of the same model"
-            )
 
         return set(redis_db_keys_list)
@@ -3,6 +3,7 @@ from datetime import date, datetime, time
 import redis.client
 import logging
 from ..models.db_key import DB_key
+from ..models.key_sources import IndexSet, SetUnion
 
 logger = logging.getLogger("POPOTO.KeyFieldMixin")
 
@@ -119,6 +120,45 @@ class KeyFieldMixin:
             )
         )
 
+    @classmethod
+    def get_filter_key_sources(
+        cls, model: "Model", field_name: str, **query_params
+    ) -> list:
+        """
+        exact, __in and __isnull=True filters read the KeyField sets directly.
+        pattern filters still require a KEYS scan on the client.
+        """
+        key_sources, client_side_query_params = list(), dict()
+        field = model._meta.fields[field_name]
+        redis_set_key_prefix = field.get_special_use_field_db_key(model, field_name)
+
+        for query_param, query_value in query_params.items():
+            if query_param.endswith("__in"):
+                key_sources.append(
+                    SetUnion(
+                        [
+                            DB_key(redis_set_key_prefix, query_value_elem).redis_key
+                            for query_value_elem in query_value
+                        ]
+                    )
+                )
+            elif query_param == f"{field_name}" and not field.auto:
+                key_sources.append(
+                    IndexSet(DB_key(redis_set_key_prefix, query_value).redis_key)
+                )
+            elif query_param.endswith("__isnull") and query_value is True:
+                key_sources.append(
+                    IndexSet(DB_key(redis_set_key_prefix, None).redis_key)
+                )
+            else:
+                client_side_query_params[query_param] = query_value
+
+        if client_side_query_params:
+            key_sources += super().get_filter_key_sources(
+                model, field_name, **client_side_query_params
+            )
+        return key_sources
+
     @classmethod
     def filter_query(cls, model: "Model", field_name: str, **query_params) -> set:
         """
@@ -159,7 +199,7 @@ class KeyFieldMixin:
                     )
                 keys_lists_to_union = pipeline_2.execute()
                 keys_lists_to_intersect.append(
-                    set.union(*[set(key_list) for key_list in keys_lists_to_union])
+                    set().union(*[set(key_list) for key_list in keys_lists_to_union])
                 )
 
             else:
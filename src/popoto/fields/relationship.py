@@ -3,12 +3,100 @@ from .field import Field
 import logging
 
 from ..models.db_key import DB_key
+from ..models.key_sources import IndexSet
 from ..models.query import QueryException
 from ..redis_db import POPOTO_REDIS_DB
 
 logger = logging.getLogger("POPOTO.Relationship")
 
 
+class RelatedObjectDescriptor:
+    """
+    The attribute of a Relationship field on model instances.
+    Objects read from Redis hold the redis key of the related object,
+    which is read on first access. See QuerySet.select_related()
+    :param slot: the slot holding the value, on a Meta.slots model
+    """
+
+    def __init__(self, field_name: str, field: "Relationship", slot=None):
+        self.field_name = field_name
+        self.field = field
+        self.slot = slot
+
+    def get_reference(self, instance: "Model"):
+        """the related object, or its redis key if it was not read yet"""
+        if self.slot is not None:
+            return self.slot.__get__(instance, type(instance))
+        try:
+            return instance.__dict__[self.field_name]
+        except KeyError:
+            raise AttributeError(self.field_name) from None
+
+    def __get__(self, instance: "Model", owner=None):
+        if instance is None:
+            return self
+        value = self.get_reference(instance)
+        if isinstance(value, str):
+            value = self.field.model.query.get(redis_key=value)
+            self.__set__(instance, value)
+        return value
+
+    def __set__(self, instance: "Model", value):
+        if self.slot is not None:
+            self.slot.__set__(instance, value)
+        else:
+            instance.__dict__[self.field_name] = value
+
+
+class RelatedSetDescriptor:
+    """
+    The reverse of a Relationship, on the related model's instances:
+    a QuerySet of the objects relating to the instance, from their relationship set.
+    Named by the Relationship's related_name. See QuerySet.prefetch_related()
+
+    class Ticker(Model): ...
+    class Price(Model):
+        ticker = Relationship(model=Ticker, related_name="prices")
+    ticker.prices.order_by("-day")[:10]
+    """
+
+    def __init__(self, related_name: str, model: "Model", field_name: str):
+        self.related_name = related_name
+        self.model = model  # the model of the Relationship field
+        self.field_name = field_name
+
+    def get_set_redis_key(self, instance: "Model") -> str:
+        """the relationship set of the objects relating to instance"""
+        return DB_key(
+            Relationship.get_special_use_field_db_key(self.model, self.field_name),
+            instance.db_key,
+        ).redis_key
+
+    def set_prefetched(self, instance: "Model", related_objects: list):
+        """keep related_objects as the results of the related set of instance"""
+        queryset = self.model.query.filter(**{self.field_name: instance})
+        queryset._result_cache = related_objects
+        instance._prefetched_objects = {
+            **(getattr(instance, "_prefetched_objects", None) or {}),
+            self.related_name: queryset,
+        }
+
+    def __get__(self, instance: "Model", owner=None):
+        if instance is None:
+            return self
+        prefetched_objects = getattr(instance, "_prefetched_objects", None) or {}
+        if self.related_name in prefetched_objects:
+            return prefetched_objects[self.related_name]
+        return self.model.query.filter(**{self.field_name: instance})
+
+
+def get_related_db_key(field_value) -> DB_key:
+    """the db key of a related object, or of its redis key"""
+    if isinstance(field_value, str):
+        return DB_key.from_redis_key(field_value)
+    return field_value.db_key
+
+
 class Relationship(Field):
     """
     A field that stores references to one or more other model instances.
@@ -18,6 +106,7 @@ class Relationship(Field):
     model: "Model" = None
     many: bool = False
     null: bool = True
+    related_name: str = None  # of the reverse relationship, default <model name>_set
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -28,12 +117,20 @@ class Relationship(Field):
             "model": None,
             "many": False,
             "null": True,
+            "related_name": None,
         }
         self.field_defaults.update(relationship_field_defaults)
         # set field options, let kwargs override
         for k, v in relationship_field_defaults.items():
             setattr(self, k, kwargs.get(k, v))
 
+    @classmethod
+    def is_valid(cls, field, value, null_check=True, **kwargs) -> bool:
+        if isinstance(value, str):
+            # the redis key of a related object not read yet
+            return value.startswith(f"{field.model._meta.db_class_key.redis_key}:")
+        return super().is_valid(field, value, null_check=null_check, **kwargs)
+
     def get_filter_query_params(self, field_name) -> set:
         related_field_filter_query_params = set()
         for related_field_name, related_field in self.model._meta.fields.items():
@@ -73,14 +170,14 @@ class Relationship(Field):
         # example: "$RelationshipF:Membership:person:person_db_key"
         relationship_set_db_key = DB_key(
             cls.get_special_use_field_db_key(model_instance, field_name),
-            field_value.db_key if field_value else "None",
+            get_related_db_key(field_value) if field_value else "None",
         )
 
         if pipeline and field_value is None:
             return pipeline.srem(
                 relationship_set_db_key.redis_key, model_instance.db_key.redis_key
             )
-        elif pipeline and isinstance(field_value, Model):
+        elif pipeline and isinstance(field_value, (Model, str)):
             return pipeline.sadd(
                 relationship_set_db_key.redis_key, model_instance.db_key.redis_key
             )
@@ -88,7 +185,7 @@ class Relationship(Field):
             return POPOTO_REDIS_DB.srem(
                 relationship_set_db_key.redis_key, model_instance.db_key.redis_key
             )
-        elif isinstance(field_value, Model):
+        elif isinstance(field_value, (Model, str)):
             return POPOTO_REDIS_DB.sadd(
                 relationship_set_db_key.redis_key, model_instance.db_key.redis_key
             )
@@ -106,11 +203,9 @@ class Relationship(Field):
     ):
         # todo: it's possible this instance is not fully loaded or has been changed.
         #  Need to reload from db before deleting
-        #  Example: on person.friend.delete() the person.friend.friend will have field_value as a keystring
-        #  It will not be a model instance, so this method will fail on field_value.db_key below
         relationship_set_db_key = DB_key(
             cls.get_special_use_field_db_key(model_instance, field_name),
-            field_value.db_key if field_value else "None",
+            get_related_db_key(field_value) if field_value else "None",
         )
         if pipeline:
             return pipeline.srem(
@@ -121,6 +216,40 @@ class Relationship(Field):
                 relationship_set_db_key.redis_key, model_instance.db_key.redis_key
             )
 
+    @classmethod
+    def get_filter_key_sources(
+        cls, model: "Model", field_name: str, **query_params
+    ) -> list:
+        """
+        an exact match on a related instance reads its relationship set directly.
+        filters on the related model's fields are resolved on the client.
+        """
+        from ..models.base import Model
+
+        key_sources, client_side_query_params = list(), dict()
+        for query_param, query_value in query_params.items():
+            if query_param == f"{field_name}":
+                if not isinstance(query_value, Model):
+                    raise QueryException(
+                        f"Query filter on Relationship expects model instance. Instead, got {query_value}"
+                    )
+                key_sources.append(
+                    IndexSet(
+                        DB_key(
+                            cls.get_special_use_field_db_key(model, field_name),
+                            query_value.db_key,
+                        ).redis_key
+                    )
+                )
+            else:
+                client_side_query_params[query_param] = query_value
+
+        if client_side_query_params:
+            key_sources += super().get_filter_key_sources(
+                model, field_name, **client_side_query_params
+            )
+        return key_sources
+
     @classmethod
     def filter_query(cls, model: "Model", field_name: str, **query_params) -> set:
         """
@@ -1,10 +1,12 @@
 import logging
 from decimal import Decimal
 import datetime
+import itertools
 import typing
 import redis
 
 from ..models.db_key import DB_key
+from ..models.key_sources import ScoreRange, ScoreRangeUnion
 from ..models.query import QueryException
 from ..redis_db import POPOTO_REDIS_DB
 
@@ -68,7 +70,7 @@ class SortedFieldMixin:
                     f"{field_name}__gte",
                     f"{field_name}__lt",
                     f"{field_name}__lte",
-                    # f'{field_name}__range',  # todo: like https://docs.djangoproject.com/en/3.2/ref/models/querysets/#range
+                    f"{field_name}__range",  # takes a (min, max) tuple, inclusive
                     # f'{field_name}__isnull',  # todo: see todo in __init__
                 }
             )
@@ -105,6 +107,20 @@ class SortedFieldMixin:
                 f"SortedField {field} received non-numeric value {field_value} type {type(field_value)}."
             )
 
+    @classmethod
+    def convert_from_numeric(cls, field, score: float):
+        """the field value for a sorted set score, see convert_to_numeric()"""
+        if field.type is int:
+            return int(score)
+        elif field.type is Decimal:
+            return Decimal(str(score))
+        elif field.type is datetime.date:
+            return datetime.date.fromordinal(int(score))
+        elif field.type is datetime.datetime:
+            return datetime.datetime.fromtimestamp(score)
+        else:
+            return score
+
     @classmethod
     def get_sortedset_db_key(cls, model, field_name, *partition_field_names) -> DB_key:
         return cls.get_special_use_field_db_key(
@@ -173,18 +189,26 @@ class SortedFieldMixin:
             return POPOTO_REDIS_DB.zrem(sortedset_db_key.redis_key, sortedset_member)
 
     @classmethod
-    def filter_query(cls, model_class: "Model", field_name: str, **query_params) -> set:
+    def get_query_value_range(
+        cls, model_class: "Model", field_name: str, **query_params
+    ) -> dict:
         """
-        :param model_class: the popoto.Model to query from
-        :param field_name: the name of the field being filtered on
-        :param query_params: dict of filter args and values
-        :return: set{db_key, db_key, ..}
+        :return: {"min": .., "max": ..} score range args for ZRANGEBYSCORE
         """
         value_range = {"min": "-inf", "max": "+inf"}
 
         for query_param, query_value in query_params.items():
             if field_name not in query_param:
                 continue
+            if query_param == f"{field_name}__range":
+                min_value, max_value = query_value
+                value_range["min"] = cls.convert_to_numeric(
+                    model_class._meta.fields[field_name], min_value
+                )
+                value_range["max"] = cls.convert_to_numeric(
+                    model_class._meta.fields[field_name], max_value
+                )
+                continue
 
             numeric_value = cls.convert_to_numeric(
                 model_class._meta.fields[field_name], query_value
@@ -195,12 +219,20 @@ class SortedFieldMixin:
             elif "__lt" in query_param:
                 inclusive = query_param.split("__lt")[1]
                 value_range["max"] = f"{'' if inclusive == 'e' else '('}{numeric_value}"
+            elif query_param == f"{field_name}":
+                value_range["min"] = value_range["max"] = numeric_value
             else:
                 pass  # this is just a mixin, another subclass may have valid query params
 
+        return value_range
+
+    @classmethod
+    def get_query_sortedset_db_key(
+        cls, model_class: "Model", field_name: str, **query_params
+    ) -> DB_key:
         try:
             # use field names and query values sort_by fields to extend sortedset_db_key
-            sortedset_db_key = cls.get_sortedset_db_key(
+            return cls.get_sortedset_db_key(
                 model_class,
                 field_name,
                 *[
@@ -216,12 +248,75 @@ class SortedFieldMixin:
                 f"Query filter must also specify a value for {', '.join(model_class._meta.fields[field_name].sort_by)}"
             )
 
-        redis_db_keys_list = POPOTO_REDIS_DB.zrangebyscore(
-            sortedset_db_key.redis_key, value_range["min"], value_range["max"]
+    @classmethod
+    def get_query_sortedset_db_keys(
+        cls, model_class: "Model", field_name: str, **query_params
+    ) -> list:
+        """
+        like get_query_sortedset_db_key(), but partition fields may also be filtered
+        with `__in`, giving a sorted set for each combination of partition values
+        """
+        sort_by = model_class._meta.fields[field_name].sort_by
+        partition_values = []
+        for partition_field_name in sort_by:
+            if partition_field_name in query_params:
+                partition_values.append([query_params[partition_field_name]])
+            elif f"{partition_field_name}__in" in query_params:
+                partition_values.append(query_params[f"{partition_field_name}__in"])
+            else:
+                raise QueryException(
+                    f"{field_name} field is sorted on {', '.join(sort_by)}. "
+                    f"Query filter must also specify a value or values for {partition_field_name}"
+                )
+        return [
+            cls.get_sortedset_db_key(
+                model_class, field_name, *[str(value) for value in values]
+            )
+            for values in itertools.product(*partition_values)
+        ]
+
+    @classmethod
+    def get_filter_key_sources(
+        cls, model_class: "Model", field_name: str, **query_params
+    ) -> list:
+        """
+        a single ScoreRange, or a ScoreRangeUnion over several partitions
+        when a sort_by field is filtered with `__in`
+        """
+        value_range = cls.get_query_value_range(model_class, field_name, **query_params)
+        sortedset_db_keys = cls.get_query_sortedset_db_keys(
+            model_class, field_name, **query_params
         )
-        # redis_db_keys_list = POPOTO_REDIS_DB.zrange(
-        #     sortedset_db_key.redis_key, value_range['min'], value_range['max'],
-        #     desc=False, withscores=False,
-        #     byscore=True, offset=None, num=None
-        # )
-        return set(redis_db_keys_list)
+        if len(sortedset_db_keys) == 1:
+            return [
+                ScoreRange(
+                    sortedset_db_keys[0].redis_key,
+                    value_range["min"],
+                    value_range["max"],
+                )
+            ]
+        return [
+            ScoreRangeUnion(
+                [sortedset_db_key.redis_key for sortedset_db_key in sortedset_db_keys],
+                value_range["min"],
+                value_range["max"],
+            )
+        ]
+
+    @classmethod
+    def filter_query(cls, model_class: "Model", field_name: str, **query_params) -> set:
+        """
+        :param model_class: the popoto.Model to query from
+        :param field_name: the name of the field being filtered on
+        :param query_params: dict of filter args and values
+        :return: set{db_key, db_key, ..}
+        """
+        value_range = cls.get_query_value_range(model_class, field_name, **query_params)
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        for sortedset_db_key in cls.get_query_sortedset_db_keys(
+            model_class, field_name, **query_params
+        ):
+            pipeline.zrangebyscore(
+                sortedset_db_key.redis_key, value_range["min"], value_range["max"]
+            )
+        return set().union(*pipeline.execute())
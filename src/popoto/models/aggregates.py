@@ -0,0 +1,142 @@
+import logging
+from decimal import Decimal
+
+from .key_sources import ScoreRange
+from .scripts import queue_sum_scores_script
+
+logger = logging.getLogger("POPOTO.aggregates")
+
+
+class Aggregate:
+    """
+    An aggregate over the scores of a SortedField, computed inside Redis.
+    Each queues its commands on a pipeline, then reads its own replies,
+    so any number of aggregates share one round trip.
+
+    Model.query.filter(category="toys").aggregate(Min("price"), Avg("price"), Count())
+    """
+
+    name: str = None
+
+    def __init__(self, field_name: str = None):
+        self.field_name = field_name
+
+    @property
+    def default_alias(self) -> str:
+        return f"{self.field_name}__{self.name}" if self.field_name else self.name
+
+    def check(self, model_class: "Model"):
+        from .query import QueryException
+
+        if self.field_name not in model_class._meta.sorted_field_names:
+            raise QueryException(
+                f"{self.__class__.__name__} needs a SortedField, not {self.field_name}"
+            )
+
+    def queue(self, pipeline, score_range: ScoreRange) -> int:
+        """
+        queue the commands computing this aggregate over the scores in score_range
+        :return: the number of replies queued
+        """
+        raise NotImplementedError
+
+    def read(self, field: "Field", replies: list):
+        """:return: the aggregate value, or None if nothing matched"""
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.field_name or ''})"
+
+
+class Min(Aggregate):
+    """the lowest value. one end of the sorted set, O(log n)"""
+
+    name = "min"
+    reverse = False
+
+    def queue(self, pipeline, score_range: ScoreRange) -> int:
+        if score_range.is_unbounded:
+            index = -1 if self.reverse else 0
+            pipeline.zrange(score_range.redis_key, index, index, withscores=True)
+        else:
+            pipeline.zrange(
+                score_range.redis_key,
+                score_range.max if self.reverse else score_range.min,
+                score_range.min if self.reverse else score_range.max,
+                desc=self.reverse,
+                byscore=True,
+                offset=0,
+                num=1,
+                withscores=True,
+            )
+        return 1
+
+    def read(self, field: "Field", replies: list):
+        if not replies[0]:
+            return None
+        _, score = replies[0][0]
+        return field.convert_from_numeric(field, score)
+
+
+class Max(Min):
+    """the highest value. one end of the sorted set, O(log n)"""
+
+    name = "max"
+    reverse = True
+
+
+class Sum(Aggregate):
+    """the sum of values. one Lua pass over the scores, no hashes are read"""
+
+    name = "sum"
+
+    def check(self, model_class: "Model"):
+        from .query import QueryException
+
+        super().check(model_class)
+        field_type = model_class._meta.fields[self.field_name].type
+        if field_type not in (int, float, Decimal):
+            raise QueryException(
+                f"{self.__class__.__name__} needs a numeric field, {self.field_name} is {field_type}"
+            )
+
+    def queue(self, pipeline, score_range: ScoreRange) -> int:
+        queue_sum_scores_script(
+            pipeline, score_range.redis_key, score_range.min, score_range.max
+        )
+        return 1
+
+    def read(self, field: "Field", replies: list):
+        count, total = replies[0]
+        if not count:
+            return None
+        return field.convert_from_numeric(field, float(total))
+
+
+class Avg(Sum):
+    """the mean of values. one Lua pass over the scores, no hashes are read"""
+
+    name = "avg"
+
+    def read(self, field: "Field", replies: list):
+        count, total = replies[0]
+        if not count:
+            return None
+        return float(total) / count
+
+
+class Count(Aggregate):
+    """the number of matching objects"""
+
+    name = "count"
+
+    def check(self, model_class: "Model"):
+        if self.field_name is not None:
+            super().check(model_class)
+
+    def queue(self, pipeline, score_range: ScoreRange) -> int:
+        pipeline.zcount(score_range.redis_key, score_range.min, score_range.max)
+        return 1
+
+    def read(self, field: "Field", replies: list):
+        return int(replies[0])
@@ -1,33 +1,82 @@
+import inspect
 import logging
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from operator import attrgetter
 
+import msgpack
 import redis
 
-from .encoding import encode_popoto_model_obj
+from .encoding import decode_custom_types, encode_popoto_model_obj, get_field_encoder
 from .db_key import DB_key
-from .query import Query
+from .identity_map import discard_from_identity_map, get_identity_map
+from .query import Query, QUERY_OPTION_NAMES
+from .scripts import (
+    ScriptPipeline,
+    queue_expiry_values_script,
+    queue_if_exists,
+    run_reap_script,
+)
 from ..fields.auto_field_mixin import AutoFieldMixin
 from ..fields.field import Field, VALID_FIELD_TYPES
 from ..fields.key_field_mixin import KeyFieldMixin
 from ..fields.sorted_field_mixin import SortedFieldMixin
 from ..fields.geo_field import GeoField
-from ..fields.relationship import Relationship
-from ..redis_db import POPOTO_REDIS_DB
+from ..fields.relationship import (
+    RelatedObjectDescriptor,
+    RelatedSetDescriptor,
+    Relationship,
+)
+from ..redis_db import POPOTO_REDIS_DB, ENCODING
 
 logger = logging.getLogger("POPOTO.model_base")
 
-global RELATED_MODEL_LOAD_SEQUENCE
-RELATED_MODEL_LOAD_SEQUENCE = set()
+BULK_BATCH_SIZE = 1000  # objects saved per pipeline by bulk_save() and bulk_create()
+REAP_BATCH_SIZE = 1000  # expired objects cleaned per round trip by reap_expired()
+
+# per instance state besides field values, the slots of a Meta.slots model
+INSTANCE_STATE_NAMES = (
+    "_ttl",
+    "_expire_at",
+    "_redis_key",
+    "obsolete_redis_key",
+    "_prefetched_objects",  # see QuerySet.prefetch_related()
+)
 
 
 class ModelException(Exception):
     pass
 
 
+# a model's fields compiled into tuples, once per class. See ModelOptions.compile_layout()
+ModelLayout = namedtuple(
+    "ModelLayout",
+    "db_class_redis_key, field_names, key_field_names, key_positions, "
+    "defaults, getters, validators, encoders, expiry_field_names",
+)
+
+
+def get_default_factory(field: Field):
+    """a function returning a new default value for field"""
+    if field.auto:
+        return field.get_new_auto_key_value
+    default = field.default
+    if isinstance(default, (list, dict, set)):
+        return default.copy  # not shared between instances
+    return lambda: default
+
+
 class ModelOptions:
     def __init__(self, model_name):
         self.model_name = model_name
         self.db_class_key = DB_key(self.model_name)
         self.db_class_set_key = DB_key("$Class", self.db_class_key)
+        # incremented on every save() and delete(), so cached query results can expire
+        self.db_generation_key = DB_key("$Generation", self.db_class_key)
+        # expiring objects by expiry timestamp, and the values their index entries need
+        self.db_expiry_key = DB_key("$Expiry", self.db_class_key)
+        self.db_expiry_values_key = DB_key("$ExpiryValues", self.db_class_key)
 
         self.hidden_fields = dict()
         self.explicit_fields = dict()
@@ -36,14 +85,28 @@ class ModelOptions:
         # self.list_field_names = set()
         # self.set_field_names = set()
         self.relationship_field_names = set()
+        self.related_object_descriptors = dict()  # field_name: RelatedObjectDescriptor
+        # related_name: RelatedSetDescriptor, of Relationships of other models to this
+        self.related_sets = dict()
         self.sorted_field_names = set()
         self.geo_field_names = set()
         # todo: should this be a dict of related objects or just a list of field names?
         # self.related_fields = {}  # model becomes graph node
 
         self.filter_query_params_by_field = dict()  # field_name: set(query_params,..)
+        self.fields = dict()  # explicit, then hidden fields
+        self.field_names = list()
+        self.layout = None  # compiled by ModelBase when the class is created
 
         self.abstract = False
+        self.server_side_filters = True  # intersect filter results inside Redis
+        self.lua_queries = False  # run whole queries in one Lua script call
+        self.cache_ttl = None  # seconds to cache query results, see QueryCache
+        # seconds. log slower queries to POPOTO.SlowQuery
+        self.slow_query_threshold = None
+        self.ttl = None  # seconds until objects expire, unless saved with a ttl
+        self.slots = False  # instances use __slots__, without a __dict__
+        self.track_changes = True  # keep _db_content, so save() writes only changes
         self.unique_together = []
         self.index_together = []
         self.parents = []
@@ -55,7 +118,7 @@ class ModelOptions:
             raise ModelException(
                 f"{field_name} field name must start with a lowercase letter."
             )
-        elif field_name in ["limit", "order_by", "values"]:
+        elif field_name in QUERY_OPTION_NAMES:
             raise ModelException(
                 f"{field_name} is a reserved field name. "
                 f"See https://popoto.readthedocs.io/en/latest/fields/#reserved-field-names"
@@ -83,21 +146,107 @@ class ModelOptions:
         self.filter_query_params_by_field[field_name] = field.get_filter_query_params(
             field_name
         )
+        self.fields = {**self.explicit_fields, **self.hidden_fields}
+        self.field_names = list(self.fields.keys())
+        if self.layout:
+            self.compile_layout()
 
-    @property
-    def fields(self) -> dict:
-        return {**self.explicit_fields, **self.hidden_fields}
-
-    @property
-    def field_names(self) -> list:
-        return list(self.fields.keys())
+    def compile_layout(self) -> ModelLayout:
+        """
+        precompute what every instance needs from the fields,
+        so building, validating, keying and encoding an instance are loops over tuples
+        """
+        key_field_names = tuple(sorted(self.key_field_names))
+        indexed_field_names = {
+            field_name
+            for field_name, field in self.fields.items()
+            if field.__class__.on_delete.__func__ is not Field.on_delete.__func__
+        }
+        # field values as stored on the instance. related objects are not read
+        getters = {
+            field_name: self.related_object_descriptors[field_name].get_reference
+            if field_name in self.related_object_descriptors
+            else attrgetter(field_name)
+            for field_name in self.fields
+        }
+        self.layout = ModelLayout(
+            db_class_redis_key=self.db_class_key.redis_key,
+            field_names=tuple(self.field_names),
+            key_field_names=key_field_names,
+            key_positions={
+                field_name: 1 + position
+                for position, field_name in enumerate(key_field_names)
+            },
+            defaults=tuple(
+                (field_name, get_default_factory(field))
+                for field_name, field in self.fields.items()
+            ),
+            getters=getters,
+            validators=tuple(
+                (
+                    field_name,
+                    getters[field_name],
+                    field,
+                    # or the redis key of a related object not read yet
+                    (field.type, str)
+                    if field_name in self.related_object_descriptors
+                    else field.type,
+                    field.type in VALID_FIELD_TYPES,  # coerce values to the type
+                    field.max_length if field.type == str else None,
+                    field.__class__.is_valid,
+                )
+                for field_name, field in self.fields.items()
+            ),
+            encoders=tuple(
+                (
+                    getters[field_name],
+                    field_name.encode(ENCODING),
+                    get_field_encoder(field),
+                )
+                for field_name, field in self.fields.items()
+            ),
+            # recorded for expiring objects, to find their index entries once expired
+            expiry_field_names=tuple(
+                sorted(
+                    self.get_index_load_field_names(indexed_field_names)
+                    - self.key_field_names
+                )
+            ),
+        )
+        return self.layout
 
     @property
     def db_key_length(self):
         return 1 + len(self.key_field_names)
 
     def get_db_key_index_position(self, field_name):
-        return 1 + sorted(self.key_field_names).index(field_name)
+        return self.layout.key_positions[field_name]
+
+    def get_indexed_field_names(self, field_names: set) -> set:
+        """fields with Redis indexes depending on any of field_names"""
+        indexed_field_names = set()
+        for field_name, field in self.fields.items():
+            if field_name in field_names and (
+                field.__class__.on_save.__func__ is not Field.on_save.__func__
+            ):
+                indexed_field_names.add(field_name)
+            elif set(getattr(field, "sort_by", ())) & field_names:
+                indexed_field_names.add(field_name)  # the partition changes
+        return indexed_field_names
+
+    def get_index_load_field_names(self, indexed_field_names: set) -> set:
+        """fields to read to compute the index entries of indexed_field_names"""
+        return (
+            self.key_field_names
+            | indexed_field_names
+            | {
+                partition_field_name
+                for field_name in indexed_field_names
+                for partition_field_name in getattr(
+                    self.fields[field_name], "sort_by", ()
+                )
+            }
+        )
 
 
 class ModelBase(type):
@@ -147,81 +296,90 @@ class ModelBase(type):
         #     for field_name, field in base.auto_fields.items():
         #         options.add_field(field_name, field)
 
+        # add auto KeyField if needed
+        if not options.key_field_names:
+            from ..fields.shortcuts import AutoKeyField
+
+            options.add_field("_auto_key", AutoKeyField())
+
+        options.slots = getattr(attr_meta, "slots", False)
+        options.track_changes = getattr(attr_meta, "track_changes", True)
+        if options.slots:
+            new_attrs["__slots__"] = (
+                *options.field_names,
+                *INSTANCE_STATE_NAMES,
+                *(("_db_content",) if options.track_changes else ()),
+                "__weakref__",
+            )
+
         new_class = super().__new__(cls, name, bases, new_attrs)
 
+        # related objects are read on first access
+        for field_name in options.relationship_field_names:
+            descriptor = RelatedObjectDescriptor(
+                field_name,
+                options.fields[field_name],
+                slot=new_class.__dict__.get(field_name),  # on a Meta.slots model
+            )
+            setattr(new_class, field_name, descriptor)
+            options.related_object_descriptors[field_name] = descriptor
+            new_class._add_related_set(field_name, options.fields[field_name])
+
         options.abstract = getattr(attr_meta, "abstract", False)
         options.meta = attr_meta or getattr(new_class, "Meta", None)
         options.base_meta = getattr(new_class, "_meta", None)
+        options.server_side_filters = getattr(options.meta, "server_side_filters", True)
+        options.lua_queries = getattr(options.meta, "lua_queries", False)
+        options.cache_ttl = getattr(options.meta, "cache_ttl", None)
+        # cached models, and the models their cached results depend on, count writes
+        options.tracks_generation = options.cache_ttl is not None
+        for field_name in options.relationship_field_names:
+            related_model = options.fields[field_name].model
+            if related_model is None:
+                continue
+            if options.cache_ttl is not None:
+                related_model._meta.tracks_generation = True
+            if related_model._meta.cache_ttl is not None:
+                options.tracks_generation = True  # its prefetched related sets
+        options.slow_query_threshold = getattr(
+            options.meta, "slow_query_threshold", None
+        )
+        options.ttl = getattr(options.meta, "ttl", None)
+        # only expiring models record the index values reap_expired() needs
+        options.expires = options.ttl is not None or getattr(
+            options.meta, "expires", False
+        )
         new_class._meta = options
+        options.compile_layout()
         new_class.objects = new_class.query = Query(new_class)
         return new_class
 
 
 class Model(metaclass=ModelBase):
     query: Query
+    __slots__ = ()  # subclasses have a __dict__, unless Meta.slots
+    _db_content = dict()  # never mutated, only replaced. see Meta.track_changes
 
     def __init__(self, **kwargs):
-        cls = self.__class__
+        layout = self._meta.layout
         # self._ttl = kwargs.get('ttl', None)
         # self._expire_at = kwargs.get('expire_at', None)
 
         # allow init kwargs to set any base parameters
-        self.__dict__.update(kwargs)
-
-        # add auto KeyField if needed
-        if not len(self._meta.key_field_names):
-            from ..fields.shortcuts import AutoKeyField
-
-            self._meta.add_field("_auto_key", AutoKeyField())
-
-        # prep AutoKeys with new default ids
-        for field in self._meta.fields.values():
-            if hasattr(field, "auto") and field.auto:
-                field.set_auto_key_value()
-
-        # set defaults
-        for field_name, field in self._meta.fields.items():
-            setattr(self, field_name, field.default)
-
-        # set field values from init kwargs
-        for field_name in self._meta.fields.keys() & kwargs.keys():
-            setattr(self, field_name, kwargs.get(field_name))
-
-        # load relationships
-        if len(self._meta.relationship_field_names):
-            global RELATED_MODEL_LOAD_SEQUENCE
-            is_parent_model = len(RELATED_MODEL_LOAD_SEQUENCE) == 0
-            for field_name in self._meta.relationship_field_names:
-                if (
-                    f"{self.__class__.__name__}.{field_name}"
-                    in RELATED_MODEL_LOAD_SEQUENCE
-                ):
-                    continue
-                RELATED_MODEL_LOAD_SEQUENCE.add(
-                    f"{self.__class__.__name__}.{field_name}"
-                )
-
-                field_value = getattr(self, field_name)
-                if isinstance(field_value, Model):
-                    setattr(self, field_name, field_value)
-                elif isinstance(field_value, str):
-                    setattr(
-                        self,
-                        field_name,
-                        self._meta.fields[field_name].model.query.get(
-                            redis_key=field_value
-                        ),
-                    )
+        if not self._meta.slots:
+            self.__dict__.update(kwargs)
+        elif kwargs.keys() - self._meta.fields.keys():
+            raise ModelException(
+                f"{self.__class__.__name__} has no fields "
+                f"{', '.join(kwargs.keys() - self._meta.fields.keys())}"
+            )
 
-                # todo: lazy load the instance from the db
-                elif not field_value:
-                    setattr(self, field_name, None)
-                else:
-                    raise ModelException(
-                        f"{field_name} expects model instance or redis_key"
-                    )
-            if is_parent_model:
-                RELATED_MODEL_LOAD_SEQUENCE = set()
+        # set field values from init kwargs, else defaults. AutoKeys get new ids
+        for field_name, default_factory in layout.defaults:
+            if field_name in kwargs:
+                setattr(self, field_name, kwargs[field_name])
+            else:
+                setattr(self, field_name, default_factory())
 
         self._ttl = None  # todo: set default in child Meta class
         self._expire_at = None  # todo: datetime? or timestamp?
@@ -236,17 +394,93 @@ class Model(metaclass=ModelBase):
         # _db_key used by Redis cannot be known without performance cost
         # _db_key is predicted until synced during save() call
         if None not in [
-            getattr(self, key_field_name)
-            for key_field_name in self._meta.key_field_names
+            getattr(self, key_field_name) for key_field_name in layout.key_field_names
         ]:
-            self._redis_key = self.db_key.redis_key
+            self._redis_key = self._get_redis_key()
         self.obsolete_redis_key = (
             None  # to be used when db_key changes between loading and saving the object
         )
-        self._db_content = dict()  # empty until synced during save() call
+        if self._meta.track_changes:
+            self._db_content = dict()  # empty until synced during save() call
 
         # todo: create set of possible custom field keys
 
+    @classmethod
+    def _add_related_set(cls, field_name: str, field: Relationship):
+        """add the reverse of a Relationship field to its related model"""
+        related_model = field.model
+        if related_model is None:
+            return
+        related_name = field.related_name or f"{cls.__name__.lower()}_set"
+        # any attribute, inherited methods too, unless the model is being redefined
+        existing = inspect.getattr_static(related_model, related_name, None)
+        redefined = isinstance(existing, RelatedSetDescriptor) and (
+            existing.model.__name__,
+            existing.field_name,
+        ) == (cls.__name__, field_name)
+        if related_name in related_model._meta.fields or (
+            existing is not None and not redefined
+        ):
+            raise ModelException(
+                f"{cls.__name__}.{field_name} related_name {related_name} is taken "
+                f"on {related_model.__name__}. Set Relationship(related_name=...)"
+            )
+        descriptor = RelatedSetDescriptor(related_name, cls, field_name)
+        setattr(related_model, related_name, descriptor)
+        related_model._meta.related_sets[related_name] = descriptor
+
+    @classmethod
+    def from_redis(
+        cls, attrs: dict, redis_key=None, db_content: dict = None
+    ) -> "Model":
+        """
+        trusted constructor for objects read back from Redis
+        values were validated and formatted on save(), so unlike __init__ this skips
+        defaults for stored fields, validation, type coercion and auto key generation
+        :param attrs: decoded field values, by field name
+        :param redis_key: the key the hash was read from
+        :param db_content: the whole raw hash, if it was read. save() diffs against it
+        """
+        instance = cls.__new__(cls)
+        if not cls._meta.slots:
+            instance.__dict__.update(attrs)
+        else:
+            for field_name in cls._meta.fields.keys() & attrs.keys():
+                setattr(instance, field_name, attrs[field_name])
+        for field_name, default_factory in cls._meta.layout.defaults:
+            if field_name not in attrs:
+                # fields added after the object was saved. auto keys get no new ids
+                setattr(
+                    instance,
+                    field_name,
+                    cls._meta.fields[field_name].default
+                    if field_name in cls._meta.auto_field_names
+                    else default_factory(),
+                )
+
+        instance._ttl = None
+        instance._expire_at = None
+        if isinstance(redis_key, bytes):
+            redis_key = redis_key.decode(ENCODING)
+        instance._redis_key = redis_key or instance._get_redis_key()
+        instance.obsolete_redis_key = None
+        if cls._meta.track_changes:
+            instance._db_content = db_content or dict()
+        return instance
+
+    @classmethod
+    def _from_redis_key(cls, redis_key: str) -> "Model":
+        """an instance with only its key fields set, parsed from redis_key. no Redis read"""
+        return cls.from_redis(
+            dict(
+                zip(
+                    cls._meta.layout.key_field_names,
+                    DB_key.from_redis_key(redis_key)[1:],
+                )
+            ),
+            redis_key=redis_key,
+        )
+
     @property
     def db_key(self) -> DB_key:
         """
@@ -261,10 +495,23 @@ class Model(metaclass=ModelBase):
             self._meta.db_class_key,
             [
                 str(getattr(self, key_field_name, "None"))
-                for key_field_name in sorted(self._meta.key_field_names)
+                for key_field_name in self._meta.layout.key_field_names
             ],
         )
 
+    def _get_redis_key(self) -> str:
+        """db_key.redis_key, joined from the layout without building a DB_key"""
+        layout = self._meta.layout
+        return ":".join(
+            [
+                layout.db_class_redis_key,
+                *[
+                    DB_key.clean(str(getattr(self, key_field_name, "None")))
+                    for key_field_name in layout.key_field_names
+                ],
+            ]
+        )
+
     def __repr__(self):
         return f"<{self.__class__.__name__} Popoto object at {self.db_key.redis_key}>"
 
@@ -320,36 +567,31 @@ class Model(metaclass=ModelBase):
         - field.max_length ✅
         - ttl, expire_at - todo
         """
+        if self._ttl and self._expire_at:
+            raise ModelException("Can set either ttl and expire_at. Not both.")
+
+        for (
+            field_name,
+            get_value,
+            field,
+            field_type,
+            coerce_type,
+            max_length,
+            field_is_valid,
+        ) in self._meta.layout.validators:
+            value = get_value(self)
 
-        for field_name in self._meta.field_names:
             # type check the field values against their class specified type, unless null/None
-
-            if all(
-                [
-                    getattr(self, field_name) is not None,
-                    not isinstance(
-                        getattr(self, field_name), self._meta.fields[field_name].type
-                    ),
-                ]
-            ):
+            if value is not None and not isinstance(value, field_type):
                 try:
-                    if getattr(self, field_name) is not None:
-                        if self._meta.fields[field_name].type in VALID_FIELD_TYPES:
-                            setattr(
-                                self,
-                                field_name,
-                                self._meta.fields[field_name].type(
-                                    getattr(self, field_name)
-                                ),
-                            )
-                        else:
-                            pass  # do not force typing if custom type is defined
-                    if not isinstance(
-                        getattr(self, field_name), self._meta.fields[field_name].type
-                    ):
+                    if coerce_type:
+                        value = field_type(value)
+                        setattr(self, field_name, value)
+                    # else do not force typing if custom type is defined
+                    if not isinstance(value, field_type):
                         raise TypeError(
-                            f"Expected {field_name} to be type {self._meta.fields[field_name].type}. "
-                            f"It is type {type(getattr(self, field_name))}"
+                            f"Expected {field_name} to be type {field_type}. "
+                            f"It is type {type(value)}"
                         )
                 except TypeError as e:
                     logger.error(
@@ -358,11 +600,7 @@ class Model(metaclass=ModelBase):
                     return False
 
             # check non-nullable fields
-            if (
-                null_check
-                and self._meta.fields[field_name].null is False
-                and getattr(self, field_name) is None
-            ):
+            if null_check and field.null is False and value is None:
                 error = (
                     f"{field_name} is None/null. "
                     f"Set a value or set null=True on {self.__class__.__name__}.{field_name}"
@@ -371,28 +609,15 @@ class Model(metaclass=ModelBase):
                 return False
 
             # validate str max_length
-            if (
-                self._meta.fields[field_name].type == str
-                and getattr(self, field_name)
-                and len(getattr(self, field_name))
-                > self._meta.fields[field_name].max_length
-            ):
-                error = f"{field_name} is greater than max_length={self._meta.fields[field_name].max_length}"
+            if max_length is not None and value and len(value) > max_length:
+                error = f"{field_name} is greater than max_length={max_length}"
                 logger.error(error)
                 return False
 
-            if self._ttl and self._expire_at:
-                raise ModelException("Can set either ttl and expire_at. Not both.")
-
-        for field_name, field_value in self.__dict__.items():
-            if field_name in self._meta.fields.keys():
-                field_class = self._meta.fields[field_name].__class__
-                if not field_class.is_valid(
-                    self._meta.fields[field_name], field_value, null_check=null_check
-                ):
-                    error = f"Validation on [{field_name}] Field failed"
-                    logger.error(error)
-                    return False
+            if not field_is_valid(field, value, null_check=null_check):
+                error = f"Validation on [{field_name}] Field failed"
+                logger.error(error)
+                return False
 
         return True
 
@@ -414,9 +639,10 @@ class Model(metaclass=ModelBase):
             return False
 
         # run any necessary formatting on field data before saving
+        getters = self._meta.layout.getters
         for field_name, field in self._meta.fields.items():
             setattr(
-                self, field_name, field.format_value_pre_save(getattr(self, field_name))
+                self, field_name, field.format_value_pre_save(getters[field_name](self))
             )
         return pipeline if pipeline else True
 
@@ -424,12 +650,36 @@ class Model(metaclass=ModelBase):
         self,
         pipeline: redis.client.Pipeline = None,
         ignore_errors: bool = False,
+        update_fields: list = None,
+        ttl=None,
+        expire_at=None,
         **kwargs,
     ):
         """
         Model instance save method. Uses Redis HSET command with key, dict of values, ttl.
         Also triggers all field on_save methods.
+        Without a pipeline, all commands run in one script: one atomic round trip.
+        An object loaded from or saved to Redis under the same db key writes only
+        its changed fields, and only updates the indexes depending on them.
+        :param update_fields: write only these fields, if changed
+        :param ttl: seconds (or timedelta) until the object expires, default Meta.ttl
+        :param expire_at: datetime (or timestamp) when the object expires
+        saving without ttl or expire_at, and without Meta.ttl, keeps the current expiry
+        ttl and expire_at need Meta.ttl or Meta.expires = True
         """
+        if ttl is not None or expire_at is not None:
+            if not self._meta.expires:
+                raise ModelException(
+                    f"{self.__class__.__name__} objects do not expire. "
+                    f"Set Meta.ttl or Meta.expires = True"
+                )
+            self._ttl, self._expire_at = ttl, expire_at
+        if update_fields is not None:
+            unknown_field_names = set(update_fields) - self._meta.fields.keys()
+            if unknown_field_names:
+                raise ModelException(
+                    f"update_fields has unknown fields: {', '.join(unknown_field_names)}"
+                )
 
         pipeline_or_success = self.pre_save(
             pipeline=pipeline, ignore_errors=ignore_errors, **kwargs
@@ -439,13 +689,6 @@ class Model(metaclass=ModelBase):
         elif pipeline:
             pipeline = pipeline_or_success
 
-        new_db_key = DB_key(self.db_key)  # todo: why have a new key??
-        if self._redis_key != new_db_key.redis_key:
-            self.obsolete_redis_key = self._redis_key
-
-        # todo: implement and test tll, expire_at
-        # ttl, expire_at = (ttl or self._ttl), (expire_at or self._expire_at)
-
         """
         1. save object as hashmap
         2. optionally set ttl, expire_at
@@ -453,94 +696,441 @@ class Model(metaclass=ModelBase):
         4. if obsolete key, delete and run field on_delete methods
         5. run field on_save methods
         6. save private version of compiled db key
+        7. increment the model generation, expiring cached query results
         """
 
+        if isinstance(pipeline, redis.client.Pipeline):
+            queued_count = len(pipeline)
+            pipeline = self._queue_save(
+                pipeline,
+                ignore_errors=ignore_errors,
+                update_fields=update_fields,
+                **kwargs,
+            )
+            if len(pipeline) == queued_count:
+                return pipeline  # nothing changed
+            return self._queue_generation_increment(pipeline)  # 7
+
+        else:
+            pipeline = self._queue_save(
+                ScriptPipeline(),
+                ignore_errors=ignore_errors,
+                update_fields=update_fields,
+                **kwargs,
+            )
+            if not len(pipeline):
+                return 0  # nothing changed
+            self._queue_generation_increment(pipeline)  # 7
+            return pipeline.execute()[0]  # the HSET reply
+
+    def _queue_save(
+        self,
+        pipeline: redis.client.Pipeline,
+        ignore_errors: bool = False,
+        update_fields: list = None,
+        **kwargs,
+    ) -> redis.client.Pipeline:
+        """
+        queue steps 1-6 of save() on a pipeline, for an instance through pre_save()
+        the model generation is not incremented, see save() and bulk_save()
+        """
         hset_mapping = encode_popoto_model_obj(self)  # 1
-        self._db_content = hset_mapping  # 1
+        if self._is_synced():
+            changes, changed_field_names = self._queue_changes(
+                ScriptPipeline(), hset_mapping, update_fields=update_fields, **kwargs
+            )
+            changes = self._queue_expiry(
+                changes, hset_mapping, changed_field_names
+            )  # 2
+            if not len(changes):
+                return pipeline  # nothing changed
+            # deleted or expired since it was loaded, the hash is saved anew
+            new_hash = self._queue_new_hash(
+                ScriptPipeline(), hset_mapping, ignore_errors=ignore_errors, **kwargs
+            )
+            return queue_if_exists(pipeline, self._redis_key, changes, new_hash)
+        elif update_fields is not None:
+            raise ModelException(
+                "update_fields needs an object loaded from or saved to Redis"
+            )
 
-        if isinstance(pipeline, redis.client.Pipeline):
-            pipeline = pipeline.hset(new_db_key.redis_key, mapping=hset_mapping)  # 1
-            # if ttl is not None:
-            #     pipeline = pipeline.expire(new_db_key, ttl)  # 2
-            # if expire_at is not None:
-            #     pipeline = pipeline.expire_at(new_db_key, expire_at)  # 2
-            pipeline = pipeline.sadd(
-                self._meta.db_class_set_key.redis_key, new_db_key.redis_key
-            )  # 3
-            if (
-                self.obsolete_redis_key
-                and self.obsolete_redis_key != new_db_key.redis_key
-            ):  # 4
-                for field_name, field in self._meta.fields.items():
-                    pipeline = field.on_delete(  # 4
-                        model_instance=self,
-                        field_name=field_name,
-                        field_value=getattr(self, field_name),
-                        pipeline=pipeline,
-                        **kwargs,
-                    )
-                pipeline.delete(self.obsolete_redis_key)  # 4
-                self.obsolete_redis_key = None
-            for field_name, field in self._meta.fields.items():  # 5
-                pipeline = field.on_save(  # 5
-                    self,
+        new_redis_key = self._get_redis_key()
+        if self._redis_key != new_redis_key:
+            self.obsolete_redis_key = self._redis_key
+        old_instance = self._get_synced_instance() if self._db_content else self
+        getters = self._meta.layout.getters
+        if self._meta.track_changes:
+            self._db_content = hset_mapping  # 1
+        self._redis_key = new_redis_key  # 6
+        pipeline = self._queue_new_hash(
+            pipeline, hset_mapping, ignore_errors=ignore_errors, **kwargs
+        )  # 1, 3, 5, 2
+
+        if self.obsolete_redis_key and self.obsolete_redis_key != new_redis_key:  # 4
+            for field_name, field in self._meta.fields.items():
+                pipeline = field.on_delete(  # 4
+                    model_instance=old_instance,
                     field_name=field_name,
-                    field_value=getattr(self, field_name),
-                    # ttl=ttl, expire_at=expire_at,
-                    ignore_errors=ignore_errors,
+                    field_value=getters[field_name](old_instance),
                     pipeline=pipeline,
                     **kwargs,
                 )
-            self._redis_key = new_db_key.redis_key  # 6
+            pipeline.delete(self.obsolete_redis_key)  # 4
+            pipeline.srem(
+                self._meta.db_class_set_key.redis_key, self.obsolete_redis_key
+            )  # 4
+            self._queue_expiry_removal(pipeline, [self.obsolete_redis_key])  # 4
+            identity_map = get_identity_map()
+            if identity_map is not None:
+                identity_map.discard(self.obsolete_redis_key)  # 4
+            self.obsolete_redis_key = None
+        return pipeline
+
+    def _queue_new_hash(
+        self,
+        pipeline: redis.client.Pipeline,
+        hset_mapping: dict,
+        ignore_errors: bool = False,
+        **kwargs,
+    ) -> redis.client.Pipeline:
+        """queue steps 1, 3, 5 and 2 of save(): the whole hash and all its indexes"""
+        pipeline = pipeline.hset(self._redis_key, mapping=hset_mapping)  # 1
+        pipeline = pipeline.sadd(
+            self._meta.db_class_set_key.redis_key, self._redis_key
+        )  # 3
+        getters = self._meta.layout.getters
+        for field_name, field in self._meta.fields.items():  # 5
+            pipeline = field.on_save(  # 5
+                self,
+                field_name=field_name,
+                field_value=getters[field_name](self),
+                ignore_errors=ignore_errors,
+                pipeline=pipeline,
+                **kwargs,
+            )
+        return self._queue_expiry(pipeline, hset_mapping, self._meta.fields)  # 2
+
+    def _get_expire_at(self):
+        """the timestamp set by save(ttl=, expire_at=) or Meta.ttl, else None"""
+        if self._expire_at is not None:
+            if isinstance(self._expire_at, datetime):
+                return self._expire_at.timestamp()
+            return float(self._expire_at)
+        ttl = self._ttl if self._ttl is not None else self._meta.ttl
+        if ttl is None:
+            return None
+        if isinstance(ttl, timedelta):
+            ttl = ttl.total_seconds()
+        return time.time() + ttl
+
+    def _queue_expiry(
+        self, pipeline: redis.client.Pipeline, hset_mapping: dict, field_names
+    ) -> redis.client.Pipeline:
+        """
+        queue the expiry of the hash, recorded in the expiry sorted set with the values
+        its index entries depend on, for reap_expired().
+        without an expiry, the recorded values of field_names are updated, if recorded
+        """
+        options = self._meta
+        if not options.expires:
+            return pipeline
+        expire_at = self._get_expire_at()
+        if expire_at is not None:
+            field_names = options.layout.expiry_field_names
+        expiry_values = {
+            f"{field_name}:{self._redis_key}": hset_mapping[field_name.encode(ENCODING)]
+            for field_name in options.layout.expiry_field_names
+            if field_name in field_names
+        }
+        if expire_at is not None:
+            pipeline.pexpireat(self._redis_key, int(expire_at * 1000))
+            pipeline.zadd(options.db_expiry_key.redis_key, {self._redis_key: expire_at})
+            if expiry_values:
+                pipeline.hset(
+                    options.db_expiry_values_key.redis_key, mapping=expiry_values
+                )
+        elif expiry_values:
+            queue_expiry_values_script(
+                pipeline,
+                options.db_expiry_key.redis_key,
+                options.db_expiry_values_key.redis_key,
+                self._redis_key,
+                expiry_values,
+            )
+        return pipeline
+
+    @classmethod
+    def _queue_expiry_removal(
+        cls, pipeline: redis.client.Pipeline, redis_keys: list
+    ) -> redis.client.Pipeline:
+        """forget the expiry records of redis_keys"""
+        if not cls._meta.expires:
             return pipeline
+        redis_keys = [
+            redis_key.decode(ENCODING) if isinstance(redis_key, bytes) else redis_key
+            for redis_key in redis_keys
+        ]
+        pipeline.zrem(cls._meta.db_expiry_key.redis_key, *redis_keys)
+        if cls._meta.layout.expiry_field_names:
+            pipeline.hdel(
+                cls._meta.db_expiry_values_key.redis_key,
+                *[
+                    f"{field_name}:{redis_key}"
+                    for redis_key in redis_keys
+                    for field_name in cls._meta.layout.expiry_field_names
+                ],
+            )
+        return pipeline
 
-        else:
-            db_response = POPOTO_REDIS_DB.hset(
-                new_db_key.redis_key, mapping=hset_mapping
-            )  # 1
-            # if ttl is not None:
-            #     POPOTO_REDIS_DB.expire(new_db_key, ttl)  # 2
-            # if expire_at is not None:
-            #     POPOTO_REDIS_DB.expireat(new_db_key, ttl)  # 2
-            POPOTO_REDIS_DB.sadd(
-                self._meta.db_class_set_key.redis_key, new_db_key.redis_key
-            )  # 3
-
-            if (
-                self.obsolete_redis_key
-                and self.obsolete_redis_key != new_db_key.redis_key
-            ):  # 4
-                for field_name, field in self._meta.fields.items():
-                    field.on_delete(  # 4
-                        model_instance=self,
-                        field_name=field_name,
-                        field_value=getattr(self, field_name),
-                        pipeline=None,
-                        **kwargs,
+    @classmethod
+    def _queue_generation_increment(
+        cls, pipeline: redis.client.Pipeline
+    ) -> redis.client.Pipeline:
+        """expire cached query results depending on this model, see QueryCache"""
+        if cls._meta.tracks_generation:
+            pipeline.incr(cls._meta.db_generation_key.redis_key)
+        return pipeline
+
+    @classmethod
+    def reap_expired(cls, batch_size: int = REAP_BATCH_SIZE) -> int:
+        """
+        remove the index entries of up to batch_size objects expired by Redis,
+        using the values recorded when they were saved. See ExpiryReaper
+        :return: the number of reaped objects
+        """
+        options = cls._meta
+        if not options.expires:
+            return 0
+        expired = run_reap_script(
+            options.db_expiry_key.redis_key,
+            options.db_expiry_values_key.redis_key,
+            time.time(),
+            batch_size,
+            options.layout.expiry_field_names,
+        )
+        if not expired:
+            return 0
+
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        redis_keys = []
+        for redis_key, values in zip(expired[::2], expired[1::2]):
+            redis_key = redis_key.decode(ENCODING)
+            redis_keys.append(redis_key)
+            instance = cls._from_redis_key(redis_key)
+            for field_name, value in cls._decode_field_values(
+                dict(
+                    zip(
+                        [
+                            field_name.encode(ENCODING)
+                            for field_name in options.layout.expiry_field_names
+                        ],
+                        values,
                     )
-                POPOTO_REDIS_DB.delete(self.obsolete_redis_key)  # 4
-                self.obsolete_redis_key = None
+                ),
+                options.layout.expiry_field_names,
+            ).items():
+                setattr(instance, field_name, value)
+            for field_name, field in options.fields.items():
+                pipeline = field.on_delete(
+                    model_instance=instance,
+                    field_name=field_name,
+                    field_value=getattr(instance, field_name),
+                    pipeline=pipeline,
+                )
+        pipeline.srem(options.db_class_set_key.redis_key, *redis_keys)
+        cls._queue_expiry_removal(pipeline, redis_keys)
+        cls._queue_generation_increment(pipeline)
+        pipeline.execute()
+        discard_from_identity_map(redis_keys)
+        return len(redis_keys)
+
+    def _is_synced(self) -> bool:
+        """the object was loaded from or saved to Redis, and its db key is unchanged"""
+        return bool(self._db_content) and self._redis_key == self._get_redis_key()
 
-            for field_name, field in self._meta.fields.items():  # 5
-                field.on_save(  # 5
-                    self,
+    def _get_synced_values(self, field_names) -> dict:
+        """the values of field_names as last loaded or saved, decoded from _db_content"""
+        return self._decode_field_values(self._db_content, field_names)
+
+    @classmethod
+    def _decode_field_values(cls, encoded_values: dict, field_names) -> dict:
+        """
+        decode field_names from {field name bytes: encoded value}, defaults if missing
+        related objects are rebuilt from their redis keys, without reading Redis
+        """
+        values = dict()
+        for field_name in field_names:
+            field = cls._meta.fields[field_name]
+            value_b = encoded_values.get(field_name.encode(ENCODING))
+            if value_b is None:  # field added after the object was saved
+                values[field_name] = field.default
+                continue
+            value = decode_custom_types(msgpack.unpackb(value_b))
+            if value and field_name in cls._meta.relationship_field_names:
+                value = field.model._from_redis_key(value)
+            values[field_name] = value
+        return values
+
+    def _get_synced_instance(self) -> "Model":
+        """a copy of the object as last loaded or saved, to compute its old index entries"""
+        return self.from_redis(
+            self._get_synced_values(self._meta.fields), redis_key=self._redis_key
+        )
+
+    def get_changed_fields(self) -> list:
+        """
+        names of the fields changed since the object was loaded or last saved
+        every field, if it never was
+        """
+        hset_mapping = encode_popoto_model_obj(self)
+        return [
+            field_name
+            for field_name in self._meta.fields
+            if self._db_content.get(field_name.encode(ENCODING))
+            != hset_mapping[field_name.encode(ENCODING)]
+        ]
+
+    def _queue_changes(
+        self,
+        pipeline: redis.client.Pipeline,
+        hset_mapping: dict,
+        update_fields: list = None,
+        **kwargs,
+    ) -> redis.client.Pipeline:
+        """
+        queue the save of a synced object: HSET of the fields that differ from
+        _db_content, then on_delete with the old values and on_save with the new
+        for the indexes depending on them. Nothing is queued if nothing changed
+        :return: (pipeline, names of the changed fields)
+        """
+        changed_mapping = {
+            field_name_b: hset_mapping[field_name_b]
+            for field_name_b in (
+                hset_mapping
+                if update_fields is None
+                else [field_name.encode(ENCODING) for field_name in update_fields]
+            )
+            if self._db_content.get(field_name_b) != hset_mapping[field_name_b]
+        }
+        if not changed_mapping:
+            return pipeline, set()
+
+        pipeline = pipeline.hset(self._redis_key, mapping=changed_mapping)  # 1
+        changed_field_names = {
+            field_name_b.decode(ENCODING) for field_name_b in changed_mapping
+        }
+        indexed_field_names = self._meta.get_indexed_field_names(changed_field_names)
+        if indexed_field_names:
+            getters = self._meta.layout.getters
+            # index entries are computed from what is stored, before and after
+            synced_values = self._get_synced_values(
+                self._meta.get_index_load_field_names(indexed_field_names)
+            )
+            old_instance = self.from_redis(synced_values, redis_key=self._redis_key)
+            new_instance = self.from_redis(
+                {
+                    **synced_values,
+                    **{
+                        field_name: getters[field_name](self)
+                        for field_name in changed_field_names & synced_values.keys()
+                    },
+                },
+                redis_key=self._redis_key,
+            )
+            for field_name in indexed_field_names:
+                field = self._meta.fields[field_name]
+                pipeline = field.on_delete(  # 4
+                    model_instance=old_instance,
                     field_name=field_name,
-                    field_value=getattr(self, field_name),
-                    # ttl=ttl, expire_at=expire_at,
-                    ignore_errors=ignore_errors,
-                    pipeline=None,
+                    field_value=getters[field_name](old_instance),
+                    pipeline=pipeline,
                     **kwargs,
                 )
-
-            self._redis_key = new_db_key.redis_key  # 6
-            return db_response
+                pipeline = field.on_save(  # 5
+                    new_instance,
+                    field_name=field_name,
+                    field_value=getters[field_name](new_instance),
+                    pipeline=pipeline,
+                    **kwargs,
+                )
+        self._db_content = {**self._db_content, **changed_mapping}
+        return pipeline, changed_field_names
 
     @classmethod
-    def create(cls, pipeline: redis.client.Pipeline = None, **kwargs):
+    def create(
+        cls, pipeline: redis.client.Pipeline = None, ttl=None, expire_at=None, **kwargs
+    ):
+        """:param ttl, expire_at: the object's expiry, see save()"""
         instance = cls(**kwargs)
-        pipeline_or_db_response = instance.save(pipeline=pipeline)
+        pipeline_or_db_response = instance.save(
+            pipeline=pipeline, ttl=ttl, expire_at=expire_at
+        )
         return pipeline_or_db_response if pipeline else instance
 
+    @classmethod
+    def bulk_create(cls, objects, batch_size: int = BULK_BATCH_SIZE) -> tuple:
+        """
+        create many objects, batch_size per pipeline. See bulk_save()
+        :param objects: iterable of field values dicts, or of unsaved instances
+        :return: (number of created objects, list of (object, exception) for the others)
+        """
+        errors = []
+
+        def instances():
+            for obj in objects:
+                if isinstance(obj, cls):
+                    yield obj
+                    continue
+                try:
+                    yield cls(**obj)
+                except Exception as e:
+                    errors.append((obj, e))
+
+        created_count, save_errors = cls.bulk_save(instances(), batch_size=batch_size)
+        return created_count, errors + save_errors
+
+    @classmethod
+    def bulk_save(cls, instances, batch_size: int = BULK_BATCH_SIZE) -> tuple:
+        """
+        save many instances, streaming them through validation and encoding.
+        Each batch is one non-transactional pipeline holding every HSET, SADD and index write,
+        plus a single increment of the model generation.
+        Invalid instances, and instances with a failed command, are reported and skipped.
+        :param instances: iterable of instances of this model
+        :return: (number of saved instances, list of (instance, exception) for the others)
+        """
+        saved_count, errors = 0, []
+        instances = iter(instances)
+        while True:
+            pipeline = POPOTO_REDIS_DB.pipeline(transaction=False)
+            reply_ranges = []  # (instance, first reply index, reply index after)
+            for instance in instances:
+                try:
+                    instance.pre_save()
+                    start = len(pipeline)
+                    pipeline = instance._queue_save(pipeline)
+                except Exception as e:
+                    errors.append((instance, e))
+                    continue
+                reply_ranges.append((instance, start, len(pipeline)))
+                if len(reply_ranges) >= batch_size:
+                    break
+            if not reply_ranges:
+                return saved_count, errors
+
+            cls._queue_generation_increment(pipeline)
+            replies = pipeline.execute(raise_on_error=False)
+            for instance, start, stop in reply_ranges:
+                failures = [
+                    reply
+                    for reply in replies[start:stop]
+                    if isinstance(reply, Exception)
+                ]
+                if failures:
+                    errors.append((instance, failures[0]))
+                else:
+                    saved_count += 1
+
     @classmethod
     def load(cls, db_key: str = None, **kwargs):
         return cls.query.get(db_key=db_key or cls(**kwargs).db_key)
@@ -549,39 +1139,43 @@ class Model(metaclass=ModelBase):
         """
         Model instance delete method. Uses Redis DELETE command with key.
         Also triggers all field on_delete methods.
+        Without a pipeline, all commands run in one script: one atomic round trip.
         1. delete object as hashmap
-        2. delete from class set
+        2. delete from class set and increment the model generation
         3. run field on_delete methods
         4. reset private vars
         returns pipeline or boolean(object existed AND was deleted)
         """
         delete_redis_key = self._redis_key or self.db_key.redis_key
-        db_response = False
-
-        if pipeline:
-            pipeline = pipeline.delete(delete_redis_key)  # 1
-        else:
-            db_response = POPOTO_REDIS_DB.delete(delete_redis_key)  # 1
-            pipeline = POPOTO_REDIS_DB.pipeline()
+        execute = pipeline is None
 
+        if execute:
+            pipeline = ScriptPipeline()
+        pipeline = pipeline.delete(delete_redis_key)  # 1
         pipeline = pipeline.srem(
             self._meta.db_class_set_key.redis_key, delete_redis_key
         )  # 2
+        pipeline = self._queue_generation_increment(pipeline)  # 2
+        pipeline = self._queue_expiry_removal(pipeline, [delete_redis_key])  # 2
 
+        getters = self._meta.layout.getters
         for field_name, field in self._meta.fields.items():  # 3
             pipeline = field.on_delete(
                 model_instance=self,
                 field_name=field_name,
-                field_value=getattr(self, field_name),
+                field_value=getters[field_name](self),
                 pipeline=pipeline,
                 **kwargs,
             )
 
-        self._db_content = dict()  # 4
+        if self._meta.track_changes:
+            self._db_content = dict()  # 4
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.discard(delete_redis_key)  # 4
 
-        if db_response is not False:
-            pipeline.execute()
-            return bool(db_response > 0)
+        if execute:
+            return bool(pipeline.execute()[0] > 0)
         else:
             return pipeline
 
@@ -2,17 +2,20 @@ from collections.abc import Iterable
 
 from ..redis_db import POPOTO_REDIS_DB, ENCODING
 
+# escape "/" first, then the glob-style special chars, then ":" the key separator
+CLEAN_TRANSLATION = str.maketrans(
+    {"/": "//", **{char: f"/{char}" for char in "'?*^[]-"}, ":": "{&#58;}"}
+)
+
 
 class DB_key(list):
     def __init__(self, *key_partials):
         def flatten(yet_flat):
-            if isinstance(yet_flat, Iterable) and not isinstance(
-                yet_flat, (str, bytes)
-            ):
-                for item in yet_flat:
+            for item in yet_flat:
+                if isinstance(item, (str, bytes)) or not isinstance(item, Iterable):
+                    yield item
+                else:
                     yield from flatten(item)
-            else:
-                yield yet_flat
 
         super().__init__(flatten(key_partials))
 
@@ -24,11 +27,7 @@ class DB_key(list):
 
     @classmethod
     def clean(cls, value: str) -> str:
-        value = value.replace("/", "//")
-        for char in "'?*^[]-":
-            value = value.replace(char, f"/{char}")
-        value = value.replace(":", "{&#58;}")
-        return value
+        return value.translate(CLEAN_TRANSLATION)
 
     @classmethod
     def unclean(cls, value: str) -> str:
@@ -62,4 +61,6 @@ class DB_key(list):
         redis_hash = POPOTO_REDIS_DB.hgetall(self.redis_key)
         from .encoding import decode_popoto_model_hashmap
 
-        return decode_popoto_model_hashmap(model_class, redis_hash)
+        return decode_popoto_model_hashmap(
+            model_class, redis_hash, redis_key=self.redis_key
+        )
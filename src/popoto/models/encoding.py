@@ -3,6 +3,7 @@ from collections import namedtuple
 from decimal import Decimal
 import msgpack
 import pandas as pd
+from .identity_map import get_identity_map
 from ..exceptions import ModelException
 from ..redis_db import ENCODING
 
@@ -82,52 +83,88 @@ def decode_custom_types(obj):
 #     return obj
 
 
+def encode_field_value(field: "Field", value) -> bytes:
+    # use db_key string for relationships
+    from ..fields.relationship import Relationship
+
+    if value is not None and isinstance(field, Relationship):
+        if isinstance(value, str):
+            return msgpack.packb(value)  # the redis key of an object not read yet
+        if not isinstance(value, field.model):
+            raise ModelException(
+                f"Relationship field requires {field.model} model instance. got {value} instead"
+            )
+        return msgpack.packb(value.db_key.redis_key)
+        # todo: refactor to store db_key list, not redis_key
+
+    elif value is not None and field.type in TYPE_ENCODER_DECODERS.keys():
+        return msgpack.packb(TYPE_ENCODER_DECODERS[field.type].encoder(value))
+    return msgpack.packb(value)
+
+
+def get_field_encoder(field: "Field"):
+    """a function encoding values of field, for the model's compiled layout"""
+    from ..fields.relationship import Relationship
+
+    if isinstance(field, Relationship):
+        return lambda value: encode_field_value(field, value)
+    elif field.type in TYPE_ENCODER_DECODERS.keys():
+        type_encoder = TYPE_ENCODER_DECODERS[field.type].encoder
+        return lambda value: msgpack.packb(
+            type_encoder(value) if value is not None else None
+        )
+    return lambda value: msgpack.packb(value)
+
+
 def encode_popoto_model_obj(obj: "Model") -> dict:
     import msgpack_numpy as m
 
     m.patch()
 
-    encoded_hashmap = dict()
-    for field_name, field in obj._meta.fields.items():
-        value = getattr(obj, field_name)
-
-        # use db_key string for relationships
-        from ..fields.relationship import Relationship
+    return {
+        field_name_b: encoder(get_value(obj))
+        for get_value, field_name_b, encoder in obj._meta.layout.encoders
+    }
 
-        if value is not None and isinstance(field, Relationship):
-            if not isinstance(value, field.model):
-                raise ModelException(
-                    f"Relationship field requires {field.model} model instance. got {value} instead"
-                )
-            encoded_value = msgpack.packb(value.db_key.redis_key)
-            # todo: refactor to store db_key list, not redis_key
 
-        elif value is not None and field.type in TYPE_ENCODER_DECODERS.keys():
-            encoded_value = msgpack.packb(
-                TYPE_ENCODER_DECODERS[field.type].encoder(value)
-            )
-        else:
-            encoded_value = msgpack.packb(value)
+def encode_field_values(model_class: "Model", values: dict) -> dict:
+    """encode some field values of model_class, eg. for a partial HSET"""
+    import msgpack_numpy as m
 
-        encoded_hashmap[str(field_name).encode(ENCODING)] = encoded_value
+    m.patch()
 
-    return encoded_hashmap
+    return {
+        str(field_name).encode(ENCODING): encode_field_value(
+            model_class._meta.fields[field_name], value
+        )
+        for field_name, value in values.items()
+    }
 
 
 def decode_popoto_model_hashmap(
-    model_class: "Model", redis_hash: dict, fields_only=False
+    model_class: "Model", redis_hash: dict, fields_only=False, redis_key=None
 ) -> "Model":
     """
     fields_only=True return only the fields dict, not a model object
     (also skips decoding of the field keys)
+    redis_key is the key the hash was read from, saves recomputing it on the object
+    inside an IdentityMap, an object already decoded from redis_key is returned
     """
     if len(redis_hash):
+        identity_map = get_identity_map() if redis_key and not fields_only else None
+        if identity_map is not None and redis_key in identity_map:
+            return identity_map.get(redis_key)
         model_attrs = {
             key_b.decode(ENCODING)
             if not fields_only
             else key_b: decode_custom_types(msgpack.unpackb(value_b))
             for key_b, value_b in redis_hash.items()
         }
-        return model_attrs if fields_only else model_class(**model_attrs)
+        if fields_only:
+            return model_attrs
+        instance = model_class.from_redis(
+            model_attrs, redis_key=redis_key, db_content=redis_hash
+        )
+        return identity_map.add(instance) if identity_map is not None else instance
 
     return None
@@ -0,0 +1,53 @@
+import logging
+import threading
+
+from .base import REAP_BATCH_SIZE
+
+logger = logging.getLogger("POPOTO.expiry")
+
+
+class ExpiryReaper(threading.Thread):
+    """
+    A daemon thread removing the index entries of expired objects.
+    Every interval seconds, each model's reap_expired() runs batch after batch
+    until the objects due are reaped, so memory stays bounded.
+
+    reaper = ExpiryReaper([Session, CachedPage], interval=5)
+    reaper.start()
+    ...
+    reaper.stop()
+    """
+
+    def __init__(
+        self, models: list, interval: float = 1.0, batch_size: int = REAP_BATCH_SIZE
+    ):
+        super().__init__(name="POPOTO.ExpiryReaper", daemon=True)
+        self.models = list(models)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.reaped_count = 0
+        self._stopped = threading.Event()
+
+    def reap(self) -> int:
+        """reap every due object of every model once. :return: the number reaped"""
+        reaped_count = 0
+        for model in self.models:
+            while not self._stopped.is_set():
+                batch_count = model.reap_expired(batch_size=self.batch_size)
+                reaped_count += batch_count
+                if batch_count < self.batch_size:
+                    break
+        self.reaped_count += reaped_count
+        return reaped_count
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"reaping expired objects failed: {e}")
+            self._stopped.wait(self.interval)
+
+    def stop(self, timeout: float = None):
+        self._stopped.set()
+        self.join(timeout)
@@ -0,0 +1,105 @@
+import logging
+
+from .key_sources import Difference, IndexSet, Intersection, Union
+
+logger = logging.getLogger("POPOTO.Q")
+
+
+class Q:
+    """
+    A filter expression. Filter kwargs are AND'ed, like in filter().
+    Combine expressions with & (AND), | (OR) and ~ (NOT).
+    Resolved inside Redis with SINTERSTORE, SUNIONSTORE and SDIFFSTORE (or ZINTERSTORE, ..)
+    NOT is the difference between the model's class set and the negated expression
+
+    Model.query.filter(Q(status="open") | Q(priority__gte=5), ~Q(owner=bob))
+    """
+
+    AND = "AND"
+    OR = "OR"
+
+    def __init__(self, *children, _connector: str = AND, _negated=False, **kwargs):
+        # each child is another Q, or a dict of filter kwargs
+        self.children = [*children, kwargs] if kwargs else list(children)
+        self.connector = _connector
+        self.negated = _negated
+
+    def _combine(self, other, connector: str) -> "Q":
+        if not isinstance(other, Q):
+            raise TypeError(f"cannot combine Q with {type(other)}")
+        return Q(self, other, _connector=connector)
+
+    def __or__(self, other) -> "Q":
+        return self._combine(other, self.OR)
+
+    def __and__(self, other) -> "Q":
+        return self._combine(other, self.AND)
+
+    def __invert__(self) -> "Q":
+        return Q(*self.children, _connector=self.connector, _negated=not self.negated)
+
+    def __eq__(self, other):
+        return isinstance(other, Q) and repr(self) == repr(other)
+
+    def __repr__(self):
+        children = ", ".join(
+            repr(child) if isinstance(child, Q) else repr(sorted(child.items()))
+            for child in self.children
+        )
+        return f"<Q{' NOT' if self.negated else ''} {self.connector}: {children}>"
+
+    def check(self, query: "Query"):
+        """raise QueryException on invalid filter params anywhere in the expression"""
+        from .query import QueryException, QUERY_OPTION_NAMES
+
+        for child in self.children:
+            if isinstance(child, Q):
+                child.check(query)
+                continue
+            if set(child) & QUERY_OPTION_NAMES:
+                raise QueryException(
+                    f"{', '.join(set(child) & QUERY_OPTION_NAMES)} cannot be used in a Q object"
+                )
+            query.get_filters_by_field(**child)
+
+    def get_key_source(self, query: "Query") -> "KeySource":
+        """compile the expression into one KeySource, to be staged in Redis"""
+        key_sources = []
+        for child in self.children:
+            if isinstance(child, Q):
+                key_sources.append(child.get_key_source(query))
+            else:
+                key_sources.append(
+                    Intersection(
+                        query.get_key_sources(query.get_filters_by_field(**child))
+                    )
+                )
+
+        class_set = IndexSet(query.model_class._meta.db_class_set_key.redis_key)
+        if not key_sources:
+            key_source = class_set  # Q() matches everything
+        elif self.connector == self.OR:
+            key_source = Union(key_sources)
+        else:
+            key_source = Intersection(key_sources)
+        if self.negated:
+            key_source = Difference(class_set, key_source)
+        return key_source
+
+    def get_db_keys_set(self, query: "Query") -> set:
+        """resolve the expression in Python, for models without server_side_filters"""
+        db_keys_sets = [
+            child.get_db_keys_set(query)
+            if isinstance(child, Q)
+            else query.filter_for_keys_set(**child)
+            for child in self.children
+        ]
+        if not db_keys_sets:
+            db_keys = set(query.keys())
+        elif self.connector == self.OR:
+            db_keys = set().union(*db_keys_sets)
+        else:
+            db_keys = set.intersection(*db_keys_sets)
+        if self.negated:
+            db_keys = set(query.keys()) - db_keys
+        return db_keys
@@ -0,0 +1,67 @@
+import logging
+from contextvars import ContextVar
+
+from ..redis_db import ENCODING
+
+logger = logging.getLogger("POPOTO.identity_map")
+
+_current_identity_map = ContextVar("popoto_identity_map", default=None)
+
+
+class IdentityMap:
+    """
+    A unit of work in which each object is read from Redis and decoded once.
+    Inside the context, query.get(), query results and related objects
+    share one instance per redis key, and objects already loaded are not read again.
+    The map lives in a ContextVar, so threads and asyncio tasks have their own.
+    Objects changed by others during the context are not reloaded.
+
+    with IdentityMap():
+        prices = Price.query.filter(day=today)  # each Ticker is read once
+        assert prices[0].ticker is prices[1].ticker
+    """
+
+    def __init__(self):
+        self.instances = {}
+        self._token = None
+
+    def __enter__(self) -> "IdentityMap":
+        self._token = _current_identity_map.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _current_identity_map.reset(self._token)
+        self._token = None
+
+    def __len__(self):
+        return len(self.instances)
+
+    def __contains__(self, redis_key) -> bool:
+        return _to_str(redis_key) in self.instances
+
+    def get(self, redis_key) -> "Model":
+        return self.instances.get(_to_str(redis_key))
+
+    def add(self, instance: "Model") -> "Model":
+        """:return: the instance already mapped to its redis key, else instance"""
+        return self.instances.setdefault(instance._redis_key, instance)
+
+    def discard(self, redis_key):
+        self.instances.pop(_to_str(redis_key), None)
+
+
+def _to_str(redis_key) -> str:
+    return redis_key.decode(ENCODING) if isinstance(redis_key, bytes) else redis_key
+
+
+def get_identity_map() -> IdentityMap:
+    """the IdentityMap of the current context, or None"""
+    return _current_identity_map.get()
+
+
+def discard_from_identity_map(redis_keys):
+    """forget objects deleted or changed in Redis by bulk operations"""
+    identity_map = get_identity_map()
+    if identity_map is not None:
+        for redis_key in redis_keys:
+            identity_map.discard(redis_key)
@@ -0,0 +1,520 @@
+import logging
+import uuid
+
+from .db_key import DB_key
+from ..redis_db import ENCODING
+
+logger = logging.getLogger("POPOTO.KeySource")
+
+TEMP_KEY_TTL = 10  # seconds. temp keys only outlive a query if it dies midway
+
+
+class TempKeys(list):
+    """
+    Disposable Redis keys holding partial query results.
+    All temp keys for a model share the prefix `$Query:<Model>:`
+    """
+
+    def __init__(self, model_class: "Model"):
+        super().__init__()
+        self.prefix = DB_key("$Query", model_class._meta.db_class_key)
+
+    def new(self) -> str:
+        temp_key = DB_key(self.prefix, uuid.uuid4().hex).redis_key
+        self.append(temp_key)
+        return temp_key
+
+    def expire(self, pipeline, ttl: int = TEMP_KEY_TTL):
+        for temp_key in self:
+            pipeline = pipeline.expire(temp_key, ttl)
+        return pipeline
+
+    def delete(self, pipeline):
+        if len(self):
+            pipeline = pipeline.delete(*self)
+        return pipeline
+
+
+class KeySource:
+    """
+    Describes where in Redis to find the db keys matching one filter.
+    Fields return KeySources from `get_filter_key_sources()`.
+    The Query stages each source as a Redis (sorted) set and combines them server-side,
+    so only the final list of db keys is sent back to the client.
+    """
+
+    sorted: bool = False  # the staged key is a sorted set
+    # upper bound of matching db keys, set by Query.plan_key_sources
+    estimate: int = None
+
+    def stage(self, pipeline, temp_keys: TempKeys) -> str:
+        """
+        queue any commands needed to collect the matching db keys in one Redis key
+        :return: the redis key of a set or sorted set
+        """
+        raise NotImplementedError
+
+    def is_empty(self) -> bool:
+        """True when the source is known to match nothing without asking Redis"""
+        return False
+
+    def stage_count(self, pipeline) -> bool:
+        """
+        queue one command replying with the number of matching db keys, without temp keys
+        :return: False if the source must be staged before it can be counted
+        """
+        return False
+
+    @property
+    def copies_members(self) -> bool:
+        """stage() copies every match into a temp key, at a cost proportional to its size"""
+        return True
+
+    def queue_estimate(self, pipeline) -> int:
+        """
+        queue commands replying with an upper bound of the number of matching db keys
+        :return: the number of commands queued
+        """
+        return 1 if self.stage_count(pipeline) else 0
+
+    def read_estimate(self, replies: list):
+        """:return: the estimate from the replies to queue_estimate(), or None if unknown"""
+        if not replies:
+            return None
+        return sum(int(reply or 0) for reply in replies)
+
+    def stage_intersection(
+        self, pipeline, temp_keys: TempKeys, staged_key: tuple
+    ) -> tuple:
+        """
+        queue commands to intersect an already staged (redis_key, is_sorted) with this source
+        :return: (redis_key, is_sorted) of the result
+        """
+        key = self.stage(pipeline, temp_keys)
+        result_key = temp_keys.new()
+        if staged_key[1] or self.sorted:
+            pipeline.zinterstore(result_key, [staged_key[0], key])
+            return result_key, True
+        pipeline.sinterstore(result_key, [staged_key[0], key])
+        return result_key, False
+
+    def to_script_args(self) -> list:
+        """describe the source for the query Lua script. see scripts.QUERY_LUA"""
+        raise NotImplementedError
+
+    def describe(self) -> str:
+        """the index read by this source, for QuerySet.explain()"""
+        return self.__class__.__name__
+
+    def walk(self):
+        """yield this source and any sources it combines"""
+        yield self
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.__dict__}>"
+
+
+class IndexSet(KeySource):
+    """an existing Redis set, eg. the KeyField set for one value"""
+
+    def __init__(self, redis_key: str):
+        self.redis_key = redis_key
+
+    copies_members = False
+
+    def stage(self, pipeline, temp_keys: TempKeys) -> str:
+        return self.redis_key
+
+    def stage_count(self, pipeline) -> bool:
+        pipeline.scard(self.redis_key)
+        return True
+
+    def to_script_args(self) -> list:
+        return ["set", self.redis_key]
+
+    def describe(self) -> str:
+        return f"set {self.redis_key}"
+
+
+class SetUnion(KeySource):
+    """members of any of the given Redis sets. Staged with SUNIONSTORE"""
+
+    def __init__(self, redis_keys: list):
+        self.redis_keys = list(redis_keys)
+
+    def stage(self, pipeline, temp_keys: TempKeys) -> str:
+        if len(self.redis_keys) == 1:
+            return self.redis_keys[0]
+        temp_key = temp_keys.new()
+        pipeline.sunionstore(temp_key, self.redis_keys)
+        return temp_key
+
+    def is_empty(self) -> bool:
+        return not len(self.redis_keys)
+
+    @property
+    def copies_members(self) -> bool:
+        return len(self.redis_keys) > 1
+
+    def queue_estimate(self, pipeline) -> int:
+        for redis_key in self.redis_keys:
+            pipeline.scard(redis_key)
+        return len(self.redis_keys)
+
+    def to_script_args(self) -> list:
+        if len(self.redis_keys) == 1:
+            return ["set", self.redis_keys[0]]
+        return ["union", *self.redis_keys]
+
+    def describe(self) -> str:
+        return f"union of {len(self.redis_keys)} sets {', '.join(self.redis_keys)}"
+
+
+class ScoreRange(KeySource):
+    """members of a sorted set within a score range. Staged with ZRANGESTORE"""
+
+    sorted = True
+
+    def __init__(self, redis_key: str, min="-inf", max="+inf"):
+        self.redis_key = redis_key
+        self.min, self.max = min, max
+
+    @property
+    def is_unbounded(self) -> bool:
+        return str(self.min) == "-inf" and str(self.max) == "+inf"
+
+    def stage(self, pipeline, temp_keys: TempKeys) -> str:
+        if self.is_unbounded:
+            return self.redis_key
+        temp_key = temp_keys.new()
+        pipeline.zrangestore(temp_key, self.redis_key, self.min, self.max, byscore=True)
+        return temp_key
+
+    @property
+    def copies_members(self) -> bool:
+        return not self.is_unbounded
+
+    def stage_count(self, pipeline) -> bool:
+        pipeline.zcount(self.redis_key, self.min, self.max)
+        return True
+
+    def stage_intersection(
+        self, pipeline, temp_keys: TempKeys, staged_key: tuple
+    ) -> tuple:
+        if self.is_unbounded:
+            return super().stage_intersection(pipeline, temp_keys, staged_key)
+        # score the (smaller) staged members by this sorted set, then keep the range.
+        # costs the size of staged_key, never the size of the range
+        scored_key, result_key = temp_keys.new(), temp_keys.new()
+        pipeline.zinterstore(scored_key, {staged_key[0]: 0, self.redis_key: 1})
+        pipeline.zrangestore(result_key, scored_key, self.min, self.max, byscore=True)
+        return result_key, True
+
+    def to_script_args(self) -> list:
+        return ["range", self.redis_key, str(self.min), str(self.max)]
+
+    def describe(self) -> str:
+        return f"sorted set {self.redis_key} [{self.min}, {self.max}]"
+
+
+class ScoreRangeUnion(KeySource):
+    """
+    members of disjoint sorted sets within one score range, eg. several partitions of a SortedField.
+    Each range is staged like a ScoreRange, then merged with ZUNIONSTORE.
+    Members are only in one of the sorted sets, so they keep their scores
+    """
+
+    sorted = True
+
+    def __init__(self, redis_keys: list, min="-inf", max="+inf"):
+        self.score_ranges = [
+            ScoreRange(redis_key, min, max) for redis_key in redis_keys
+        ]
+        self.min, self.max = min, max
+
+    def stage(self, pipeline, temp_keys: TempKeys) -> str:
+        keys = [
+            score_range.stage(pipeline, temp_keys) for score_range in self.score_ranges
+        ]
+        if len(keys) == 1:
+            return keys[0]
+        temp_key = temp_keys.new()
+        pipeline.zunionstore(temp_key, keys)
+        return temp_key
+
+    def is_empty(self) -> bool:
+        return not len(self.score_ranges)
+
+    @property
+    def copies_members(self) -> bool:
+        return len(self.score_ranges) > 1 or self.score_ranges[0].copies_members
+
+    def queue_estimate(self, pipeline) -> int:
+        for score_range in self.score_ranges:
+            score_range.stage_count(pipeline)
+        return len(self.score_ranges)
+
+    def to_script_args(self) -> list:
+        if len(self.score_ranges) == 1:
+            return self.score_ranges[0].to_script_args()
+        return [
+            "ranges",
+            str(self.min),
+            str(self.max),
+            *[score_range.redis_key for score_range in self.score_ranges],
+        ]
+
+    def describe(self) -> str:
+        return (
+            f"union of {len(self.score_ranges)} sorted sets "
+            f"{', '.join(score_range.redis_key for score_range in self.score_ranges)} "
+            f"[{self.min}, {self.max}]"
+        )
+
+
+class GeoRadius(KeySource):
+    """members of a geo set within a radius. Staged with GEORADIUS ... STORE"""
+
+    sorted = True
+
+    def __init__(
+        self,
+        redis_key: str,
+        radius,
+        unit: str,
+        longitude: float = None,
+        latitude: float = None,
+        member: str = None,
+    ):
+        self.redis_key = redis_key
+        self.radius, self.unit = radius, unit
+        self.longitude, self.latitude = longitude, latitude
+        self.member = member
+
+    def queue_estimate(self, pipeline) -> int:
+        pipeline.zcard(self.redis_key)  # everything in the geo set
+        return 1
+
+    def stage(self, pipeline, temp_keys: TempKeys) -> str:
+        temp_key = temp_keys.new()
+        if self.member:
+            pipeline.georadiusbymember(
+                self.redis_key,
+                self.member,
+                self.radius,
+                unit=self.unit,
+                store=temp_key,
+            )
+        else:
+            pipeline.georadius(
+                self.redis_key,
+                self.longitude,
+                self.latitude,
+                self.radius,
+                unit=self.unit,
+                store=temp_key,
+            )
+        return temp_key
+
+    def to_script_args(self) -> list:
+        return [
+            "geo",
+            self.redis_key,
+            str(self.radius),
+            self.unit,
+            str(self.longitude),
+            str(self.latitude),
+            self.member or "",
+        ]
+
+    def describe(self) -> str:
+        return f"geo set {self.redis_key} within {self.radius}{self.unit}"
+
+
+class KeyList(KeySource):
+    """
+    db keys already known to the client.
+    Used for filters which Redis cannot resolve on its own, eg. KEYS pattern matches
+    """
+
+    def __init__(self, db_keys):
+        self.db_keys = set(db_keys)
+
+    def stage(self, pipeline, temp_keys: TempKeys) -> str:
+        temp_key = temp_keys.new()
+        pipeline.sadd(temp_key, *self.db_keys)
+        return temp_key
+
+    def is_empty(self) -> bool:
+        return not len(self.db_keys)
+
+    def read_estimate(self, replies: list):
+        return len(self.db_keys)
+
+    def to_script_args(self) -> list:
+        # msgpack packs bytes as bin, which cmsgpack cannot unpack
+        return [
+            "keys",
+            *(
+                db_key.decode(ENCODING) if isinstance(db_key, bytes) else db_key
+                for db_key in self.db_keys
+            ),
+        ]
+
+    def describe(self) -> str:
+        return f"{len(self.db_keys)} db keys resolved on the client, eg. by a KEYS scan"
+
+
+class Combination(KeySource):
+    """a combination of other key sources, eg. from Q objects"""
+
+    operator: str = None
+
+    def __init__(self, key_sources: list):
+        self.key_sources = list(key_sources)
+        self._estimate_reply_counts = []
+
+    @property
+    def sorted(self) -> bool:
+        return any(key_source.sorted for key_source in self.key_sources)
+
+    def queue_estimate(self, pipeline) -> int:
+        self._estimate_reply_counts = [
+            key_source.queue_estimate(pipeline) for key_source in self.key_sources
+        ]
+        return sum(self._estimate_reply_counts)
+
+    def read_estimates(self, replies: list) -> list:
+        """:return: the estimate of each combined key source"""
+        estimates, reply_index = [], 0
+        for key_source, reply_count in zip(
+            self.key_sources, self._estimate_reply_counts
+        ):
+            estimates.append(
+                key_source.read_estimate(
+                    replies[reply_index : reply_index + reply_count]
+                )
+            )
+            reply_index += reply_count
+        return estimates
+
+    def describe(self) -> str:
+        if len(self.key_sources) == 1:
+            return self.key_sources[0].describe()
+        return f"{self.operator}({', '.join(key_source.describe() for key_source in self.key_sources)})"
+
+    def walk(self):
+        yield self
+        for key_source in self.key_sources:
+            yield from key_source.walk()
+
+    def stage_all(self, pipeline, temp_keys: TempKeys) -> list:
+        return [
+            key_source.stage(pipeline, temp_keys)
+            for key_source in self.key_sources
+            if not key_source.is_empty()
+        ]
+
+
+class Intersection(Combination):
+    """members of all the given key sources. Staged with SINTERSTORE/ZINTERSTORE"""
+
+    operator = "AND"
+
+    def stage(self, pipeline, temp_keys: TempKeys) -> str:
+        keys = self.stage_all(pipeline, temp_keys)
+        if len(keys) == 1:
+            return keys[0]
+        temp_key = temp_keys.new()
+        if self.sorted:
+            pipeline.zinterstore(temp_key, keys)
+        else:
+            pipeline.sinterstore(temp_key, keys)
+        return temp_key
+
+    def is_empty(self) -> bool:
+        return any(key_source.is_empty() for key_source in self.key_sources)
+
+    def read_estimate(self, replies: list):
+        estimates = [
+            estimate
+            for estimate in self.read_estimates(replies)
+            if estimate is not None
+        ]
+        return min(estimates) if estimates else None
+
+    def to_script_args(self) -> list:
+        if len(self.key_sources) == 1:
+            return self.key_sources[0].to_script_args()
+        return [
+            "and",
+            *[key_source.to_script_args() for key_source in self.key_sources],
+        ]
+
+
+class Union(Combination):
+    """members of any of the given key sources. Staged with SUNIONSTORE/ZUNIONSTORE"""
+
+    operator = "OR"
+
+    def stage(self, pipeline, temp_keys: TempKeys) -> str:
+        keys = self.stage_all(pipeline, temp_keys)
+        if len(keys) == 1:
+            return keys[0]
+        temp_key = temp_keys.new()
+        if self.sorted:
+            pipeline.zunionstore(temp_key, keys)
+        else:
+            pipeline.sunionstore(temp_key, keys)
+        return temp_key
+
+    def is_empty(self) -> bool:
+        return all(key_source.is_empty() for key_source in self.key_sources)
+
+    def read_estimate(self, replies: list):
+        estimates = self.read_estimates(replies)
+        return None if None in estimates else sum(estimates)
+
+    def to_script_args(self) -> list:
+        args = [
+            key_source.to_script_args()
+            for key_source in self.key_sources
+            if not key_source.is_empty()
+        ]
+        return args[0] if len(args) == 1 else ["or", *args]
+
+
+class Difference(Combination):
+    """
+    members of a key source, except those of another. Staged with SDIFFSTORE/ZDIFFSTORE
+    negations are the difference of the model's class set and the negated key source
+    """
+
+    operator = "NOT"
+
+    def __init__(self, key_source: KeySource, excluded: KeySource):
+        super().__init__([key_source, excluded])
+
+    def stage(self, pipeline, temp_keys: TempKeys) -> str:
+        key_source, excluded = self.key_sources
+        if excluded.is_empty():
+            return key_source.stage(pipeline, temp_keys)
+        keys = self.stage_all(pipeline, temp_keys)
+        temp_key = temp_keys.new()
+        if self.sorted:
+            pipeline.zdiffstore(temp_key, keys)
+        else:
+            pipeline.sdiffstore(temp_key, keys)
+        return temp_key
+
+    def is_empty(self) -> bool:
+        return self.key_sources[0].is_empty()
+
+    def read_estimate(self, replies: list):
+        return self.read_estimates(replies)[0]
+
+    def to_script_args(self) -> list:
+        key_source, excluded = self.key_sources
+        if excluded.is_empty():
+            return key_source.to_script_args()
+        return ["not", key_source.to_script_args(), excluded.to_script_args()]
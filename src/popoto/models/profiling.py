@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+import redis
+
+from .scripts import WRITE_SCRIPT
+from ..redis_db import ENCODING
+
+logger = logging.getLogger("POPOTO.profiling")
+slow_query_logger = logging.getLogger("POPOTO.SlowQuery")
+
+# the profiles recording in the current thread or asyncio task, outermost first
+_active_profiles = ContextVar("popoto_query_profiles", default=())
+_hooks_lock = threading.Lock()
+_hooks_installed = False
+
+
+def payload_size(value) -> int:
+    """bytes of a command argument or reply, without the protocol framing"""
+    if value is None:
+        return 0
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode(ENCODING))
+    if isinstance(value, dict):
+        return sum(payload_size(k) + payload_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sum(payload_size(item) for item in value)
+    return len(str(value))
+
+
+def describe_command(args: tuple) -> str:
+    """command name and first key, eg. 'SINTERSTORE $Query:Ticket:..'"""
+    name = args[0].decode(ENCODING) if isinstance(args[0], bytes) else str(args[0])
+    name = name.upper()
+    if name == "EVALSHA" and len(args) > 3:
+        return f"EVALSHA {str(args[1])[:8]} {args[3] if args[2] else ''}".rstrip()
+    if len(args) > 1:
+        first_arg = args[1].decode(ENCODING) if isinstance(args[1], bytes) else args[1]
+        return f"{name} {first_arg}"
+    return name
+
+
+def unpack_script_commands(args: tuple) -> list:
+    """the commands of WRITE_SCRIPT's flat ARGV, see ScriptPipeline"""
+    commands, i = [], 0
+    while i < len(args):
+        size = int(args[i])
+        commands.append(args[i + 1 : i + size + 1])
+        i += size + 1
+    return commands
+
+
+def install_profiling_hooks():
+    """
+    wrap the Redis client's command and pipeline execution, once per process.
+    commands are only recorded for the profiles active in the context sending them,
+    elsewhere the hooks cost a ContextVar lookup.
+    """
+    global _hooks_installed
+    with _hooks_lock:
+        if _hooks_installed:
+            return
+        execute_command = redis.Redis.execute_command
+        execute_pipeline = redis.client.Pipeline.execute
+
+        def profiled_execute_command(client, *args, **options):
+            profiles = _active_profiles.get()
+            if not profiles:
+                return execute_command(client, *args, **options)
+            start = time.perf_counter()
+            reply = execute_command(client, *args, **options)
+            duration = time.perf_counter() - start
+            if args[0] == "EVALSHA" and args[1] == WRITE_SCRIPT.sha:
+                commands = unpack_script_commands(args[3:])
+            else:
+                commands = [args]
+            for profile in profiles:
+                profile.record(commands, reply, duration)
+            return reply
+
+        def profiled_execute_pipeline(pipeline, *args, **kwargs):
+            profiles = _active_profiles.get()
+            if not profiles:
+                return execute_pipeline(pipeline, *args, **kwargs)
+            commands = [command_args for command_args, _ in pipeline.command_stack]
+            start = time.perf_counter()
+            replies = execute_pipeline(pipeline, *args, **kwargs)
+            duration = time.perf_counter() - start
+            if commands:
+                for profile in profiles:
+                    profile.record(commands, replies, duration)
+            return replies
+
+        redis.Redis.execute_command = profiled_execute_command
+        redis.client.Pipeline.execute = profiled_execute_pipeline
+        _hooks_installed = True
+
+
+class QueryProfile:
+    """
+    Records every Redis command sent inside the context:
+    the commands, round trips, payload bytes each way and time waiting on Redis.
+    Meant for diagnostics like QuerySet.explain(). Only commands sent by the same
+    thread or asyncio task are recorded. Nested profiles record to each of them.
+    The commands run by a ScriptPipeline are recorded in place of its EVALSHA.
+
+    with QueryProfile() as profile:
+        Model.query.filter(status="open").count()
+    profile.commands  # ['SCARD $KeyF:Model:status:open']
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.redis_time = 0.0
+        self._token = None
+
+    def record(self, commands: list, replies, duration: float):
+        self.commands += [describe_command(args) for args in commands]
+        self.round_trips += 1
+        self.bytes_sent += sum(payload_size(args) for args in commands)
+        self.bytes_received += payload_size(replies)
+        self.redis_time += duration
+
+    def __enter__(self) -> "QueryProfile":
+        install_profiling_hooks()
+        self._token = _active_profiles.set(_active_profiles.get() + (self,))
+        return self
+
+    def __exit__(self, *exc_info):
+        _active_profiles.reset(self._token)
+        self._token = None
+
+    def to_dict(self) -> dict:
+        return {
+            "commands": list(self.commands),
+            "round_trips": self.round_trips,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+        }
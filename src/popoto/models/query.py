@@ -1,10 +1,17 @@
 import logging
 
 from .db_key import DB_key
+from .identity_map import get_identity_map
+from .key_sources import TempKeys
+from .query_cache import QueryCache
+from .queryset import QuerySet
 from ..redis_db import POPOTO_REDIS_DB, ENCODING
 
 logger = logging.getLogger("POPOTO.Query")
 
+# reserved kwargs of filter(), not filter params
+QUERY_OPTION_NAMES = {"limit", "order_by", "values", "cache_ttl"}
+
 
 class QueryException(Exception):
     pass
@@ -21,6 +28,7 @@ class Query:
     def __init__(self, model_class: "Model"):
         self.model_class = model_class
         self.options = model_class._meta
+        self.cache = QueryCache(model_class)
 
     def get(self, db_key: DB_key = None, redis_key: str = None, **kwargs) -> "Model":
         if (
@@ -36,13 +44,18 @@ class Query:
         if redis_key:
             from ..models.encoding import decode_popoto_model_hashmap
 
+            identity_map = get_identity_map()
+            if identity_map is not None and redis_key in identity_map:
+                return identity_map.get(redis_key)
             hashmap = POPOTO_REDIS_DB.hgetall(redis_key)
             if not hashmap:
                 return None
-            instance = decode_popoto_model_hashmap(self.model_class, hashmap)
+            instance = decode_popoto_model_hashmap(
+                self.model_class, hashmap, redis_key=redis_key
+            )
 
         else:
-            instances = self.filter(**kwargs)
+            instances = self.filter(**kwargs)[:2]
             if len(instances) > 1:
                 raise QueryException(
                     f"{self.model_class.__name__} found more than one unique instance. Use `query.filter()`"
@@ -99,30 +112,32 @@ class Query:
                 )
             )
 
-    def all(self, **kwargs) -> list:
-        redis_db_keys_list = self.keys()
-        return self.prepare_results(
-            Query.get_many_objects(
-                self.model_class,
-                set(redis_db_keys_list),
-                values=kwargs.get("values", None),
-            ),
-            **kwargs,
-        )
+    def all(self, **kwargs) -> "QuerySet":
+        """
+        return a lazy QuerySet of all model_class objects
+        accepts order_by, limit, values
+        """
+        return QuerySet(self).filter(**kwargs)
 
-    def filter_for_keys_set(self, **kwargs) -> set:
-        db_keys_sets = []
-        yet_employed_kwargs_set = set(kwargs.keys()).difference(
-            {"limit", "order_by", "values"}
-        )
-        if not len(yet_employed_kwargs_set):
-            return set()
+    def iterator(self, chunk_size: int = 1000, **kwargs):
+        """
+        stream model_class objects, chunk_size at a time, without loading all keys
+        optionally filtered by kwargs
+        """
+        return self.filter(**kwargs).iterator(chunk_size=chunk_size)
 
-        # todo: use redis.SINTER for keyfield exact match filters
+    def get_filters_by_field(self, **kwargs) -> list:
+        """
+        assign each filter param to the field which can resolve it
+        :return: list[(field_name, query_params), ..]
+        """
+        filters_by_field = []
+        yet_employed_kwargs_set = set(kwargs.keys()).difference(QUERY_OPTION_NAMES)
+        if not len(yet_employed_kwargs_set):
+            return filters_by_field
 
         # do sorted_fields first - because they can obviate some keyfield filters
         for field_name in self.options.sorted_field_names:
-            field = self.options.fields[field_name]
             if not len(
                 yet_employed_kwargs_set
                 & self.options.filter_query_params_by_field[field_name]
@@ -138,14 +153,19 @@ class Query:
                     if k in kwargs
                 }
             )
-            db_keys_sets.append(
-                field.__class__.filter_query(self.model_class, field_name, **kwargs)
-            )
+            filters_by_field.append((field_name, kwargs))
             yet_employed_kwargs_set = yet_employed_kwargs_set.difference(
                 self.options.filter_query_params_by_field[field_name]
             ).difference(
-                set(field.sort_by)
-            )  # also remove the required sort_by field names
+                {
+                    partition_param
+                    for partition_field_name in self.options.fields[field_name].sort_by
+                    for partition_param in (
+                        partition_field_name,
+                        f"{partition_field_name}__in",
+                    )
+                }
+            )  # also remove the required sort_by field filters
 
         for field_name in self.options.filter_query_params_by_field:
             if field_name in self.options.sorted_field_names:
@@ -156,13 +176,11 @@ class Query:
             if not params_for_field:
                 continue  # this field cannot use any of the available filter params
 
-            field = self.options.fields[field_name]
             logger.debug(f"query on {field_name} with {params_for_field}")
             logger.debug({k: kwargs[k] for k in params_for_field})
-            key_set = field.__class__.filter_query(
-                self.model_class, field_name, **{k: kwargs[k] for k in params_for_field}
+            filters_by_field.append(
+                (field_name, {k: kwargs[k] for k in params_for_field})
             )
-            db_keys_sets.append(key_set)
             yet_employed_kwargs_set = yet_employed_kwargs_set.difference(
                 params_for_field
             )
@@ -172,34 +190,164 @@ class Query:
             raise QueryException(
                 f"Invalid filter parameters: {','.join(yet_employed_kwargs_set)}"
             )
+        return filters_by_field
 
-        logger.debug(db_keys_sets)
-        if not len(db_keys_sets):
+    def filter_for_keys_set(self, **kwargs) -> set:
+        filters_by_field = self.get_filters_by_field(**kwargs)
+        if not len(filters_by_field):
             return set()
-        # return intersection of all the db keys sets, effectively &&-ing all filters
-        return set.intersection(*db_keys_sets)
 
-    def filter(self, **kwargs) -> list:
+        if self.options.server_side_filters:
+            return self.filter_for_keys_set_in_redis(filters_by_field)
+
+        # intersect the db keys sets, effectively &&-ing all filters
+        # stop as soon as nothing can match
+        db_keys = None
+        for field_name, query_params in filters_by_field:
+            db_keys_set = self.options.fields[field_name].__class__.filter_query(
+                self.model_class, field_name, **query_params
+            )
+            db_keys = db_keys_set if db_keys is None else db_keys & db_keys_set
+            if not db_keys:
+                return set()
+        return db_keys
+
+    def get_key_sources(self, filters_by_field: list) -> list:
+        key_sources = []
+        for field_name, query_params in filters_by_field:
+            key_sources += self.options.fields[
+                field_name
+            ].__class__.get_filter_key_sources(
+                self.model_class, field_name, **query_params
+            )
+        return key_sources
+
+    @classmethod
+    def plan_key_sources(cls, key_sources: list) -> list:
         """
-        Access any and all filters for the fields on the model_class
-        Run query using the given paramters
-        return a list of model_class objects
+        order key_sources by estimated cardinality, most selective first.
+        estimates are read with SCARD/ZCOUNT in one pipeline, only when a source would copy
+        its members into a temp key, at a cost proportional to its size.
+        :return: key_sources in the order to intersect them, or [] if nothing can match
         """
-        db_keys_set = self.filter_for_keys_set(**kwargs)
-        if not len(db_keys_set):
+        if any(key_source.is_empty() for key_source in key_sources):
             return []
+        if len(key_sources) < 2 or not any(
+            key_source.copies_members for key_source in key_sources
+        ):
+            return key_sources  # SINTERSTORE/ZINTERSTORE order their inputs by size
+
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        reply_counts = [
+            key_source.queue_estimate(pipeline) for key_source in key_sources
+        ]
+        replies, reply_index = pipeline.execute(), 0
+        for key_source, reply_count in zip(key_sources, reply_counts):
+            key_source.estimate = key_source.read_estimate(
+                replies[reply_index : reply_index + reply_count]
+            )
+            reply_index += reply_count
+        logger.debug(
+            {repr(key_source): key_source.estimate for key_source in key_sources}
+        )
 
-        return self.prepare_results(
-            Query.get_many_objects(
-                self.model_class,
-                db_keys_set,
-                order_by_attr_name=kwargs.get("order_by", None),
-                limit=kwargs.get("limit", None),
-                values=kwargs.get("values", None),
-            ),
-            **kwargs,
+        if any(key_source.estimate == 0 for key_source in key_sources):
+            return []
+        return sorted(
+            key_sources,
+            key=lambda key_source: float("inf")
+            if key_source.estimate is None
+            else key_source.estimate,
         )
 
+    @classmethod
+    def stage_intersection(cls, pipeline, temp_keys: TempKeys, key_sources: list):
+        """
+        queue commands to intersect all key_sources inside Redis
+        planned key_sources (see plan_key_sources) are intersected one by one, smallest first,
+        so no source is copied in full when a smaller one already narrowed the results
+        :return: (redis_key, is_sorted) of the set or sorted set holding the result
+        """
+        if len(key_sources) > 1 and key_sources[0].estimate is not None:
+            staged_key = (
+                key_sources[0].stage(pipeline, temp_keys),
+                key_sources[0].sorted,
+            )
+            for key_source in key_sources[1:]:
+                staged_key = key_source.stage_intersection(
+                    pipeline, temp_keys, staged_key
+                )
+            return staged_key
+
+        staged_keys = [
+            (key_source.stage(pipeline, temp_keys), key_source.sorted)
+            for key_source in key_sources
+        ]
+        if len(staged_keys) == 1:
+            return staged_keys[0]
+
+        result_key = temp_keys.new()
+        if any(is_sorted for _, is_sorted in staged_keys):
+            # ZINTERSTORE accepts plain sets as well
+            pipeline.zinterstore(result_key, [key for key, _ in staged_keys])
+            return result_key, True
+        pipeline.sinterstore(result_key, [key for key, _ in staged_keys])
+        return result_key, False
+
+    @classmethod
+    def stage_difference(
+        cls, pipeline, temp_keys: TempKeys, staged_key: tuple, excluded_key: tuple
+    ):
+        """
+        queue commands to remove the members of excluded_key from staged_key inside Redis
+        :return: (redis_key, is_sorted) of the set or sorted set holding the result
+        """
+        result_key = temp_keys.new()
+        if staged_key[1] or excluded_key[1]:
+            # ZDIFFSTORE accepts plain sets as well
+            pipeline.zdiffstore(result_key, [staged_key[0], excluded_key[0]])
+            return result_key, True
+        pipeline.sdiffstore(result_key, [staged_key[0], excluded_key[0]])
+        return result_key, False
+
+    def filter_for_keys_set_in_redis(self, filters_by_field: list) -> set:
+        """
+        stage every filter as a temporary Redis key and intersect them server-side.
+        only the final db keys are transferred back to the client
+        """
+        key_sources = self.plan_key_sources(self.get_key_sources(filters_by_field))
+        logger.debug(key_sources)
+        if not key_sources:
+            return set()
+
+        temp_keys = TempKeys(self.model_class)
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        result_key, is_sorted = self.stage_intersection(
+            pipeline, temp_keys, key_sources
+        )
+        pipeline = temp_keys.expire(pipeline)
+        result_index = len(pipeline)
+        if is_sorted:
+            pipeline = pipeline.zrange(result_key, 0, -1)
+        else:
+            pipeline = pipeline.smembers(result_key)
+        pipeline = temp_keys.delete(pipeline)
+        return set(pipeline.execute()[result_index])
+
+    def filter(self, *q_objects, **kwargs) -> "QuerySet":
+        """
+        Access any and all filters for the fields on the model_class
+        Run query using the given paramters, and Q objects for OR and NOT
+        return a lazy QuerySet of model_class objects
+        """
+        return QuerySet(self).filter(*q_objects, **kwargs)
+
+    def exclude(self, *q_objects, **kwargs) -> "QuerySet":
+        """
+        return a lazy QuerySet of model_class objects NOT matching all filters
+        """
+        return QuerySet(self).exclude(*q_objects, **kwargs)
+
     def prepare_results(
         self,
         objects,
@@ -240,15 +388,23 @@ class Query:
 
         return objects
 
-    def count(self, **kwargs) -> int:
-        if not len(kwargs):
-            return int(
-                POPOTO_REDIS_DB.scard(self.model_class._meta.db_class_set_key.redis_key)
-                or 0
-            )
-        return len(
-            self.filter_for_keys_set(**kwargs)
-        )  # maybe possible to refactor to use redis.SINTERCARD
+    def count(self, *q_objects, **kwargs) -> int:
+        """
+        count objects matching all filters, inside Redis. See QuerySet.count()
+        """
+        return self.filter(*q_objects, **kwargs).count()
+
+    def explain(self, *q_objects, **kwargs) -> dict:
+        """
+        run a filter query and report its plan, commands and timings. See QuerySet.explain()
+        """
+        return self.filter(*q_objects, **kwargs).explain()
+
+    def aggregate(self, *aggregates, **named_aggregates) -> dict:
+        """
+        aggregate SortedField scores of all objects, inside Redis. See QuerySet.aggregate()
+        """
+        return QuerySet(self).aggregate(*aggregates, **named_aggregates)
 
     @classmethod
     def get_many_objects(
@@ -259,9 +415,6 @@ class Query:
         limit: int = None,
         values: tuple = None,
     ) -> list:
-        from .encoding import decode_popoto_model_hashmap
-
-        pipeline = POPOTO_REDIS_DB.pipeline()
         reverse_order = False
         # order the hashes list or objects before applying limit
         if order_by_attr_name and order_by_attr_name.startswith("-"):
@@ -294,17 +447,47 @@ class Query:
                     }
                     for db_key in db_keys
                 ]
-            else:
-                [pipeline.hmget(db_key, values) for db_key in db_keys]
-                value_lists = pipeline.execute()
-                hashes_list = [
-                    {field_name: result[i] for i, field_name in enumerate(values)}
-                    for result in value_lists
-                ]
 
-        else:
-            [pipeline.hgetall(db_key) for db_key in db_keys]
-            hashes_list = pipeline.execute()
+        db_keys = list(db_keys)
+        identity_map = get_identity_map()
+        if identity_map is not None and not values:
+            # read only the objects not loaded yet, they join the identity map
+            new_keys = [db_key for db_key in db_keys if db_key not in identity_map]
+            cls.decode_many_objects(
+                model, cls.get_many_hashes(new_keys), db_keys=new_keys
+            )
+            return [
+                identity_map.get(db_key) for db_key in db_keys if db_key in identity_map
+            ]
+        hashes_list = cls.get_many_hashes(db_keys, values=values)
+        return cls.decode_many_objects(
+            model, hashes_list, values=values, db_keys=db_keys
+        )
+
+    @classmethod
+    def get_many_hashes(cls, db_keys: list, values: tuple = None) -> list:
+        """
+        fetch the raw hashes of db_keys in one pipeline
+        :return: list of {field_name: encoded value} dicts, only the `values` fields if given
+        """
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        if values:
+            [pipeline.hmget(db_key, values) for db_key in db_keys]
+            return [
+                {field_name: result[i] for i, field_name in enumerate(values)}
+                for result in pipeline.execute()
+            ]
+        [pipeline.hgetall(db_key) for db_key in db_keys]
+        return pipeline.execute()
+
+    @classmethod
+    def decode_many_objects(
+        cls, model: "Model", hashes_list: list, values: tuple = None, db_keys=None
+    ) -> list:
+        """
+        :param db_keys: the keys hashes_list was read from, in the same order
+        """
+        from .encoding import decode_popoto_model_hashmap
 
         if {} in hashes_list:
             logger.error(
@@ -312,7 +495,11 @@ class Query:
             )
 
         return [
-            decode_popoto_model_hashmap(model, redis_hash, fields_only=bool(values))
-            for redis_hash in hashes_list
+            decode_popoto_model_hashmap(
+                model, redis_hash, fields_only=bool(values), redis_key=redis_key
+            )
+            for redis_hash, redis_key in zip(
+                hashes_list, db_keys or [None] * len(hashes_list)
+            )
             if redis_hash
         ]
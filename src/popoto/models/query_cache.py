@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from ..redis_db import POPOTO_REDIS_DB
+
+logger = logging.getLogger("POPOTO.QueryCache")
+
+QUERY_CACHE_MAX_ENTRIES = 1000  # per model
+
+
+class QueryCache:
+    """
+    In-process LRU cache of raw query results for one model.
+    Entries are stored with the model generation they were read at
+    and are only served while that generation is current and their ttl has not passed.
+    The generations of related models count too, as do objects expired by Redis.
+    Raw results are cached, not objects, so each hit decodes fresh instances.
+    """
+
+    def __init__(
+        self, model_class: "Model", max_entries: int = QUERY_CACHE_MAX_ENTRIES
+    ):
+        self.model_class = model_class
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # cache_key: (generation, expires_at, result)
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get_dependencies(self) -> list:
+        """the model, and the related models its query results can depend on"""
+        options = self.model_class._meta
+        dependencies = [self.model_class]
+        for model_class in [
+            *(options.fields[name].model for name in options.relationship_field_names),
+            *(related_set.model for related_set in options.related_sets.values()),
+        ]:
+            if model_class is not None and model_class not in dependencies:
+                dependencies.append(model_class)
+        return dependencies
+
+    def get_generation(self) -> tuple:
+        """
+        the current generations of the model and its related models, in one round trip.
+        any save() or delete() increments them.
+        :return: (generations, timestamp when the next object of these models expires)
+        """
+        dependencies = self.get_dependencies()
+        expiring = [
+            model_class for model_class in dependencies if model_class._meta.expires
+        ]
+        pipeline = POPOTO_REDIS_DB.pipeline(transaction=False)
+        pipeline.mget(
+            [
+                model_class._meta.db_generation_key.redis_key
+                for model_class in dependencies
+            ]
+        )
+        now = time.time()
+        for model_class in expiring:
+            pipeline.zrangebyscore(
+                model_class._meta.db_expiry_key.redis_key,
+                now,
+                "+inf",
+                start=0,
+                num=1,
+                withscores=True,
+            )
+        generations, *next_expiries = pipeline.execute()
+        expiry_timestamps = [scored[0][1] for scored in next_expiries if scored]
+        return (
+            tuple(int(generation or 0) for generation in generations),
+            min(expiry_timestamps) if expiry_timestamps else None,
+        )
+
+    def get(self, cache_key: str, generation: tuple):
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry_generation, expires_at, result = entry
+            if entry_generation != generation or expires_at <= time.monotonic():
+                del self._entries[cache_key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return result
+
+    def set(self, cache_key: str, generation: tuple, result, ttl: float):
+        _, expires_at = generation
+        if expires_at is not None:  # served until an object it may include expires
+            ttl = min(ttl, expires_at - time.time())
+            if ttl <= 0:
+                return
+        with self._lock:
+            self._entries[cache_key] = (generation, time.monotonic() + ttl, result)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
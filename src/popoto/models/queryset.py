@@ -0,0 +1,1482 @@
+import base64
+import binascii
+import functools
+import logging
+import time
+
+import msgpack
+
+from .expressions import Q
+from .identity_map import discard_from_identity_map, get_identity_map
+from .key_sources import IndexSet, KeyList, ScoreRange, TempKeys
+from .profiling import QueryProfile, slow_query_logger
+from .scripts import (
+    queue_expiry_values_script,
+    queue_page_script,
+    queue_update_script,
+    run_query_script,
+)
+from ..redis_db import POPOTO_REDIS_DB, ENCODING, get_redis_version
+
+logger = logging.getLogger("POPOTO.QuerySet")
+
+ITERATOR_TEMP_KEY_TTL = 600  # seconds allowed between chunks of iterator()
+UPDATE_BATCH_SIZE = 1000  # objects updated per pipeline
+
+
+class Page(list):
+    """
+    one page of objects from QuerySet.paginate()
+    pass next_cursor as `after` to read the following page. It is None on the last page
+    """
+
+    def __init__(self, objects: list, next_cursor: str = None):
+        super().__init__(objects)
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+
+def encode_cursor(order_by: str, score: bytes, member: bytes) -> str:
+    return base64.urlsafe_b64encode(msgpack.packb([order_by, score, member])).decode()
+
+
+def decode_cursor(order_by: str, cursor: str) -> tuple:
+    """:return: (score, member) of the last member of the previous page"""
+    from .query import QueryException
+
+    try:
+        cursor_order_by, score, member = msgpack.unpackb(
+            base64.urlsafe_b64decode(cursor)
+        )
+    except (binascii.Error, ValueError, TypeError, msgpack.UnpackException):
+        raise QueryException(f"invalid pagination cursor {cursor}")
+    if cursor_order_by != order_by:
+        raise QueryException(
+            f"the cursor orders by {cursor_order_by}, not by {order_by}"
+        )
+    return score, member
+
+
+def logs_slow_queries(describe_result):
+    """
+    log calls taking Meta.slow_query_threshold or longer to POPOTO.SlowQuery
+    :param describe_result: the logged outcome of a result, eg. "counted 5"
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def timed_method(self, *args, **kwargs):
+            start = time.perf_counter()
+            result = method(self, *args, **kwargs)
+            self._log_if_slow(
+                method.__name__, time.perf_counter() - start, describe_result, result
+            )
+            return result
+
+        return timed_method
+
+    return decorator
+
+
+class QuerySet:
+    """
+    A lazy, chainable set of query results.
+    Redis is not touched until the QuerySet is evaluated by
+    iterating, indexing, len(), count() or exists().
+    Slices are pushed down into Redis, so only the sliced objects are fetched.
+
+    Model.query.filter(status="open").exclude(owner=bob).order_by("-created")[:50]
+    """
+
+    def __init__(self, query: "Query"):
+        self.query = query
+        self.model_class = query.model_class
+        self._filters = []  # filter kwargs dicts or Q objects, all AND'ed together
+        # filter kwargs dicts or Q objects, each removed from the results
+        self._excludes = []
+        self._order_by = None
+        self._values = None
+        self._select_related = ()  # Relationship field names, see select_related()
+        self._prefetch_related = ()  # related set names, see prefetch_related()
+        self._start, self._stop = 0, None
+        self._cache_ttl = None  # defaults to Meta.cache_ttl
+        self._result_cache = None
+
+    def _clone(self) -> "QuerySet":
+        clone = self.__class__(self.query)
+        clone._filters = list(self._filters)
+        clone._excludes = list(self._excludes)
+        clone._order_by = self._order_by
+        clone._values = self._values
+        clone._select_related = self._select_related
+        clone._prefetch_related = self._prefetch_related
+        clone._start, clone._stop = self._start, self._stop
+        clone._cache_ttl = self._cache_ttl
+        return clone
+
+    def _pop_options(self, kwargs: dict) -> dict:
+        """
+        apply the reserved query kwargs `order_by`, `values`, `limit`, `cache_ttl` to self
+        :return: the remaining filter kwargs
+        """
+        from .query import QueryException
+
+        if "order_by" in kwargs:
+            self._order_by = kwargs.pop("order_by")
+        if "values" in kwargs:
+            self._values = kwargs.pop("values")
+            if self._values is not None and not isinstance(self._values, tuple):
+                raise QueryException(
+                    "values takes a tuple. eg. query.filter(values=('name',))"
+                )
+        if "cache_ttl" in kwargs:
+            self._cache_ttl = kwargs.pop("cache_ttl")
+            if self._cache_ttl and self.query.options.cache_ttl is None:
+                raise QueryException(
+                    f"{self.model_class.__name__} does not count its writes to expire "
+                    f"cached results. Set Meta.cache_ttl, 0 to cache per query only"
+                )
+        limit = kwargs.pop("limit", None)
+        if limit is not None:
+            self._set_window(0, limit)
+        self.query.get_filters_by_field(**kwargs)  # raises on invalid filter params
+        return kwargs
+
+    def _set_window(self, start: int, stop: int = None):
+        """narrow the current slice window, relative to its start"""
+        new_start = self._start + start
+        new_stop = self._stop if stop is None else self._start + stop
+        if self._stop is not None and new_stop is not None:
+            new_stop = min(new_stop, self._stop)
+        self._start, self._stop = new_start, new_stop
+
+    def _check_q_objects(self, q_objects: tuple) -> list:
+        from .query import QueryException
+
+        for q_object in q_objects:
+            if not isinstance(q_object, Q):
+                raise QueryException(
+                    f"filter arguments must be Q objects, not {type(q_object)}"
+                )
+            q_object.check(self.query)
+        return list(q_objects)
+
+    def filter(self, *q_objects, **kwargs) -> "QuerySet":
+        clone = self._clone()
+        filter_kwargs = clone._pop_options(dict(kwargs))
+        clone._filters += clone._check_q_objects(q_objects)
+        if filter_kwargs:
+            clone._filters.append(filter_kwargs)
+        return clone
+
+    def exclude(self, *q_objects, **kwargs) -> "QuerySet":
+        clone = self._clone()
+        exclude_kwargs = clone._pop_options(dict(kwargs))
+        if q_objects:
+            # the objects matching all of them are excluded
+            q_objects = clone._check_q_objects(q_objects)
+            clone._excludes.append(Q(*q_objects, **exclude_kwargs))
+        elif exclude_kwargs:
+            clone._excludes.append(exclude_kwargs)
+        return clone
+
+    def order_by(self, field_name: str) -> "QuerySet":
+        clone = self._clone()
+        clone._order_by = field_name
+        return clone
+
+    def select_related(self, *field_names) -> "QuerySet":
+        """
+        read the related objects of these Relationship fields with the results,
+        all in one pipeline, instead of one read per object on first access
+
+        Price.query.filter(day=today).select_related("ticker")
+        """
+        from .query import QueryException
+
+        unknown_field_names = (
+            set(field_names) - self.model_class._meta.relationship_field_names
+        )
+        if unknown_field_names:
+            raise QueryException(
+                f"select_related() takes Relationship fields. "
+                f"{', '.join(sorted(unknown_field_names))} is not one"
+            )
+        clone = self._clone()
+        clone._select_related += tuple(
+            field_name
+            for field_name in field_names
+            if field_name not in clone._select_related
+        )
+        return clone
+
+    def prefetch_related(self, *related_names) -> "QuerySet":
+        """
+        read the objects relating to each result with the results: one pipeline of
+        SMEMBERS of their relationship sets, then one of HGETALL, per related name.
+        They are kept as the results of each object's related set
+
+        Ticker.query.filter(exchange="NYSE").prefetch_related("prices")
+        """
+        from .query import QueryException
+
+        unknown_names = set(related_names) - self.model_class._meta.related_sets.keys()
+        if unknown_names:
+            raise QueryException(
+                f"prefetch_related() takes the related names of Relationships "
+                f"to {self.model_class.__name__}. "
+                f"{', '.join(sorted(unknown_names))} is not one"
+            )
+        clone = self._clone()
+        clone._prefetch_related += tuple(
+            related_name
+            for related_name in related_names
+            if related_name not in clone._prefetch_related
+        )
+        return clone
+
+    def _load_related(self, objects: list) -> list:
+        """read the objects of select_related() and prefetch_related() for objects"""
+        if self._values or not objects:
+            return objects
+        if self._select_related:
+            self._select_related_objects(objects)
+        for related_name in self._prefetch_related:
+            self._prefetch_related_set(objects, related_name)
+        return objects
+
+    def _prefetch_related_set(self, objects: list, related_name: str):
+        related_set = self.model_class._meta.related_sets[related_name]
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        for instance in objects:
+            pipeline.smembers(related_set.get_set_redis_key(instance))
+        redis_keys_lists = [
+            sorted(redis_key.decode(ENCODING) for redis_key in redis_keys)
+            for redis_keys in pipeline.execute()
+        ]
+        related_instances = {
+            related_instance._redis_key: related_instance
+            for related_instance in self.query.get_many_objects(
+                related_set.model,
+                list({key for redis_keys in redis_keys_lists for key in redis_keys}),
+            )
+        }
+        get_reference = related_set.model._meta.layout.getters[related_set.field_name]
+        for instance, redis_keys in zip(objects, redis_keys_lists):
+            related_objects = [
+                related_instances[redis_key]
+                for redis_key in redis_keys
+                if redis_key in related_instances
+            ]
+            for related_instance in related_objects:
+                if get_reference(related_instance) == instance._redis_key:
+                    # no need to read the instance again from its related objects
+                    setattr(related_instance, related_set.field_name, instance)
+            related_set.set_prefetched(instance, related_objects)
+
+    def _select_related_objects(self, objects: list):
+        """
+        set the related objects of the select_related() fields on objects,
+        reading those not loaded yet with one pipeline of HGETALL
+        """
+        from .encoding import decode_popoto_model_hashmap
+
+        options = self.model_class._meta
+        identity_map = get_identity_map()
+        related_models = {}  # redis key: related model, of the objects to read
+        for field_name in self._select_related:
+            get_reference = options.layout.getters[field_name]
+            for instance in objects:
+                reference = get_reference(instance)
+                if isinstance(reference, str) and (
+                    identity_map is None or reference not in identity_map
+                ):
+                    related_models[reference] = options.fields[field_name].model
+
+        redis_keys = list(related_models)
+        related_instances = {
+            redis_key: decode_popoto_model_hashmap(
+                related_models[redis_key], redis_hash, redis_key=redis_key
+            )
+            for redis_key, redis_hash in zip(
+                redis_keys, self.query.get_many_hashes(redis_keys)
+            )
+        }
+        for field_name in self._select_related:
+            get_reference = options.layout.getters[field_name]
+            for instance in objects:
+                reference = get_reference(instance)
+                if isinstance(reference, str):
+                    setattr(
+                        instance,
+                        field_name,
+                        related_instances[reference]
+                        if reference in related_instances
+                        else identity_map.get(reference),
+                    )
+
+    @property
+    def is_sliced(self) -> bool:
+        return bool(self._start) or self._stop is not None
+
+    def _get_key_sources(self, filters: list) -> list:
+        key_sources = []
+        for filter_kwargs in filters:
+            if isinstance(filter_kwargs, Q):
+                key_sources.append(filter_kwargs.get_key_source(self.query))
+                continue
+            key_sources += self.query.get_key_sources(
+                self.query.get_filters_by_field(**filter_kwargs)
+            )
+        return key_sources
+
+    def stage(self, pipeline, temp_keys: TempKeys):
+        """
+        queue commands leaving every matching db key in one Redis key
+        :return: (redis_key, is_sorted), or None if nothing can match
+        """
+        key_sources = self.query.plan_key_sources(
+            self._get_key_sources(self._filters)
+            or [IndexSet(self.model_class._meta.db_class_set_key.redis_key)]
+        )
+        if not key_sources:
+            return None
+        staged_key = self.query.stage_intersection(pipeline, temp_keys, key_sources)
+
+        for exclude_kwargs in self._excludes:
+            exclude_sources = self.query.plan_key_sources(
+                self._get_key_sources([exclude_kwargs])
+            )
+            if not exclude_sources:
+                continue  # excludes nothing
+            staged_key = self.query.stage_difference(
+                pipeline,
+                temp_keys,
+                staged_key,
+                self.query.stage_intersection(pipeline, temp_keys, exclude_sources),
+            )
+        return staged_key
+
+    def _filter_for_keys_set_on_client(self, filter_kwargs) -> set:
+        if isinstance(filter_kwargs, Q):
+            return filter_kwargs.get_db_keys_set(self.query)
+        return self.query.filter_for_keys_set(**filter_kwargs)
+
+    def _get_db_keys_set_on_client(self) -> set:
+        if self._filters:
+            db_keys = set.intersection(
+                *[
+                    self._filter_for_keys_set_on_client(filter_kwargs)
+                    for filter_kwargs in self._filters
+                ]
+            )
+        else:
+            db_keys = set(self.query.keys())
+        for exclude_kwargs in self._excludes:
+            db_keys -= self._filter_for_keys_set_on_client(exclude_kwargs)
+        return db_keys
+
+    def _get_db_keys(self, can_slice_in_redis: bool = True) -> tuple:
+        """
+        :return: (list of db keys, whether the slice window is already applied)
+        """
+        if self._stop is not None and self._stop <= self._start:
+            return [], True
+        if not self.query.options.server_side_filters:
+            return list(self._get_db_keys_set_on_client()), False
+
+        can_slice_in_redis = can_slice_in_redis and self.is_sliced
+        temp_keys = TempKeys(self.model_class)
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        staged_key = self.stage(pipeline, temp_keys)
+        if staged_key is None:
+            return [], True
+        result_key, is_sorted = staged_key
+        pipeline = temp_keys.expire(pipeline)
+
+        result_index = len(pipeline)
+        if not can_slice_in_redis:
+            if is_sorted:
+                pipeline = pipeline.zrange(result_key, 0, -1)
+            else:
+                pipeline = pipeline.smembers(result_key)
+        elif is_sorted:
+            pipeline = pipeline.zrange(
+                result_key, self._start, -1 if self._stop is None else self._stop - 1
+            )
+        else:
+            pipeline = pipeline.sort(
+                result_key,
+                start=self._start,
+                num=-1 if self._stop is None else self._stop - self._start,
+                by="nosort",
+            )
+        pipeline = temp_keys.delete(pipeline)
+        return list(pipeline.execute()[result_index]), can_slice_in_redis
+
+    def _get_order_by_sortedset_key(self):
+        """
+        :return: redis key of the sorted set to order results by, if order_by is a SortedField
+        and the filters provide a value for each of its sort_by partition fields
+        """
+        order_by_attr_name = (self._order_by or "").lstrip("-")
+        if order_by_attr_name not in self.model_class._meta.sorted_field_names:
+            return None
+        field = self.model_class._meta.fields[order_by_attr_name]
+        partition_values = self._get_partition_values(field)
+        if len(partition_values) < len(field.sort_by):
+            return None
+        return field.get_query_sortedset_db_key(
+            self.model_class, order_by_attr_name, **partition_values
+        ).redis_key
+
+    def _get_partition_values(self, field: "Field", include_in: bool = False) -> dict:
+        """
+        the filtered values of a SortedField's sort_by partition fields
+        :param include_in: also return `__in` filters, naming several partitions
+        """
+        partition_params = set(field.sort_by)
+        if include_in:
+            partition_params |= {f"{field_name}__in" for field_name in field.sort_by}
+        return {
+            query_param: query_value
+            for filter_kwargs in self._filters
+            if not isinstance(filter_kwargs, Q)
+            for query_param, query_value in filter_kwargs.items()
+            if query_param in partition_params
+        }
+
+    def _get_db_keys_by_score(self, sortedset_key: str) -> list:
+        """
+        order and slice the results by the scores of a SortedField inside Redis
+        so that only the sliced db keys are returned
+        """
+        reverse = self._order_by.startswith("-")
+        offset, num = (None, None) if not self.is_sliced else (self._start, -1)
+        if self._stop is not None:
+            num = self._stop - self._start
+
+        key_sources = self._get_key_sources(self._filters)
+        if not self._excludes and (
+            not key_sources
+            or (
+                len(key_sources) == 1
+                and isinstance(key_sources[0], ScoreRange)
+                and key_sources[0].redis_key == sortedset_key
+            )
+        ):
+            # a range on the order_by field itself needs no temp keys at all
+            score_range = key_sources[0] if key_sources else ScoreRange(sortedset_key)
+            return POPOTO_REDIS_DB.zrange(
+                sortedset_key,
+                score_range.max if reverse else score_range.min,
+                score_range.min if reverse else score_range.max,
+                desc=reverse,
+                byscore=True,
+                offset=offset,
+                num=num,
+            )
+
+        temp_keys = TempKeys(self.model_class)
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        staged_key = self.stage(pipeline, temp_keys)
+        if staged_key is None:
+            return []
+        result_key = staged_key[0]
+        if result_key != sortedset_key:
+            # intersect with weights, so results are scored by the order_by field only
+            result_key = temp_keys.new()
+            pipeline.zinterstore(result_key, {staged_key[0]: 0, sortedset_key: 1})
+        pipeline = temp_keys.expire(pipeline)
+        result_index = len(pipeline)
+        pipeline = pipeline.zrange(
+            result_key,
+            self._start,
+            -1 if self._stop is None else self._stop - 1,
+            desc=reverse,
+        )
+        pipeline = temp_keys.delete(pipeline)
+        return pipeline.execute()[result_index]
+
+    def compile_script_plan(self, order_by_sortedset_key: str = None) -> dict:
+        """
+        compile filters, excludes, ordering and slicing into a plan for the query Lua script
+        :return: plan dict, or None if nothing can match
+        """
+        key_sources = self._get_key_sources(self._filters)
+        if not key_sources and order_by_sortedset_key:
+            key_sources = [ScoreRange(order_by_sortedset_key)]
+        elif not key_sources:
+            key_sources = [IndexSet(self.model_class._meta.db_class_set_key.redis_key)]
+        if any(key_source.is_empty() for key_source in key_sources):
+            return None
+
+        exclude_sources_lists = [
+            self._get_key_sources([exclude_kwargs]) for exclude_kwargs in self._excludes
+        ]
+        # slicing is applied in Lua unless objects are ordered on the client
+        can_slice_in_redis = order_by_sortedset_key or not self._order_by
+        start, count = (self._start, -1) if can_slice_in_redis else (0, -1)
+        if can_slice_in_redis and self._stop is not None:
+            count = self._stop - self._start
+
+        return {
+            "filters": [key_source.to_script_args() for key_source in key_sources],
+            "excludes": [
+                [key_source.to_script_args() for key_source in exclude_sources]
+                for exclude_sources in exclude_sources_lists
+                if not any(key_source.is_empty() for key_source in exclude_sources)
+            ],
+            "order_key": order_by_sortedset_key or "",
+            "rev": 1 if (self._order_by or "").startswith("-") else 0,
+            "start": start,
+            "count": count,
+            "values": list(self._values or ()),
+            "temp_prefix": TempKeys(self.model_class).new(),
+        }
+
+    def _fetch_rows_with_script(self, order_by_sortedset_key: str = None) -> tuple:
+        """fetch all results in a single round trip, see scripts.QUERY_LUA"""
+        plan = self.compile_script_plan(order_by_sortedset_key)
+        if plan is None or (self._stop is not None and self._stop <= self._start):
+            return [], [], False, True, True
+        db_keys, hashes = run_query_script(plan)
+        if self._values:
+            hashes_list = [
+                {field_name: result[i] for i, field_name in enumerate(self._values)}
+                for result in hashes
+            ]
+        else:
+            hashes_list = [
+                dict(zip(flat_hash[::2], flat_hash[1::2])) for flat_hash in hashes
+            ]
+        is_ordered_and_sliced = bool(order_by_sortedset_key) or not self._order_by
+        return (
+            db_keys,
+            hashes_list,
+            False,
+            bool(order_by_sortedset_key),
+            is_ordered_and_sliced,
+        )
+
+    def _can_use_script(self) -> bool:
+        options = self.model_class._meta
+        if not (options.lua_queries and options.server_side_filters):
+            return False
+        if (self._order_by or "").lstrip("-") in options.key_field_names:
+            return False  # ordered by sorting keys before fetching
+        if self._values and set(self._values).issubset(options.key_field_names):
+            return False  # values are read from the keys alone
+        return True
+
+    def _fetch_rows_by_keys(self, db_keys: list) -> tuple:
+        """:return: (db_keys, rows, is_decoded)"""
+        if self._values and set(self._values).issubset(
+            self.model_class._meta.key_field_names
+        ):
+            # values are read from the keys alone
+            return (
+                db_keys,
+                self.query.get_many_objects(
+                    self.model_class, db_keys, values=self._values
+                ),
+                True,
+            )
+        return db_keys, self.query.get_many_hashes(db_keys, values=self._values), False
+
+    def _fetch_rows(self) -> tuple:
+        """
+        read the results from Redis, without decoding them
+        :return: (db_keys, rows, is_decoded, is_ordered, is_sliced)
+            rows are the raw hashes of db_keys, or dicts of decoded values if is_decoded
+        """
+        order_by_sortedset_key = self._get_order_by_sortedset_key()
+        if self._can_use_script():
+            return self._fetch_rows_with_script(order_by_sortedset_key)
+
+        if order_by_sortedset_key and self.query.options.server_side_filters:
+            if self._stop is not None and self._stop <= self._start:
+                db_keys = []
+            else:
+                db_keys = self._get_db_keys_by_score(order_by_sortedset_key)
+            return self._fetch_rows_by_keys(db_keys) + (True, True)
+
+        order_by_attr_name = (self._order_by or "").lstrip("-")
+        key_field_names = self.model_class._meta.key_field_names
+        # ordering on a non-key field requires all objects to be decoded first
+        needs_all_objects = bool(order_by_attr_name) and (
+            order_by_attr_name not in key_field_names
+        )
+        db_keys, is_sliced = self._get_db_keys(
+            can_slice_in_redis=not order_by_attr_name
+        )
+
+        if order_by_attr_name in key_field_names:
+            field_position = self.model_class._meta.get_db_key_index_position(
+                order_by_attr_name
+            )
+            db_keys.sort(
+                key=lambda key: key.split(b":")[field_position],
+                reverse=self._order_by.startswith("-"),
+            )
+        if not is_sliced and not needs_all_objects:
+            db_keys, is_sliced = db_keys[self._start : self._stop], True
+
+        return self._fetch_rows_by_keys(db_keys) + (False, is_sliced)
+
+    def _rows_to_objects(
+        self,
+        db_keys: list,
+        rows: list,
+        is_decoded: bool,
+        is_ordered: bool,
+        is_sliced: bool,
+    ) -> list:
+        if is_decoded:
+            objects = [dict(row) for row in rows]
+        else:
+            objects = self.query.decode_many_objects(
+                self.model_class, rows, values=self._values, db_keys=db_keys
+            )
+        if self._order_by and not is_ordered:
+            objects = self.query.prepare_results(
+                objects, order_by=self._order_by, values=self._values
+            )
+        if not is_sliced:
+            objects = objects[self._start : self._stop]
+        return self._load_related(objects)
+
+    def _get_cache_key(self) -> str:
+        """normalized description of the query, independent of kwargs order"""
+
+        def normalize(filter_kwargs):
+            if isinstance(filter_kwargs, Q):
+                return filter_kwargs  # repr is independent of kwargs order
+            return sorted(filter_kwargs.items())
+
+        return repr(
+            (
+                [normalize(filter_kwargs) for filter_kwargs in self._filters],
+                [normalize(exclude_kwargs) for exclude_kwargs in self._excludes],
+                self._order_by,
+                self._values,
+                self._start,
+                self._stop,
+            )
+        )
+
+    def _fetch_all(self) -> list:
+        if self._result_cache is not None:
+            return self._result_cache
+
+        start = time.perf_counter()
+        cache_ttl = self._cache_ttl
+        if cache_ttl is None:
+            cache_ttl = self.query.options.cache_ttl
+        if cache_ttl:
+            cache = self.query.cache
+            cache_key = self._get_cache_key()
+            # read the generation first, so a save() during the query leaves the entry stale
+            generation = cache.get_generation()
+            fetched = cache.get(cache_key, generation)
+            if fetched is None:
+                fetched = self._fetch_rows()
+                cache.set(cache_key, generation, fetched, ttl=cache_ttl)
+        else:
+            fetched = self._fetch_rows()
+
+        self._result_cache = self._rows_to_objects(*fetched)
+
+        self._log_if_slow(
+            "query",
+            time.perf_counter() - start,
+            lambda objects: f"returned {len(objects)} rows",
+            self._result_cache,
+        )
+        return self._result_cache
+
+    def _log_if_slow(self, operation: str, duration: float, describe_result, result):
+        slow_query_threshold = self.query.options.slow_query_threshold
+        if slow_query_threshold is not None and duration >= slow_query_threshold:
+            slow_query_logger.warning(
+                f"{duration * 1000:.1f}ms {self.model_class.__name__} {operation} "
+                f"{self._get_cache_key()} {describe_result(result)}"
+            )
+
+    def _get_explained_predicates(self, filters: list) -> list:
+        """:return: list of (filter description, KeySource) for each predicate"""
+        predicates = []
+        for filter_kwargs in filters:
+            if isinstance(filter_kwargs, Q):
+                predicates.append(
+                    (repr(filter_kwargs), filter_kwargs.get_key_source(self.query))
+                )
+                continue
+            for field_name, query_params in self.query.get_filters_by_field(
+                **filter_kwargs
+            ):
+                field_params = {
+                    query_param: query_value
+                    for query_param, query_value in query_params.items()
+                    if query_param
+                    in self.query.options.filter_query_params_by_field[field_name]
+                }
+                predicates += [
+                    (f"{field_name} {field_params}", key_source)
+                    for key_source in self.query.get_key_sources(
+                        [(field_name, query_params)]
+                    )
+                ]
+        return predicates
+
+    @classmethod
+    def _count_key_source(cls, key_source, temp_keys: TempKeys) -> int:
+        """the actual number of db keys matching one key source"""
+        if key_source.is_empty():
+            return 0
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        if not key_source.stage_count(pipeline):
+            staged_key = key_source.stage(pipeline, temp_keys)
+            pipeline = temp_keys.expire(pipeline)
+            if key_source.sorted:
+                pipeline.zcard(staged_key)
+            else:
+                pipeline.scard(staged_key)
+        result_index = len(pipeline) - 1
+        pipeline = temp_keys.delete(pipeline)
+        return int(pipeline.execute()[result_index] or 0)
+
+    def explain(self) -> dict:
+        """
+        run the query and report how it was resolved:
+        the index read by each predicate, with estimated and actual cardinalities,
+        the order of the intersection, the Redis commands sent, payload bytes each way,
+        and time spent waiting on Redis and decoding objects.
+        Each predicate is also counted on its own, so explain() sends extra commands.
+        :return: dict, see docs/query.md
+        """
+        options = self.query.options
+        predicates = self._get_explained_predicates(self._filters)
+        exclude_predicates = self._get_explained_predicates(self._excludes)
+        key_sources = [key_source for _, key_source in predicates]
+
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        reply_counts = [
+            key_source.queue_estimate(pipeline)
+            for key_source in key_sources + [ks for _, ks in exclude_predicates]
+        ]
+        replies, reply_index, estimates = pipeline.execute(), 0, []
+        for (_, key_source), reply_count in zip(
+            predicates + exclude_predicates, reply_counts
+        ):
+            estimates.append(
+                key_source.read_estimate(
+                    replies[reply_index : reply_index + reply_count]
+                )
+            )
+            reply_index += reply_count
+        temp_keys = TempKeys(self.model_class)
+        predicate_reports = [
+            {
+                "filter": ("exclude " if i >= len(predicates) else "") + description,
+                "index": key_source.describe(),
+                "estimated": estimate,
+                "actual": self._count_key_source(key_source, temp_keys),
+            }
+            for i, ((description, key_source), estimate) in enumerate(
+                zip(predicates + exclude_predicates, estimates)
+            )
+        ]
+        planned_sources = self.query.plan_key_sources(
+            key_sources or [IndexSet(options.db_class_set_key.redis_key)]
+        )
+
+        queryset = self._clone()
+        queryset._cache_ttl = 0  # measure the query itself, not the cache
+        with QueryProfile() as profile:
+            start = time.perf_counter()
+            fetched = queryset._fetch_rows()
+            fetched_at = time.perf_counter()
+            objects = queryset._rows_to_objects(*fetched)
+            decoded_at = time.perf_counter()
+
+        if queryset._can_use_script():
+            mode = "lua script"
+        elif options.server_side_filters:
+            mode = "server-side filters"
+        else:
+            mode = "client-side filters"
+        warnings = []
+        if any(command.startswith("KEYS") for command in profile.commands):
+            warnings.append("KEYS scan, the cost grows with the whole keyspace")
+        if any(
+            isinstance(combined_source, KeyList)
+            for key_source in key_sources
+            for combined_source in key_source.walk()
+        ):
+            warnings.append("some predicates are resolved on the client")
+        order_by_attr_name = (self._order_by or "").lstrip("-")
+        if (
+            order_by_attr_name
+            and not fetched[3]
+            and order_by_attr_name not in options.key_field_names
+        ):
+            warnings.append(f"every match is decoded to order by {order_by_attr_name}")
+
+        return {
+            "model": self.model_class.__name__,
+            "mode": mode,
+            "predicates": predicate_reports,
+            "plan": [key_source.describe() for key_source in planned_sources]
+            or ["nothing can match"],
+            "rows": len(objects),
+            **profile.to_dict(),
+            "timings": {
+                "redis": profile.redis_time,
+                "fetch": fetched_at - start,
+                "decode": decoded_at - fetched_at,
+                "total": decoded_at - start,
+            },
+            "warnings": warnings,
+        }
+
+    def _window_count(self, total: int) -> int:
+        count = max(total - self._start, 0)
+        if self._stop is not None:
+            count = min(count, max(self._stop - self._start, 0))
+        return count
+
+    @logs_slow_queries(lambda count: f"counted {count}")
+    def count(self) -> int:
+        """
+        count matching objects in Redis, without transferring any keys
+        - no filters or one KeyField value: SCARD
+        - one SortedField range: ZCOUNT
+        - combined KeyField filters: SINTERCARD on Redis 7+
+        - otherwise: ZCARD/SCARD of a temp key intersection
+        """
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if not self.query.options.server_side_filters:
+            return self._window_count(len(self._get_db_keys_set_on_client()))
+
+        key_sources = self._get_key_sources(self._filters) or [
+            IndexSet(self.model_class._meta.db_class_set_key.redis_key)
+        ]
+        if any(key_source.is_empty() for key_source in key_sources):
+            return 0
+
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        if (
+            not self._excludes
+            and len(key_sources) == 1
+            and key_sources[0].stage_count(pipeline)
+        ):
+            return self._window_count(int(pipeline.execute()[-1] or 0))
+
+        temp_keys = TempKeys(self.model_class)
+        if (
+            not self._excludes
+            and not any(key_source.sorted for key_source in key_sources)
+            and get_redis_version() >= (7, 0)
+        ):
+            staged_keys = [
+                key_source.stage(pipeline, temp_keys) for key_source in key_sources
+            ]
+            pipeline = temp_keys.expire(pipeline)
+            result_index = len(pipeline)
+            pipeline.sintercard(len(staged_keys), staged_keys, limit=self._stop or 0)
+        else:
+            staged_key = self.stage(pipeline, temp_keys)
+            if staged_key is None:
+                return 0
+            result_key, is_sorted = staged_key
+            pipeline = temp_keys.expire(pipeline)
+            result_index = len(pipeline)
+            if is_sorted:
+                pipeline = pipeline.zcard(result_key)
+            else:
+                pipeline = pipeline.scard(result_key)
+        pipeline = temp_keys.delete(pipeline)
+        return self._window_count(int(pipeline.execute()[result_index] or 0))
+
+    def exists(self) -> bool:
+        if self._result_cache is not None:
+            return bool(self._result_cache)
+        return self.count() > 0
+
+    def _stage_scores(self, pipeline, temp_keys: TempKeys, field_name: str):
+        """
+        queue commands leaving the matching members of a SortedField's sorted set in one key
+        :return: ScoreRange of the matching scores, or None if nothing can match
+        """
+        field = self.model_class._meta.fields[field_name]
+        # raises QueryException unless the filters name the partitions
+        sortedset_keys = [
+            sortedset_db_key.redis_key
+            for sortedset_db_key in field.get_query_sortedset_db_keys(
+                self.model_class,
+                field_name,
+                **self._get_partition_values(field, include_in=True),
+            )
+        ]
+        if len(sortedset_keys) == 1:
+            sortedset_key = sortedset_keys[0]
+        else:
+            sortedset_key = temp_keys.new()  # partitions are disjoint, scores are kept
+            pipeline.zunionstore(sortedset_key, sortedset_keys)
+
+        if not self.query.options.server_side_filters:
+            db_keys = KeyList(self._get_db_keys_set_on_client())
+            if db_keys.is_empty():
+                return None
+            staged_key = (db_keys.stage(pipeline, temp_keys), False)
+        else:
+            key_sources = self._get_key_sources(self._filters)
+            if not self._excludes and not key_sources:
+                return ScoreRange(sortedset_key)
+            if (
+                not self._excludes
+                and len(key_sources) == 1
+                and isinstance(key_sources[0], ScoreRange)
+                and key_sources[0].redis_key == sortedset_key
+            ):
+                return key_sources[0]  # a range on the aggregated field itself
+            staged_key = self.stage(pipeline, temp_keys)
+            if staged_key is None:
+                return None
+        if staged_key[0] == sortedset_key:
+            return ScoreRange(sortedset_key)
+        scored_key = temp_keys.new()
+        pipeline.zinterstore(scored_key, {staged_key[0]: 0, sortedset_key: 1})
+        return ScoreRange(scored_key)
+
+    @logs_slow_queries(lambda aggregates: f"returned {aggregates}")
+    def aggregate(self, *aggregates, **named_aggregates) -> dict:
+        """
+        compute aggregates over SortedField scores inside Redis, without reading any hashes.
+        Min and Max read one end of the sorted set, Sum and Avg sum the scores in Lua.
+        For a field with sort_by partitions, the filters must name the partition values.
+        All aggregates share a single round trip.
+
+        Model.query.filter(category="toys").aggregate(Min("price"), total=Sum("price"))
+        :return: dict of {alias: value}, eg. {"price__min": 1.5, "total": 99.0}
+            aliases default to "<field_name>__<aggregate>", or "count" for Count()
+        """
+        from .aggregates import Aggregate
+        from .query import QueryException
+
+        if self.is_sliced:
+            raise QueryException("aggregate() does not support slicing")
+        for aggregate in aggregates:
+            if not isinstance(aggregate, Aggregate):
+                raise QueryException(f"{aggregate} is not an aggregate, eg. Min()")
+            named_aggregates.setdefault(aggregate.default_alias, aggregate)
+        for aggregate in named_aggregates.values():
+            if not isinstance(aggregate, Aggregate):
+                raise QueryException(f"{aggregate} is not an aggregate, eg. Min()")
+            aggregate.check(self.model_class)
+
+        field_names = sorted(
+            {aggregate.field_name for aggregate in named_aggregates.values()} - {None}
+        )
+        if not field_names:
+            count = self.count()
+            return {alias: count for alias in named_aggregates}
+
+        temp_keys = TempKeys(self.model_class)
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        score_ranges = {
+            field_name: self._stage_scores(pipeline, temp_keys, field_name)
+            for field_name in field_names
+        }
+        if None in score_ranges.values():  # nothing matches
+            pipeline = temp_keys.delete(pipeline)
+            pipeline.execute()
+            return {
+                alias: 0 if aggregate.name == "count" else None
+                for alias, aggregate in named_aggregates.items()
+            }
+
+        pipeline = temp_keys.expire(pipeline)
+        reply_ranges = {}
+        for alias, aggregate in named_aggregates.items():
+            # Count() counts the scores of any aggregated field, SortedFields are never null
+            score_range = score_ranges[aggregate.field_name or field_names[0]]
+            start = len(pipeline)
+            reply_ranges[alias] = (
+                start,
+                start + aggregate.queue(pipeline, score_range),
+            )
+        pipeline = temp_keys.delete(pipeline)
+        replies = pipeline.execute()
+
+        fields = self.model_class._meta.fields
+        return {
+            alias: aggregate.read(
+                fields.get(aggregate.field_name), replies[slice(*reply_ranges[alias])]
+            )
+            for alias, aggregate in named_aggregates.items()
+        }
+
+    @logs_slow_queries(lambda page: f"returned {len(page)} rows")
+    def paginate(
+        self, order_by: str = None, after: str = None, page_size: int = 100
+    ) -> Page:
+        """
+        read one page of objects ordered by a SortedField, following the cursor `after`.
+        Each page starts right after the rank of the cursor's member, or from its score
+        if it was deleted, so it costs the same at page 1 as at page 10,000.
+
+        page = Post.query.filter(author=bob).paginate(order_by="-created", page_size=50)
+        page = Post.query.filter(author=bob).paginate(order_by="-created", after=page.next_cursor)
+        :param order_by: a SortedField name, prefixed with "-" for descending order
+        :param after: the next_cursor of the previous page, or None for the first page
+        :return: Page of objects (or values dicts), with a next_cursor
+        """
+        from .query import QueryException
+
+        order_by = order_by or self._order_by
+        field_name = (order_by or "").lstrip("-")
+        if field_name not in self.model_class._meta.sorted_field_names:
+            raise QueryException("paginate() needs order_by with a SortedField name")
+        if self.is_sliced:
+            raise QueryException("paginate() does not support slicing")
+        if page_size < 1:
+            raise QueryException("page_size must be positive")
+        cursor = decode_cursor(order_by, after) if after else ("", "")
+
+        temp_keys = TempKeys(self.model_class)
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        score_range = self._stage_scores(pipeline, temp_keys, field_name)
+        if score_range is None:
+            pipeline = temp_keys.delete(pipeline)
+            pipeline.execute()
+            return Page([])
+        pipeline = temp_keys.expire(pipeline)
+        result_index = len(pipeline)
+        # one extra member tells if there is a next page
+        queue_page_script(
+            pipeline,
+            score_range.redis_key,
+            score_range.min,
+            score_range.max,
+            reverse=order_by.startswith("-"),
+            count=page_size + 1,
+            after=cursor,
+        )
+        pipeline = temp_keys.delete(pipeline)
+        members_and_scores = pipeline.execute()[result_index]
+
+        db_keys = members_and_scores[: page_size * 2 : 2]
+        next_cursor = None
+        if len(members_and_scores) > page_size * 2:
+            next_cursor = encode_cursor(
+                order_by, members_and_scores[page_size * 2 - 1], db_keys[-1]
+            )
+        return Page(
+            self._rows_to_objects(*self._fetch_rows_by_keys(db_keys), True, True),
+            next_cursor,
+        )
+
+    def _prepare_update_values(self, values: dict) -> dict:
+        """validate, coerce and format values like Model.save() would"""
+        from ..fields.field import VALID_FIELD_TYPES
+        from .query import QueryException
+
+        fields = self.model_class._meta.fields
+        prepared_values = {}
+        for field_name, value in values.items():
+            if field_name not in fields:
+                raise QueryException(
+                    f"{field_name} is not a field on {self.model_class.__name__}"
+                )
+            field = fields[field_name]
+            if (
+                value is not None
+                and not isinstance(value, field.type)
+                and field.type in VALID_FIELD_TYPES
+            ):
+                try:
+                    value = field.type(value)
+                except (TypeError, ValueError) as e:
+                    raise QueryException(f"invalid value for {field_name}: {e}")
+            if not field.__class__.is_valid(field, value):
+                raise QueryException(f"invalid value for {field_name}: {value}")
+            prepared_values[field_name] = field.format_value_pre_save(value)
+        return prepared_values
+
+    def _get_indexed_field_names(self, field_names: set) -> set:
+        """fields with Redis indexes depending on any of field_names"""
+        return self.model_class._meta.get_indexed_field_names(field_names)
+
+    def _get_load_field_names(self, indexed_field_names: set) -> set:
+        """fields to read to compute the index entries of indexed_field_names"""
+        return self.model_class._meta.get_index_load_field_names(indexed_field_names)
+
+    def _load_index_values(
+        self, db_keys: list, field_names: list, load_related: bool = True
+    ) -> list:
+        """
+        read only the fields needed to compute index membership
+        :param load_related: read related objects, else rebuild them from their
+            redis keys, with only their key fields set
+        :return: list of (db_key, instance) for objects that still exist
+        """
+        from .encoding import decode_popoto_model_hashmap
+
+        field_names = list(field_names)
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        for db_key in db_keys:
+            pipeline.hmget(db_key, field_names)
+        attrs_list = []
+        for db_key, values in zip(db_keys, pipeline.execute()):
+            if all(value is None for value in values):
+                continue  # deleted since the keys were read
+            attrs_list.append(
+                (
+                    db_key,
+                    decode_popoto_model_hashmap(
+                        self.model_class,
+                        {
+                            field_name: value
+                            for field_name, value in zip(field_names, values)
+                            if value is not None
+                        },
+                        fields_only=True,
+                    ),
+                )
+            )
+
+        # replace related redis keys with instances, one pipeline per Relationship field
+        for field_name in self.model_class._meta.relationship_field_names & set(
+            field_names
+        ):
+            related_model = self.model_class._meta.fields[field_name].model
+            related_keys = list(
+                {attrs[field_name] for _, attrs in attrs_list if attrs.get(field_name)}
+            )
+            if load_related:
+                related_instances = {
+                    related_instance._redis_key: related_instance
+                    for related_instance in self.query.get_many_objects(
+                        related_model, related_keys
+                    )
+                }
+            else:
+                related_instances = {
+                    related_key: related_model._from_redis_key(related_key)
+                    for related_key in related_keys
+                }
+            for _, attrs in attrs_list:
+                if attrs.get(field_name):
+                    attrs[field_name] = related_instances.get(attrs[field_name])
+
+        return [
+            (db_key, self.model_class.from_redis(attrs, redis_key=db_key))
+            for db_key, attrs in attrs_list
+        ]
+
+    @logs_slow_queries(lambda count: f"updated {count} objects")
+    def update(self, **values) -> int:
+        """
+        set field values on every matching object, without loading whole objects.
+        only the given hash fields are written, and only the indexes depending on them
+        are adjusted. Updating a KeyField changes the object's db key, so those objects
+        are re-saved in full.
+        :return: the number of updated objects
+        """
+        from .encoding import encode_field_values
+        from .query import QueryException
+
+        if self.is_sliced:
+            raise QueryException("update() does not support slicing")
+        if not values:
+            return 0
+        values = self._prepare_update_values(values)
+        db_keys, _ = self._get_db_keys()
+
+        if set(values) & self.model_class._meta.key_field_names:
+            return self._update_by_saving(db_keys, values)
+
+        encoded_values = encode_field_values(self.model_class, values)
+        options = self.model_class._meta
+        expiry_values = {  # recorded for expiring objects, see Model.reap_expired()
+            field_name: encoded_values[field_name.encode(ENCODING)]
+            for field_name in options.layout.expiry_field_names
+            if field_name in values and options.expires
+        }
+        indexed_field_names = self._get_indexed_field_names(set(values))
+        load_field_names = self._get_load_field_names(indexed_field_names)
+
+        updated_count = 0
+        for i in range(0, len(db_keys), UPDATE_BATCH_SIZE):
+            chunk_db_keys = db_keys[i : i + UPDATE_BATCH_SIZE]
+            pipeline = POPOTO_REDIS_DB.pipeline()
+            if indexed_field_names:
+                loaded = self._load_index_values(
+                    chunk_db_keys, load_field_names, load_related=False
+                )
+                chunk_db_keys = [db_key for db_key, _ in loaded]
+                for db_key, instance in loaded:
+                    updated_instance = self.model_class.from_redis(
+                        {
+                            **{
+                                field_name: getattr(instance, field_name)
+                                for field_name in load_field_names
+                            },
+                            **values,
+                        },
+                        redis_key=db_key,
+                    )
+                    for field_name in indexed_field_names:
+                        field = self.model_class._meta.fields[field_name]
+                        pipeline = field.on_delete(
+                            model_instance=instance,
+                            field_name=field_name,
+                            field_value=getattr(instance, field_name),
+                            pipeline=pipeline,
+                        )
+                        pipeline = field.on_save(
+                            updated_instance,
+                            field_name=field_name,
+                            field_value=getattr(updated_instance, field_name),
+                            pipeline=pipeline,
+                        )
+                    if expiry_values:
+                        redis_key = (
+                            db_key.decode(ENCODING)
+                            if isinstance(db_key, bytes)
+                            else db_key
+                        )
+                        queue_expiry_values_script(
+                            pipeline,
+                            options.db_expiry_key.redis_key,
+                            options.db_expiry_values_key.redis_key,
+                            redis_key,
+                            {
+                                f"{field_name}:{redis_key}": value
+                                for field_name, value in expiry_values.items()
+                            },
+                        )
+            if not chunk_db_keys:
+                continue
+            result_index = len(pipeline)
+            queue_update_script(pipeline, chunk_db_keys, encoded_values)
+            self.model_class._queue_generation_increment(pipeline)
+            updated_count += pipeline.execute()[result_index]
+            discard_from_identity_map(chunk_db_keys)
+        return updated_count
+
+    def _update_by_saving(self, db_keys: list, values: dict) -> int:
+        """delete each object from its old db key and all old indexes, then save it anew"""
+        updated_count = 0
+        for i in range(0, len(db_keys), UPDATE_BATCH_SIZE):
+            pipeline = POPOTO_REDIS_DB.pipeline()
+            saved_db_keys = []  # objects mapped to the new keys would be stale
+            for instance in self.query.get_many_objects(
+                self.model_class, db_keys[i : i + UPDATE_BATCH_SIZE]
+            ):
+                pipeline = instance.delete(pipeline=pipeline)
+                instance._redis_key = None
+                for field_name, value in values.items():
+                    setattr(instance, field_name, value)
+                pipeline = instance.save(pipeline=pipeline)
+                updated_count += 1
+                saved_db_keys.append(instance._redis_key)
+            pipeline.execute()
+            discard_from_identity_map(saved_db_keys)
+        return updated_count
+
+    @logs_slow_queries(lambda count: f"deleted {count} objects")
+    def delete(self, batch_size: int = 5000) -> int:
+        """
+        delete every matching object and its index entries, batch_size objects per pipeline.
+        only the fields needed to find the index entries are read, never whole objects.
+        :return: the number of deleted objects
+        """
+        from ..fields.field import Field
+        from .query import QueryException
+
+        if self.is_sliced:
+            raise QueryException("delete() does not support slicing")
+        options = self.model_class._meta
+        indexed_field_names = {
+            field_name
+            for field_name, field in options.fields.items()
+            if field.__class__.on_delete.__func__ is not Field.on_delete.__func__
+        }
+        load_field_names = self._get_load_field_names(indexed_field_names)
+        db_keys, _ = self._get_db_keys()
+
+        deleted_count = 0
+        for i in range(0, len(db_keys), batch_size):
+            chunk_db_keys = db_keys[i : i + batch_size]
+            pipeline = POPOTO_REDIS_DB.pipeline()
+            for db_key, instance in self._load_index_values(
+                chunk_db_keys, load_field_names, load_related=False
+            ):
+                for field_name in indexed_field_names:
+                    pipeline = options.fields[field_name].on_delete(
+                        model_instance=instance,
+                        field_name=field_name,
+                        field_value=getattr(instance, field_name),
+                        pipeline=pipeline,
+                    )
+            pipeline.srem(options.db_class_set_key.redis_key, *chunk_db_keys)
+            self.model_class._queue_expiry_removal(pipeline, chunk_db_keys)
+            self.model_class._queue_generation_increment(pipeline)
+            result_index = len(pipeline)
+            pipeline.unlink(*chunk_db_keys)
+            deleted_count += pipeline.execute()[result_index]
+            discard_from_identity_map(chunk_db_keys)
+        self._result_cache = None
+        return deleted_count
+
+    def iterator(self, chunk_size: int = 1000):
+        """
+        yield matching objects chunk by chunk, to keep client memory bounded.
+        walks the results with SSCAN/ZSCAN and fetches chunk_size hashes at a time.
+        filtered results are staged in a temp key, which lives as long as the iteration.
+        like SSCAN, an object may be yielded twice if the set is resized during iteration.
+        """
+        # the time spent waiting on the caller between chunks is not counted
+        duration, count = 0.0, 0
+        objects = self._iterate_chunks(chunk_size)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    obj = next(objects)
+                except StopIteration:
+                    return
+                finally:
+                    duration += time.perf_counter() - start
+                count += 1
+                yield obj
+        finally:
+            objects.close()
+            self._log_if_slow(
+                "iterator", duration, lambda count: f"yielded {count} rows", count
+            )
+
+    def _iterate_chunks(self, chunk_size: int):
+        from .query import QueryException
+
+        if self._order_by or self.is_sliced:
+            raise QueryException("iterator() does not support order_by or slicing")
+
+        if not (self._filters or self._excludes):
+            yield from self._iterate_redis_key(
+                self.model_class._meta.db_class_set_key.redis_key, False, chunk_size
+            )
+            return
+
+        if not self.query.options.server_side_filters:
+            db_keys = list(self._get_db_keys_set_on_client())
+            for i in range(0, len(db_keys), chunk_size):
+                yield from self._load_related(
+                    self.query.get_many_objects(
+                        self.model_class,
+                        db_keys[i : i + chunk_size],
+                        values=self._values,
+                    )
+                )
+            return
+
+        temp_keys = TempKeys(self.model_class)
+        pipeline = POPOTO_REDIS_DB.pipeline()
+        staged_key = self.stage(pipeline, temp_keys)
+        if staged_key is None:
+            return
+        result_key, is_sorted = staged_key
+        pipeline = temp_keys.expire(pipeline, ttl=ITERATOR_TEMP_KEY_TTL)
+        # only the result key is needed for the iteration
+        intermediate_keys = [key for key in temp_keys if key != result_key]
+        if intermediate_keys:
+            pipeline = pipeline.delete(*intermediate_keys)
+        pipeline.execute()
+        try:
+            yield from self._iterate_redis_key(
+                result_key,
+                is_sorted,
+                chunk_size,
+                refresh_ttl=result_key in temp_keys,
+            )
+        finally:
+            if len(temp_keys):
+                POPOTO_REDIS_DB.delete(*temp_keys)
+
+    def _iterate_redis_key(
+        self, redis_key: str, is_sorted: bool, chunk_size: int, refresh_ttl=False
+    ):
+        from .query import QueryException
+
+        cursor = 0
+        while True:
+            if is_sorted:
+                cursor, members = POPOTO_REDIS_DB.zscan(
+                    redis_key, cursor, count=chunk_size
+                )
+                db_keys = [member for member, score in members]
+            else:
+                cursor, db_keys = POPOTO_REDIS_DB.sscan(
+                    redis_key, cursor, count=chunk_size
+                )
+            if db_keys:
+                yield from self._load_related(
+                    self.query.get_many_objects(
+                        self.model_class, db_keys, values=self._values
+                    )
+                )
+            if cursor == 0:
+                return
+            if refresh_ttl and not POPOTO_REDIS_DB.expire(
+                redis_key, ITERATOR_TEMP_KEY_TTL
+            ):
+                raise QueryException(
+                    "iterator() results expired. "
+                    f"Consume each chunk within {ITERATOR_TEMP_KEY_TTL} seconds."
+                )
+
+    def __iter__(self):
+        return iter(self._fetch_all())
+
+    def __len__(self):
+        return len(self._fetch_all())
+
+    def __bool__(self):
+        return bool(self._fetch_all())
+
+    def __getitem__(self, k):
+        if self._result_cache is not None:
+            return self._result_cache[k]
+        if isinstance(k, slice):
+            if (
+                (k.start or 0) < 0
+                or (k.stop is not None and k.stop < 0)
+                or k.step not in (None, 1)
+            ):
+                return self._fetch_all()[k]
+            clone = self._clone()
+            clone._set_window(k.start or 0, k.stop)
+            return clone
+        if k < 0:
+            return self._fetch_all()[k]
+        clone = self._clone()
+        clone._set_window(k, k + 1)
+        results = clone._fetch_all()
+        if not results:
+            raise IndexError("QuerySet index out of range")
+        return results[0]
+
+    def __eq__(self, other):
+        if isinstance(other, (list, QuerySet)):
+            return self._fetch_all() == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self._fetch_all()!r}>"
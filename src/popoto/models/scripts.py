@@ -0,0 +1,609 @@
+"""
+Lua scripts registered on first use with SCRIPT LOAD, then called with EVALSHA.
+Plans are passed as one msgpack encoded ARGV, so every query shape shares the same cached script.
+Scripts touch keys not declared in KEYS, so they are for standalone Redis only (not Redis Cluster).
+"""
+import logging
+
+import msgpack
+import redis
+
+from ..redis_db import POPOTO_REDIS_DB
+
+logger = logging.getLogger("POPOTO.scripts")
+
+QUERY_LUA = """
+local plan = cmsgpack.unpack(ARGV[1])
+local temp_keys = {}
+
+local function new_temp_key()
+    local temp_key = plan.temp_prefix .. ':' .. (#temp_keys + 1)
+    temp_keys[#temp_keys + 1] = temp_key
+    return temp_key
+end
+
+local intersect
+
+-- commands with many keys take them 1000 at a time, unpack() fails past ~8000 values.
+-- each chunk after the first also reads the temp key, combining the partial results
+local function store_chunked(command, temp_key, keys, first, with_numkeys)
+    for i = first, #keys, 999 do
+        local chunk = {}
+        if i > first then
+            chunk[1] = temp_key
+        end
+        for j = i, math.min(i + 998, #keys) do
+            chunk[#chunk + 1] = keys[j]
+        end
+        if with_numkeys then
+            redis.call(command, temp_key, #chunk, unpack(chunk))
+        else
+            redis.call(command, temp_key, unpack(chunk))
+        end
+    end
+end
+
+-- stage the members of a source in one key. returns the key and whether it is a sorted set
+local function stage(source)
+    local op = source[1]
+    if op == 'set' then
+        return source[2], false
+    elseif op == 'range' then
+        if source[3] == '-inf' and source[4] == '+inf' then
+            return source[2], true
+        end
+        local temp_key = new_temp_key()
+        redis.call('ZRANGESTORE', temp_key, source[2], source[3], source[4], 'BYSCORE')
+        return temp_key, true
+    elseif op == 'union' then
+        local temp_key = new_temp_key()
+        store_chunked('SUNIONSTORE', temp_key, source, 2, false)
+        return temp_key, false
+    elseif op == 'ranges' then
+        local keys = {}
+        for i = 4, #source do
+            keys[i - 3] = stage({'range', source[i], source[2], source[3]})
+        end
+        local temp_key = new_temp_key()
+        store_chunked('ZUNIONSTORE', temp_key, keys, 1, true)
+        return temp_key, true
+    elseif op == 'geo' then
+        local temp_key = new_temp_key()
+        if source[7] ~= '' then
+            redis.call('GEORADIUSBYMEMBER', source[2], source[7], source[3], source[4], 'STORE', temp_key)
+        else
+            redis.call('GEORADIUS', source[2], source[5], source[6], source[3], source[4], 'STORE', temp_key)
+        end
+        return temp_key, true
+    elseif op == 'keys' then
+        local temp_key = new_temp_key()
+        for i = 2, #source, 1000 do
+            redis.call('SADD', temp_key, unpack(source, i, math.min(i + 999, #source)))
+        end
+        return temp_key, false
+    elseif op == 'and' then
+        local sources = {}
+        for i = 2, #source do
+            sources[i - 1] = source[i]
+        end
+        local key, is_sorted = intersect(sources)
+        return key or new_temp_key(), is_sorted  -- a new temp key is an empty set
+    elseif op == 'or' or op == 'not' then
+        local keys, any_sorted = {}, false
+        for i = 2, #source do
+            local key, is_sorted = stage(source[i])
+            keys[i - 1] = key
+            any_sorted = any_sorted or is_sorted
+        end
+        local temp_key = new_temp_key()
+        if op == 'or' and any_sorted then
+            store_chunked('ZUNIONSTORE', temp_key, keys, 1, true)
+        elseif op == 'or' then
+            store_chunked('SUNIONSTORE', temp_key, keys, 1, false)
+        elseif any_sorted then
+            store_chunked('ZDIFFSTORE', temp_key, keys, 1, true)
+        else
+            store_chunked('SDIFFSTORE', temp_key, keys, 1, false)
+        end
+        return temp_key, any_sorted
+    end
+    error('unknown key source ' .. tostring(op))
+end
+
+-- an upper bound of the members matching a source
+local estimate
+estimate = function(source)
+    local op = source[1]
+    if op == 'set' then
+        return redis.call('SCARD', source[2])
+    elseif op == 'range' then
+        return redis.call('ZCOUNT', source[2], source[3], source[4])
+    elseif op == 'union' then
+        local total = 0
+        for i = 2, #source do
+            total = total + redis.call('SCARD', source[i])
+        end
+        return total
+    elseif op == 'ranges' then
+        local total = 0
+        for i = 4, #source do
+            total = total + redis.call('ZCOUNT', source[i], source[2], source[3])
+        end
+        return total
+    elseif op == 'geo' then
+        return redis.call('ZCARD', source[2])
+    elseif op == 'and' then
+        local smallest = estimate(source[2])
+        for i = 3, #source do
+            smallest = math.min(smallest, estimate(source[i]))
+        end
+        return smallest
+    elseif op == 'or' then
+        local total = 0
+        for i = 2, #source do
+            total = total + estimate(source[i])
+        end
+        return total
+    elseif op == 'not' then
+        return estimate(source[2])
+    end
+    return #source - 1
+end
+
+-- staging the source copies every match into a temp key
+local function copies_members(source)
+    if source[1] == 'set' then
+        return false
+    elseif source[1] == 'range' then
+        return not (source[3] == '-inf' and source[4] == '+inf')
+    elseif source[1] == 'union' then
+        return #source > 2
+    end
+    return true
+end
+
+local function intersect_all(sources)
+    local keys, any_sorted = {}, false
+    for i, source in ipairs(sources) do
+        local key, is_sorted = stage(source)
+        keys[i] = key
+        any_sorted = any_sorted or is_sorted
+    end
+    if #keys == 1 then
+        return keys[1], any_sorted
+    end
+    local temp_key = new_temp_key()
+    if any_sorted then
+        store_chunked('ZINTERSTORE', temp_key, keys, 1, true)
+    else
+        store_chunked('SINTERSTORE', temp_key, keys, 1, false)
+    end
+    return temp_key, any_sorted
+end
+
+-- intersect the most selective sources first. returns nil as soon as nothing can match
+intersect = function(sources)
+    local any_copied = false
+    for _, source in ipairs(sources) do
+        any_copied = any_copied or copies_members(source)
+    end
+    if #sources == 1 or not any_copied then
+        return intersect_all(sources)
+    end
+
+    local planned = {}
+    for i, source in ipairs(sources) do
+        local size = estimate(source)
+        if size == 0 then
+            return nil
+        end
+        planned[i] = {size, source}
+    end
+    table.sort(planned, function(a, b) return a[1] < b[1] end)
+
+    local result_key, is_sorted = stage(planned[1][2])
+    for i = 2, #planned do
+        local source = planned[i][2]
+        local temp_key = new_temp_key()
+        if source[1] == 'range' and copies_members(source) then
+            -- score the smaller result by the sorted set, then keep the range
+            redis.call('ZINTERSTORE', temp_key, 2, result_key, source[2], 'WEIGHTS', 0, 1)
+            local range_key = new_temp_key()
+            redis.call('ZRANGESTORE', range_key, temp_key, source[3], source[4], 'BYSCORE')
+            temp_key, is_sorted = range_key, true
+        else
+            local key, source_sorted = stage(source)
+            if is_sorted or source_sorted then
+                redis.call('ZINTERSTORE', temp_key, 2, result_key, key)
+                is_sorted = true
+            else
+                redis.call('SINTERSTORE', temp_key, result_key, key)
+            end
+        end
+        result_key = temp_key
+        if redis.call('EXISTS', result_key) == 0 then
+            return nil
+        end
+    end
+    return result_key, is_sorted
+end
+
+local db_keys = {}
+local first = plan.filters[1]
+if plan.order_key ~= '' and #plan.filters == 1 and #plan.excludes == 0
+        and first[1] == 'range' and first[2] == plan.order_key then
+    -- a range on the order_by field itself
+    local min, max = first[3], first[4]
+    if plan.rev == 1 then
+        db_keys = redis.call('ZRANGE', plan.order_key, max, min, 'BYSCORE', 'REV',
+            'LIMIT', plan.start, plan.count)
+    else
+        db_keys = redis.call('ZRANGE', plan.order_key, min, max, 'BYSCORE',
+            'LIMIT', plan.start, plan.count)
+    end
+else
+    local result_key, is_sorted = intersect(plan.filters)
+    for _, exclude in ipairs(plan.excludes) do
+        if not result_key then
+            break
+        end
+        local exclude_key, exclude_sorted = intersect(exclude)
+        if exclude_key then
+            local temp_key = new_temp_key()
+            if is_sorted or exclude_sorted then
+                redis.call('ZDIFFSTORE', temp_key, 2, result_key, exclude_key)
+                is_sorted = true
+            else
+                redis.call('SDIFFSTORE', temp_key, result_key, exclude_key)
+            end
+            result_key = temp_key
+        end
+    end
+
+    local stop = plan.count < 0 and -1 or plan.start + plan.count - 1
+    if not result_key then
+        db_keys = {}
+    elseif plan.order_key ~= '' then
+        if result_key ~= plan.order_key then
+            local temp_key = new_temp_key()
+            redis.call('ZINTERSTORE', temp_key, 2, result_key, plan.order_key, 'WEIGHTS', 0, 1)
+            result_key = temp_key
+        end
+        if plan.rev == 1 then
+            db_keys = redis.call('ZRANGE', result_key, plan.start, stop, 'REV')
+        else
+            db_keys = redis.call('ZRANGE', result_key, plan.start, stop)
+        end
+    elseif is_sorted then
+        db_keys = redis.call('ZRANGE', result_key, plan.start, stop)
+    elseif plan.start > 0 or plan.count >= 0 then
+        db_keys = redis.call('SORT', result_key, 'BY', 'nosort', 'LIMIT', plan.start, plan.count)
+    else
+        db_keys = redis.call('SMEMBERS', result_key)
+    end
+end
+
+local hashes = {}
+for i, db_key in ipairs(db_keys) do
+    if #plan.values > 0 then
+        hashes[i] = redis.call('HMGET', db_key, unpack(plan.values))
+    else
+        hashes[i] = redis.call('HGETALL', db_key)
+    end
+end
+
+if #temp_keys > 0 then
+    for i = 1, #temp_keys, 1000 do
+        redis.call('DEL', unpack(temp_keys, i, math.min(i + 999, #temp_keys)))
+    end
+end
+return {db_keys, hashes}
+"""
+
+QUERY_SCRIPT = POPOTO_REDIS_DB.register_script(QUERY_LUA)
+
+# HSET the same fields on every existing hash in KEYS. ARGV is field, value, ..
+UPDATE_LUA = """
+local updated = 0
+for _, db_key in ipairs(KEYS) do
+    if redis.call('EXISTS', db_key) == 1 then
+        redis.call('HSET', db_key, unpack(ARGV))
+        updated = updated + 1
+    end
+end
+return updated
+"""
+
+UPDATE_SCRIPT = POPOTO_REDIS_DB.register_script(UPDATE_LUA)
+
+# count and sum the scores of sorted set KEYS[1] between ARGV[1] and ARGV[2], by rank in chunks
+SUM_SCORES_LUA = """
+local key, min, max = KEYS[1], ARGV[1], ARGV[2]
+local start = 0
+if min ~= '-inf' then
+    -- the rank of the first score in range is the number of scores below min
+    if string.sub(min, 1, 1) == '(' then
+        start = redis.call('ZCOUNT', key, '-inf', string.sub(min, 2))
+    else
+        start = redis.call('ZCOUNT', key, '-inf', '(' .. min)
+    end
+end
+local count = redis.call('ZCOUNT', key, min, max)
+local total = 0
+for i = start, start + count - 1, 1000 do
+    local scores = redis.call('ZRANGE', key, i, math.min(i + 999, start + count - 1), 'WITHSCORES')
+    for j = 2, #scores, 2 do
+        total = total + tonumber(scores[j])
+    end
+end
+return {count, string.format('%.17g', total)}
+"""
+
+SUM_SCORES_SCRIPT = POPOTO_REDIS_DB.register_script(SUM_SCORES_LUA)
+
+# one page of sorted set KEYS[1] between scores ARGV[1] and ARGV[2], after a cursor
+# ARGV[3] is 1 for descending order, ARGV[4] the page size,
+# ARGV[5] and ARGV[6] the score and member of the cursor, or '' for the first page
+PAGE_LUA = """
+local key, min, max = KEYS[1], ARGV[1], ARGV[2]
+local rev, count, skip = ARGV[3] == '1', tonumber(ARGV[4]), 0
+local score, member = ARGV[5], ARGV[6]
+
+-- byte order, like ZRANGE sorts equal scores. Lua's < follows the server's locale
+local function precedes(a, b)
+    for i = 1, math.min(#a, #b) do
+        local x, y = string.byte(a, i), string.byte(b, i)
+        if x ~= y then
+            return x < y
+        end
+    end
+    return #a < #b
+end
+
+if member ~= '' then
+    local current = redis.call('ZSCORE', key, member)
+    if current and tonumber(current) == tonumber(score) then
+        -- continue after the cursor's rank, up to the last member within the range
+        local start, stop
+        if rev then
+            start = redis.call('ZREVRANK', key, member) + 1
+            stop = redis.call('ZCOUNT', key, min, '+inf') - 1
+        else
+            start = redis.call('ZRANK', key, member) + 1
+            stop = redis.call('ZCOUNT', key, '-inf', max) - 1
+        end
+        stop = math.min(stop, start + count - 1)
+        if stop < start then
+            return {}
+        end
+        if rev then
+            return redis.call('ZRANGE', key, start, stop, 'REV', 'WITHSCORES')
+        end
+        return redis.call('ZRANGE', key, start, stop, 'WITHSCORES')
+    end
+    -- the cursor's member is gone: skip the ties up to where it was
+    if rev then max = score else min = score end
+    for _, tied in ipairs(redis.call('ZRANGE', key, score, score, 'BYSCORE')) do
+        if (rev and not precedes(tied, member)) or (not rev and not precedes(member, tied)) then
+            skip = skip + 1
+        end
+    end
+end
+if rev then
+    return redis.call('ZRANGE', key, max, min, 'BYSCORE', 'REV', 'LIMIT', skip, count, 'WITHSCORES')
+end
+return redis.call('ZRANGE', key, min, max, 'BYSCORE', 'LIMIT', skip, count, 'WITHSCORES')
+"""
+
+PAGE_SCRIPT = POPOTO_REDIS_DB.register_script(PAGE_LUA)
+
+
+# HSET the recorded index values ARGV[2..] (field, value pairs) of the expiring object
+# ARGV[1], if it is still in the expiry sorted set KEYS[1]. KEYS[2] holds the values
+EXPIRY_VALUES_LUA = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return redis.call('HSET', KEYS[2], unpack(ARGV, 2))
+end
+return 0
+"""
+
+EXPIRY_VALUES_SCRIPT = POPOTO_REDIS_DB.register_script(EXPIRY_VALUES_LUA)
+
+# objects of the expiry sorted set KEYS[1] due by timestamp ARGV[1], at most ARGV[2],
+# which Redis has expired: a flat [redis key, [recorded values of fields ARGV[3..]], ..]
+# objects still in Redis had their expiry changed, their score is corrected
+REAP_LUA = """
+local now, expired = tonumber(ARGV[1]), {}
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(due) do
+    local fields = {}
+    for i = 3, #ARGV do
+        fields[#fields + 1] = ARGV[i] .. ':' .. member
+    end
+    local pttl = redis.call('PTTL', member)
+    if pttl == -2 then
+        expired[#expired + 1] = member
+        expired[#expired + 1] = #fields > 0 and redis.call('HMGET', KEYS[2], unpack(fields)) or {}
+    elseif pttl == -1 then
+        -- persisted, no longer expires
+        redis.call('ZREM', KEYS[1], member)
+        if #fields > 0 then
+            redis.call('HDEL', KEYS[2], unpack(fields))
+        end
+    else
+        redis.call('ZADD', KEYS[1], now + pttl / 1000, member)
+    end
+end
+return expired
+"""
+
+REAP_SCRIPT = POPOTO_REDIS_DB.register_script(REAP_LUA)
+
+# run the commands of a ScriptPipeline in one atomic call. ARGV is flat, binary safe:
+# the number of arguments of a command, its name and arguments, then the next command
+# EXPIRYVALUES expiry key, values key, redis key, field, value, .. is the conditional
+# HSET of EXPIRY_VALUES_LUA, as scripts can not call other scripts
+# IFEXISTS redis key, number of arguments of the commands to run if it exists,
+# those commands, then the commands to run otherwise. See queue_if_exists()
+WRITE_LUA = """
+local run
+run = function(first, last)
+    local replies, i = {}, first
+    while i <= last do
+        local size = tonumber(ARGV[i])
+        if ARGV[i + 1] == 'EXPIRYVALUES' then
+            local reply = 0
+            if redis.call('ZSCORE', ARGV[i + 2], ARGV[i + 4]) then
+                reply = redis.call('HSET', ARGV[i + 3], unpack(ARGV, i + 5, i + size))
+            end
+            replies[#replies + 1] = reply
+        elseif ARGV[i + 1] == 'IFEXISTS' then
+            local if_exists_size, branch_replies = tonumber(ARGV[i + 3]), nil
+            if redis.call('EXISTS', ARGV[i + 2]) == 1 then
+                branch_replies = run(i + 4, i + 3 + if_exists_size)
+            else
+                branch_replies = run(i + 4 + if_exists_size, i + size)
+            end
+            replies[#replies + 1] = branch_replies[1] or 0
+        else
+            replies[#replies + 1] = redis.call(unpack(ARGV, i + 1, i + size))
+        end
+        i = i + size + 1
+    end
+    return replies
+end
+return run(1, #ARGV)
+"""
+
+WRITE_SCRIPT = POPOTO_REDIS_DB.register_script(WRITE_LUA)
+
+
+class ScriptPipeline(redis.client.Pipeline):
+    """
+    A pipeline of write commands sent as one WRITE_SCRIPT call:
+    a single round trip, applied atomically by Redis.
+    Commands are queued like on any pipeline, execute() returns their raw replies.
+    Used by Model.save() and Model.delete() without a pipeline.
+    """
+
+    def __init__(self, client: redis.Redis = None):
+        client = client or POPOTO_REDIS_DB
+        super().__init__(
+            client.connection_pool,
+            client.response_callbacks,
+            transaction=False,
+            shard_hint=None,
+        )
+
+    def queue_expiry_values(
+        self, expiry_key: str, values_key: str, redis_key: str, args: list
+    ) -> "ScriptPipeline":
+        return self.pipeline_execute_command(
+            "EXPIRYVALUES", expiry_key, values_key, redis_key, *args
+        )
+
+    def get_script_args(self) -> list:
+        """the queued commands, as the flat ARGV of WRITE_SCRIPT"""
+        args = []
+        for command_args, _ in self.command_stack:
+            args += [len(command_args), *command_args]
+        return args
+
+    def execute(self, raise_on_error: bool = True) -> list:
+        if not self.command_stack:
+            return []
+        try:
+            return WRITE_SCRIPT(args=self.get_script_args())
+        finally:
+            self.reset()
+
+
+def queue_if_exists(
+    pipeline, redis_key: str, if_exists: ScriptPipeline, otherwise: ScriptPipeline
+):
+    """
+    queue the commands of if_exists if redis_key exists, else those of otherwise,
+    both only queued, never executed. Checked and run atomically by WRITE_SCRIPT
+    """
+    if_exists_args = if_exists.get_script_args()
+    command = [
+        "IFEXISTS",
+        redis_key,
+        len(if_exists_args),
+        *if_exists_args,
+        *otherwise.get_script_args(),
+    ]
+    if isinstance(pipeline, ScriptPipeline):
+        return pipeline.pipeline_execute_command(*command)
+    return WRITE_SCRIPT(args=[len(command), *command], client=pipeline)
+
+
+def run_query_script(plan: dict) -> tuple:
+    """
+    execute a compiled query plan in a single round trip
+    :param plan: see QuerySet.compile_script_plan()
+    :return: (list of db keys, list of hashes)
+        each hash is a flat [field, value, ..] list, or a list of values if plan["values"]
+    """
+    db_keys, hashes = QUERY_SCRIPT(args=[msgpack.packb(plan)])
+    return db_keys, hashes
+
+
+def queue_update_script(pipeline, db_keys: list, encoded_values: dict):
+    """
+    queue HSET of encoded_values on each of db_keys that still exists
+    the reply is the number of hashes updated
+    """
+    args = [item for field_value in encoded_values.items() for item in field_value]
+    return UPDATE_SCRIPT(keys=db_keys, args=args, client=pipeline)
+
+
+def queue_sum_scores_script(pipeline, sortedset_key: str, min="-inf", max="+inf"):
+    """
+    queue a sum of the scores in sortedset_key between min and max
+    the reply is [count, sum as a string]
+    """
+    return SUM_SCORES_SCRIPT(keys=[sortedset_key], args=[min, max], client=pipeline)
+
+
+def queue_page_script(
+    pipeline,
+    sortedset_key: str,
+    min,
+    max,
+    reverse: bool,
+    count: int,
+    after: tuple = ("", ""),
+):
+    """
+    queue a read of count members of sortedset_key, ordered by score, following after
+    :param after: (score, member) of the last member of the previous page
+    the reply is a flat [member, score, ..] list
+    """
+    return PAGE_SCRIPT(
+        keys=[sortedset_key],
+        args=[min, max, 1 if reverse else 0, count, *after],
+        client=pipeline,
+    )
+
+
+def queue_expiry_values_script(
+    pipeline, expiry_key: str, values_key: str, redis_key: str, values: dict
+):
+    """queue HSET of the recorded index values of redis_key, if it expires"""
+    args = [item for field_value in values.items() for item in field_value]
+    if isinstance(pipeline, ScriptPipeline):
+        return pipeline.queue_expiry_values(expiry_key, values_key, redis_key, args)
+    return EXPIRY_VALUES_SCRIPT(
+        keys=[expiry_key, values_key], args=[redis_key, *args], client=pipeline
+    )
+
+
+def run_reap_script(
+    expiry_key: str, values_key: str, now: float, count: int, field_names
+) -> list:
+    """
+    :return: flat [redis key, [recorded values of field_names], ..] of up to count
+        objects due by now, which Redis has expired
+    """
+    return REAP_SCRIPT(keys=[expiry_key, values_key], args=[now, count, *field_names])
@@ -43,6 +43,8 @@ def set_REDIS_DB_settings(
 
     global POPOTO_REDIS_DB
     POPOTO_REDIS_DB = redis.Redis(*args, **kwargs)
+    global REDIS_VERSION
+    REDIS_VERSION = None
     # global REDIS_GRAPH
     # REDIS_GRAPH = Graph('social', POPOTO_REDIS_DB)
     logger.debug("Redis connection reset.")
@@ -52,6 +54,23 @@ def get_REDIS_DB():
     return POPOTO_REDIS_DB
 
 
+REDIS_VERSION = None
+
+
+def get_redis_version() -> tuple:
+    """
+    version of the connected Redis server, eg. (7, 2, 4)
+    used to pick commands that are only available on newer servers
+    """
+    global REDIS_VERSION
+    if REDIS_VERSION is None:
+        REDIS_VERSION = tuple(
+            int(part)
+            for part in POPOTO_REDIS_DB.info("server")["redis_version"].split(".")
+        )
+    return REDIS_VERSION
+
+
 def print_redis_info() -> None:
     logger.info(POPOTO_REDIS_DB.info())
 
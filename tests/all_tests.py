@@ -1,4 +1,5 @@
 from tests.test_common_models import *
+from tests.test_expiry import *
 from tests.test_field_types import *
 from tests.test_geofield import *
 from tests.test_dataframe_field import *
@@ -8,6 +9,7 @@ from tests.test_model_errors import *
 from tests.test_pubsub import *
 from tests.test_queries import *
 from tests.test_query_results import *
+from tests.test_queryset import *
 from tests.test_relationship import *
 from tests.test_sortedfield import *
 from tests.test_timeseries import *
@@ -74,3 +74,186 @@ assert random_fact_4 == ManyKeyModel.query.get(
 
 for item in ManyKeyModel.query.all():
     item.delete()
+
+# the layout is compiled once, when the class is created
+layout = ManyKeyModel._meta.layout
+assert layout.key_field_names == ("key1", "key2", "key3")
+assert ManyKeyModel._meta.get_db_key_index_position("key3") == 3
+assert random_fact_4.db_key.redis_key == "ManyKeyModel:calories:stamp:lick"
+assert HiddenAutoKeyModel._meta.layout.key_field_names == ("_auto_key",)
+assert HiddenAutoKeyModel().db_key != HiddenAutoKeyModel().db_key  # new auto keys
+
+
+class ListModel(popoto.Model):
+    name = popoto.KeyField()
+    items = popoto.Field(type=list, default=[])
+
+
+first_list, second_list = ListModel(name="first"), ListModel(name="second")
+first_list.items.append("item")
+assert second_list.items == []  # defaults are not shared
+first_list.name = "too long" * 200
+assert not first_list.is_valid()  # max_length
+
+# nor for fields missing from a stored hash
+ListModel(name="stored").save()
+POPOTO_REDIS_DB.hdel("ListModel:stored", "items")
+first_list, second_list = ListModel.query.get(name="stored"), ListModel.query.all()[0]
+first_list.items.append("item")
+assert second_list.items == [] and ListModel._meta.fields["items"].default == []
+ListModel.query.get(name="stored").delete()
+
+
+# BULK CREATE AND SAVE
+class BulkModel(popoto.Model):
+    name = popoto.KeyField()
+    rank = popoto.SortedField(type=int)
+    note = popoto.Field(null=True)
+
+
+created_count, errors = BulkModel.bulk_create(
+    [dict(name=f"item{i}", rank=i) for i in range(25)]
+    + [dict(name="bad rank", rank="high"), dict(name="x" * 200, rank=1)]
+    + [BulkModel(name="instance", rank=100)],
+    batch_size=10,
+)
+assert created_count == 26
+assert [obj["name"][:3] for obj, _ in errors] == ["bad", "xxx"]
+assert BulkModel.query.count() == 26
+assert BulkModel.query.filter(rank__gte=20).count() == 6
+assert BulkModel.query.get(name="item3").rank == 3
+
+items = list(BulkModel.query.filter(rank__lt=5))
+for item in items:
+    item.note = "bulk saved"
+items[0].rank = None  # invalid, SortedField cannot be null
+saved_count, errors = BulkModel.bulk_save(items)
+assert saved_count == 4 and errors[0][0] is items[0]
+assert BulkModel.query.filter(rank__lt=5).count() == 5  # the invalid one is unchanged
+assert [item.note for item in BulkModel.query.filter(rank__lt=5)].count(
+    "bulk saved"
+) == 4
+
+assert BulkModel.query.all().delete() == 26
+assert BulkModel.bulk_save([]) == (0, [])
+
+
+# SAVING ONLY CHANGED FIELDS
+from src.popoto.models.base import ModelException
+from src.popoto.models.profiling import QueryProfile
+
+
+class Shop(popoto.Model):
+    name = popoto.KeyField()
+
+
+class Listing(popoto.Model):
+    name = popoto.KeyField()
+    shop = popoto.Relationship(model=Shop, null=True)
+    category = popoto.Field(type=str)
+    price = popoto.SortedField(type=int, sort_by="category")
+    note = popoto.Field(null=True)
+
+
+corner, market = Shop.create(name="corner"), Shop.create(name="market")
+lamp = Listing.create(name="lamp", shop=corner, category="lights", price=20)
+assert lamp.get_changed_fields() == []
+
+lamp = Listing.query.get(name="lamp")
+lamp.note = "on sale"
+assert lamp.get_changed_fields() == ["note"]
+with QueryProfile() as profile:
+    lamp.save()
+# HSET of the note only, if the hash still exists
+assert profile.commands == ["IFEXISTS Listing:lamp"]
+assert profile.round_trips == 1  # one script call
+with QueryProfile() as profile:
+    lamp.save()  # nothing changed
+assert profile.commands == []
+assert Listing.query.get(name="lamp").note == "on sale"
+
+lamp.price, lamp.category, lamp.shop, lamp.note = 15, "sale", market, None
+lamp.save(update_fields=["price", "category", "shop"])
+assert lamp.get_changed_fields() == ["note"]
+lamp = Listing.query.get(name="lamp")
+assert (lamp.price, lamp.category, lamp.shop, lamp.note) == (
+    15,
+    "sale",
+    market,
+    "on sale",
+)
+assert POPOTO_REDIS_DB.zscore("$SortF:Listing:price:sale", "Listing:lamp") == 15
+assert not POPOTO_REDIS_DB.exists("$SortF:Listing:price:lights")
+assert Listing.query.filter(shop=market).count() == 1
+assert Listing.query.filter(shop=corner).count() == 0
+
+lamp.name = "desk lamp"  # a new db key, so the whole object is saved anew
+try:
+    lamp.save(update_fields=["name"])
+    raise AssertionError("update_fields needs an unchanged db key")
+except ModelException:
+    pass
+lamp.save()
+assert Listing.query.count() == 1 and Listing.query.get(name="desk lamp").price == 15
+assert POPOTO_REDIS_DB.keys("$KeyF:Listing:*") == [b"$KeyF:Listing:name:desk lamp"]
+try:
+    lamp.save(update_fields=["color"])
+    raise AssertionError("unknown fields are rejected")
+except ModelException:
+    pass
+
+with QueryProfile() as profile:
+    assert market.delete() and not market.delete()
+assert profile.round_trips == 2 and profile.commands[0] == "DEL Shop:market"
+stale_lamp = Listing.query.get(name="desk lamp")
+Listing.query.get(name="desk lamp").delete()
+stale_lamp.note = "back in stock"
+stale_lamp.save()  # deleted since it was loaded, so saved anew
+lamp = Listing.query.get(name="desk lamp")
+assert (lamp.name, lamp.price, lamp.note) == ("desk lamp", 15, "back in stock")
+assert Listing.query.filter(category="sale", price__gte=10).count() == 1
+assert Listing.query.filter(shop=market).count() == 1
+assert Listing.query.all().delete() == 1 and Shop.query.all().delete() == 1
+
+
+# SLOTTED INSTANCES
+class Reading(popoto.Model):
+    sensor = popoto.KeyField()
+    value = popoto.SortedField(type=float)
+    unit = popoto.Field(null=True)
+
+    class Meta:
+        slots = True
+
+
+class UntrackedReading(popoto.Model):
+    value = popoto.SortedField(type=float)
+
+    class Meta:
+        slots = True
+        track_changes = False
+
+
+reading = Reading.create(sensor="s1", value=20.5)
+assert not hasattr(reading, "__dict__")
+try:
+    Reading(sensor="s2", value=1.0, color="red")
+    raise AssertionError("slotted instances only take fields")
+except ModelException:
+    pass
+reading = Reading.query.get(sensor="s1")
+reading.unit = "C"
+assert reading.get_changed_fields() == ["unit"]
+reading.save()
+assert Reading.query.filter(value__gte=20)[0].unit == "C"
+
+untracked = UntrackedReading.create(value=1.5)
+assert not hasattr(untracked, "__dict__") and untracked._db_content == {}
+untracked = UntrackedReading.query.all()[0]
+untracked.value = 2.5
+with QueryProfile() as profile:
+    untracked.save()  # written in full, the stored values are unknown
+assert profile.commands[0] == f"HSET {untracked.db_key.redis_key}"
+assert UntrackedReading.query.filter(value__gt=2).count() == 1
+
+assert Reading.query.all().delete() == 1 and UntrackedReading.query.all().delete() == 1
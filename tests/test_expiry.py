@@ -0,0 +1,154 @@
+import sys
+import os
+import time
+from datetime import datetime, timedelta
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from src.popoto.redis_db import POPOTO_REDIS_DB
+from src import popoto
+from src.popoto.models.base import ModelException
+from src.popoto.models.profiling import QueryProfile
+
+
+class Visitor(popoto.Model):
+    name = popoto.KeyField()
+
+
+class Session(popoto.Model):
+    token = popoto.KeyField()
+    visitor = popoto.Relationship(model=Visitor, null=True)
+    region = popoto.Field(type=str, default="eu")
+    last_seen = popoto.SortedField(type=float, sort_by="region")
+
+    class Meta:
+        ttl = 600
+
+
+class Download(popoto.Model):
+    name = popoto.KeyField()
+    size = popoto.SortedField(type=int)
+
+    class Meta:
+        expires = True  # without a default ttl
+
+
+def index_keys(model_name):
+    return sorted(
+        key.decode()
+        for key in POPOTO_REDIS_DB.keys(f"*{model_name}*")
+        if not key.startswith(b"$Generation")
+    )
+
+
+ada = Visitor.create(name="ada")
+
+# Meta.ttl expires every object, each save() restarts it
+session = Session.create(token="t1", visitor=ada, last_seen=time.time())
+assert 590 < POPOTO_REDIS_DB.ttl("Session:t1") <= 600
+assert POPOTO_REDIS_DB.zscore("$Expiry:Session", "Session:t1") > time.time() + 590
+assert POPOTO_REDIS_DB.hgetall("$ExpiryValues:Session") == {
+    b"last_seen:Session:t1": session._db_content[b"last_seen"],
+    b"region:Session:t1": session._db_content[b"region"],
+    b"visitor:Session:t1": session._db_content[b"visitor"],
+}
+
+# saving a loaded copy keeps the recorded index values up to date
+session = Session.query.get(token="t1")
+session.region = "us"
+session.save(ttl=timedelta(seconds=30))
+assert 25 < POPOTO_REDIS_DB.ttl("Session:t1") <= 30
+assert POPOTO_REDIS_DB.hget("$ExpiryValues:Session", "region:Session:t1") == (
+    session._db_content[b"region"]
+)
+Session.query.filter(token="t1").update(region="asia")
+assert Session.query.filter(region="asia", last_seen__gt=0).count() == 1
+
+# once Redis expires the hash, reap_expired() removes its index entries
+Session.query.get(token="t1").save(expire_at=datetime.now() - timedelta(seconds=1))
+assert not POPOTO_REDIS_DB.exists("Session:t1")
+assert "$SortF:Session:last_seen:asia" in index_keys("Session")
+with popoto.IdentityMap() as identity_map:
+    assert Session.query.get(token="t1") is None
+    identity_map.add(session)  # a copy loaded before it expired
+    assert Session.reap_expired() == 1
+    assert "Session:t1" not in identity_map
+assert index_keys("Session") == []
+assert Session.query.count() == 0 and Session.query.filter(visitor=ada).count() == 0
+assert Session.reap_expired() == 0
+
+# a persisted object is no longer tracked, a changed expiry is rescheduled
+Download.create(name="a", size=1).save(ttl=60)
+Download.create(name="b", size=2).save(ttl=60)
+POPOTO_REDIS_DB.persist("Download:a")
+POPOTO_REDIS_DB.zadd("$Expiry:Download", {"Download:a": 1, "Download:b": 1})
+assert Download.reap_expired() == 0
+assert POPOTO_REDIS_DB.zrange("$Expiry:Download", 0, -1) == [b"Download:b"]
+assert POPOTO_REDIS_DB.zscore("$Expiry:Download", "Download:b") > time.time() + 50
+assert Download.query.count() == 2
+
+# create() takes the expiry too
+Download.create(name="c", size=3, ttl=60)
+assert 50 < POPOTO_REDIS_DB.ttl("Download:c") <= 60
+Download.create(name="d", size=4, expire_at=datetime.now() + timedelta(minutes=5))
+assert 290 < POPOTO_REDIS_DB.ttl("Download:d") <= 300
+assert POPOTO_REDIS_DB.zscore("$Expiry:Download", "Download:d") > time.time() + 290
+assert Download.query.filter(name__in=["c", "d"]).delete() == 2
+Download.query.get(name="b").delete()  # deleting forgets the expiry
+assert not POPOTO_REDIS_DB.exists("$Expiry:Download")
+
+# cached query results are not served past the next expiry
+class Notice(popoto.Model):
+    title = popoto.KeyField()
+
+    class Meta:
+        ttl = 600
+        cache_ttl = 30
+
+
+Notice.create(title="open")
+Notice.create(title="closing", expire_at=time.time() + 0.2)
+assert len(Notice.query.all()) == 2
+time.sleep(0.3)
+assert [notice.title for notice in Notice.query.all()] == ["open"]
+Notice.query.all().delete()
+
+# models without Meta.ttl or Meta.expires record no expiry values
+class Score(popoto.Model):
+    player = popoto.KeyField()
+    points = popoto.SortedField(type=int)
+
+
+with QueryProfile() as profile:
+    Score.bulk_create([dict(player="bo", points=1), dict(player="cy", points=2)])
+    score = Score.create(player="di", points=3)
+    score.points = 4
+    score.save()
+    Score.query.get(player="bo").delete()
+    Score.query.filter(points__gte=2).update(points=5)
+    Score.query.all().delete()
+assert not any("Expiry" in command for command in profile.commands)
+try:
+    Score.create(player="ed", points=1, ttl=60)
+    raise AssertionError("Score objects do not expire")
+except ModelException:
+    pass
+assert Score.reap_expired() == 0 and Score.query.count() == 0
+
+# a background reaper walks the expiry sorted sets in batches
+reaper = popoto.ExpiryReaper([Session, Download], interval=0.05, batch_size=2)
+reaper.start()
+for number in range(5):
+    Download.create(name=f"old{number}", size=number).save(expire_at=time.time() - 1)
+for _ in range(100):
+    if reaper.reaped_count == 5:
+        break
+    time.sleep(0.02)
+reaper.stop()
+assert reaper.reaped_count == 5 and not reaper.is_alive()
+assert Download.query.count() == 1 and Download.query.filter(size__gte=0).count() == 1
+
+Download.query.all().delete()
+Visitor.query.all().delete()
+assert index_keys("Download") == [] and index_keys("Visitor") == []
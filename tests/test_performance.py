@@ -44,6 +44,14 @@ for kv_object in KeyValueModel.objects.all():
 
 time_checkpoints["1000 objects deleted"] = time.time()
 
+KeyValueModel.bulk_create(dict(key=f"key{i}", value=f"value{i}") for i in range(1000))
+
+time_checkpoints["1000 objects bulk created"] = time.time()
+
+assert KeyValueModel.query.all().delete() == 1000
+
+time_checkpoints["1000 objects bulk deleted"] = time.time()
+
 ######################################
 ###############  DONE  ###############
 ######################################
@@ -56,3 +56,58 @@ for item in MultiKeyModel.query.all():
     item.delete()
 
 assert MultiKeyModel.query.count() == 0
+
+
+# SERVER-SIDE FILTER INTERSECTION
+class ExchangePrice(popoto.Model):
+    exchange = popoto.KeyField()
+    symbol = popoto.KeyField()
+    price = popoto.SortedField(type=float)
+
+
+class ClientSideExchangePrice(popoto.Model):
+    exchange = popoto.KeyField()
+    symbol = popoto.KeyField()
+    price = popoto.SortedField(type=float)
+
+    class Meta:
+        server_side_filters = False
+
+
+for model_class in [ExchangePrice, ClientSideExchangePrice]:
+    for i, exchange in enumerate(["binance", "kraken", "coinbase"]):
+        for j, symbol in enumerate(["BTC", "ETH", "SOL", "ADA"]):
+            model_class.create(exchange=exchange, symbol=symbol, price=i * 10 + j)
+
+assert ExchangePrice._meta.server_side_filters is True
+assert ClientSideExchangePrice._meta.server_side_filters is False
+for filter_kwargs in [
+    dict(exchange="binance", price__gte=2),
+    dict(exchange="kraken", symbol__in=["BTC", "SOL"]),
+    dict(exchange__in=["kraken", "coinbase"], price__lt=22, price__gt=10),
+    dict(symbol__startswith="S", price__gte=10),
+    dict(exchange="coinbase", symbol="ETH", price=21),
+    dict(exchange="binance", symbol="DOGE"),
+    dict(symbol__in=[]),
+]:
+    server_side_keys = {
+        m.db_key.redis_key for m in ExchangePrice.query.filter(**filter_kwargs)
+    }
+    client_side_keys = {
+        m.db_key.redis_key
+        for m in ClientSideExchangePrice.query.filter(**filter_kwargs)
+    }
+    assert server_side_keys == {
+        key.replace("ClientSideExchangePrice", "ExchangePrice")
+        for key in client_side_keys
+    }
+
+assert len(ExchangePrice.query.filter(exchange="binance", price__gte=2)) == 2
+assert len(ExchangePrice.query.filter(exchange="coinbase", price=21)) == 1
+# temp keys are cleaned up after each query
+assert not POPOTO_REDIS_DB.keys("$Query:*")
+
+for model_class in [ExchangePrice, ClientSideExchangePrice]:
+    for item in model_class.query.all():
+        item.delete()
+    assert model_class.query.count() == 0
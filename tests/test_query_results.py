@@ -78,3 +78,32 @@ for item in ThingModel.query.all():
     item.delete()
 
 assert ThingModel.query.count() == 0
+
+
+# LOADED OBJECTS ARE HYDRATED WITHOUT RE-VALIDATION
+class NoteModel(popoto.Model):
+    text = popoto.Field(type=str, null=True)
+
+
+note = NoteModel.create(text="remember")
+auto_key = note._auto_key
+loaded_note = NoteModel.query.get(redis_key=note.db_key.redis_key)
+assert loaded_note._auto_key == auto_key  # no new auto key is generated
+assert loaded_note._redis_key == note.db_key.redis_key  # the key it was read from
+assert loaded_note == note and loaded_note.text == "remember"
+assert NoteModel.query.all()[0]._redis_key == note.db_key.redis_key
+
+hydrated_key = "a" * 32
+hydrated = NoteModel.from_redis(
+    {"_auto_key": hydrated_key}, redis_key=f"NoteModel:{hydrated_key}".encode()
+)
+assert hydrated.text is None  # fields missing from the hash get their default
+assert hydrated._redis_key == f"NoteModel:{hydrated_key}"
+assert hydrated.obsolete_redis_key is None and hydrated._db_content == {}
+hydrated.text = "saved later"
+hydrated.save()
+assert NoteModel.query.get(_auto_key=hydrated_key).text == "saved later"
+
+for item in NoteModel.query.all():
+    item.delete()
+assert NoteModel.query.count() == 0
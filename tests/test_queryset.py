@@ -0,0 +1,760 @@
+import logging
+import sys
+import threading
+import os
+from datetime import date
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from src.popoto.redis_db import POPOTO_REDIS_DB
+from src.popoto.models.queryset import QuerySet
+from src import popoto
+from src.popoto import Q, Min, Max, Sum, Avg, Count
+from src.popoto.models.query import QueryException
+from src.popoto.models.profiling import QueryProfile
+
+
+class Ticket(popoto.Model):
+    number = popoto.KeyField(type=int)
+    status = popoto.KeyField()
+    priority = popoto.SortedField(type=int)
+
+
+class ClientSideTicket(popoto.Model):
+    number = popoto.KeyField(type=int)
+    status = popoto.KeyField()
+    priority = popoto.SortedField(type=int)
+
+    class Meta:
+        server_side_filters = False
+
+
+class LuaTicket(popoto.Model):
+    number = popoto.KeyField(type=int)
+    status = popoto.KeyField()
+    priority = popoto.SortedField(type=int)
+
+    class Meta:
+        lua_queries = True
+
+
+class CachedTicket(popoto.Model):
+    number = popoto.KeyField(type=int)
+    status = popoto.KeyField()
+    priority = popoto.SortedField(type=int)
+
+    class Meta:
+        cache_ttl = 30
+
+
+for model_class in [Ticket, ClientSideTicket, LuaTicket]:
+    # nothing is read from Redis until evaluated
+    open_tickets = model_class.query.filter(status="open")
+    assert isinstance(open_tickets, QuerySet)
+    assert isinstance(model_class.query.all(), QuerySet)
+
+    for number in range(10):
+        model_class.create(
+            number=number, status="open" if number % 2 else "closed", priority=number
+        )
+
+    assert len(open_tickets) == 5
+    assert open_tickets.count() == 5
+    assert open_tickets.exists()
+    assert not model_class.query.filter(status="pending").exists()
+    assert model_class.query.filter(status="pending") == []
+
+    # chaining
+    urgent_open = open_tickets.filter(priority__gte=5)
+    assert {t.number for t in urgent_open} == {5, 7, 9}
+    assert {t.number for t in urgent_open.exclude(number=7)} == {5, 9}
+    assert {t.number for t in model_class.query.all().exclude(status="open")} == {
+        0,
+        2,
+        4,
+        6,
+        8,
+    }
+    assert model_class.query.exclude(status="open", priority__lt=4).count() == 8
+
+    # ordering and slicing
+    ordered = open_tickets.order_by("-priority")
+    assert [t.number for t in ordered] == [9, 7, 5, 3, 1]
+    assert [t.number for t in ordered[1:3]] == [7, 5]
+    assert [t.number for t in ordered[1:][:2]] == [7, 5]
+    assert ordered[0].number == 9
+    assert ordered[-1].number == 1
+    assert open_tickets.order_by("-priority")[1:3].count() == 2
+    assert [t.number for t in open_tickets.order_by("number")[:2]] == [1, 3]
+    assert len(model_class.query.all()[2:6]) == 4
+    assert len(model_class.query.all()[8:20]) == 2
+    assert model_class.query.all()[10:].count() == 0
+    assert not model_class.query.all()[10:].exists()
+    assert len(model_class.query.filter(status="closed", limit=3)) == 3
+
+    # results are cached after evaluation
+    list(ordered)
+    model_class.create(number=11, status="open", priority=11)
+    assert len(ordered) == 5
+    assert len(open_tickets.order_by("-priority")) == 6
+
+    for item in model_class.query.all():
+        item.delete()
+    assert model_class.query.count() == 0
+
+assert not POPOTO_REDIS_DB.keys("$Query:*")
+
+
+# STREAMING ITERATOR
+for model_class in [Ticket, ClientSideTicket, LuaTicket]:
+    pipeline = POPOTO_REDIS_DB.pipeline()
+    for number in range(250):
+        pipeline = model_class.create(
+            pipeline=pipeline,
+            number=number,
+            status="open" if number % 2 else "closed",
+            priority=number,
+        )
+    pipeline.execute()
+
+    all_numbers = [t.number for t in model_class.query.iterator(chunk_size=20)]
+    assert sorted(all_numbers) == list(range(250))
+    open_numbers = {
+        t.number
+        for t in model_class.query.filter(status="open", priority__lt=100).iterator(
+            chunk_size=7
+        )
+    }
+    assert open_numbers == {n for n in range(1, 100, 2)}
+    assert {
+        t["number"]
+        for t in model_class.query.iterator(
+            chunk_size=50, status="closed", values=("number",)
+        )
+    } == set(range(0, 250, 2))
+    assert list(model_class.query.iterator(status="pending")) == []
+    try:
+        next(model_class.query.all().order_by("priority").iterator())
+    except popoto.models.query.QueryException:
+        pass
+    else:
+        raise Exception("expected QueryException on iterator() with order_by")
+
+    for item in model_class.query.iterator():
+        item.delete()
+    assert model_class.query.count() == 0
+
+assert not POPOTO_REDIS_DB.keys("$Query:*")
+
+
+# COUNT IN REDIS, WITHOUT TRANSFERRING KEYS
+def command_calls(*commands):
+    stats = POPOTO_REDIS_DB.info("commandstats")
+    return {c: stats.get(f"cmdstat_{c}", {}).get("calls", 0) for c in commands}
+
+
+for number in range(30):
+    Ticket.create(
+        number=number, status=["open", "closed", "pending"][number % 3], priority=number
+    )
+
+commands = ("scard", "zcount", "zcard", "sintercard", "smembers", "zrange", "sort")
+before = command_calls(*commands)
+assert Ticket.query.count() == 30
+assert Ticket.query.count(status="open") == 10
+assert Ticket.query.count(priority__gte=10, priority__lt=20) == 10
+assert Ticket.query.count(status="open", priority__gte=15) == 5
+assert Ticket.query.filter(status__in=["open", "closed"]).count() == 20
+assert Ticket.query.filter(status="open").exclude(priority__lt=15).count() == 5
+assert Ticket.query.count(status="open", number__in=[0, 3, 4]) == 2
+assert Ticket.query.filter(priority__gte=10)[:4].count() == 4
+after = command_calls(*commands)
+assert after["scard"] - before["scard"] >= 2
+assert after["zcount"] - before["zcount"] >= 2
+for transferring_command in ("smembers", "zrange", "sort"):
+    assert after[transferring_command] == before[transferring_command]
+
+for item in Ticket.query.iterator():
+    item.delete()
+assert not POPOTO_REDIS_DB.keys("$Query:*")
+
+
+# SINGLE ROUND TRIP LUA QUERIES
+for number in range(20):
+    LuaTicket.create(
+        number=number, status="open" if number % 2 else "closed", priority=number
+    )
+
+commands = ("evalsha", "eval", "hgetall", "smembers", "zrange")
+before = command_calls(*commands)
+lua_results = LuaTicket.query.filter(status="open", priority__gte=5).order_by(
+    "-priority"
+)[1:4]
+assert [t.number for t in lua_results] == [17, 15, 13]
+after = command_calls(*commands)
+assert 1 <= after["evalsha"] + after["eval"] - before["evalsha"] - before["eval"] <= 2
+assert after["hgetall"] - before["hgetall"] == 3  # called inside the script
+assert after["smembers"] == before["smembers"]
+
+assert [
+    t.number for t in LuaTicket.query.filter(priority__lt=3, order_by="priority")
+] == [
+    0,
+    1,
+    2,
+]
+assert {
+    t["priority"]
+    for t in LuaTicket.query.filter(status="closed", values=("priority",)).exclude(
+        priority__gte=6
+    )
+} == {0, 2, 4}
+assert LuaTicket.query.filter(status="pending") == []
+assert len(LuaTicket.query.filter(number__in=[1, 2, 3, 99])) == 3
+# long lists of keys are combined in chunks, past the limit of Lua's unpack()
+assert len(LuaTicket.query.filter(number__in=list(range(9000)), priority__lt=5)) == 5
+any_number = Q(*(Q(number=number) for number in range(9000)), _connector=Q.OR)
+assert len(LuaTicket.query.filter(any_number, ~Q(any_number, priority__gte=5))) == 5
+assert len(LuaTicket.query.filter(Q(*(Q(status="open") for _ in range(9000))))) == 10
+# key pattern matches are resolved on the client and sent with the script
+assert {
+    t.number for t in LuaTicket.query.filter(status__startswith="op", priority__lt=6)
+} == {1, 3, 5}
+
+for item in LuaTicket.query.iterator():
+    item.delete()
+assert not POPOTO_REDIS_DB.keys("$Query:*")
+
+
+# QUERY RESULT CACHE
+for number in range(10):
+    CachedTicket.create(number=number, status="open", priority=number)
+
+commands = ("smembers", "sort", "zrange", "hgetall")
+first = [
+    t.number for t in CachedTicket.query.filter(status="open", order_by="priority")
+]
+before = command_calls(*commands)
+second = CachedTicket.query.filter(order_by="priority", status="open")  # same query
+assert [t.number for t in second] == first == list(range(10))
+assert command_calls(*commands) == before  # served from the cache
+assert CachedTicket.query.cache.hits == 1
+
+# each hit decodes fresh instances
+second[0].priority = 100
+assert CachedTicket.query.filter(status="open", order_by="priority")[0].priority == 0
+
+# save() and delete() expire cached results
+CachedTicket.create(number=10, status="open", priority=10)
+assert len(CachedTicket.query.filter(status="open", order_by="priority")) == 11
+CachedTicket.query.get(number=0, status="open").delete()
+assert len(CachedTicket.query.filter(status="open", order_by="priority")) == 10
+
+# opt in or out per query
+before = command_calls(*commands)
+assert len(CachedTicket.query.filter(status="open", cache_ttl=0)) == 10
+assert len(CachedTicket.query.filter(status="open", cache_ttl=0)) == 10
+assert command_calls(*commands)["hgetall"] - before["hgetall"] == 20
+try:
+    Ticket.query.filter(status="open", cache_ttl=30)
+    raise AssertionError("per query caching needs Meta.cache_ttl")
+except QueryException:
+    pass
+assert not POPOTO_REDIS_DB.exists(Ticket._meta.db_generation_key.redis_key)
+
+for item in CachedTicket.query.iterator():
+    item.delete()
+assert len(CachedTicket.query.filter(status="open", order_by="priority")) == 0
+
+
+# COST-BASED FILTER ORDERING
+for number in range(200):
+    status = "rare" if number in (7, 8) else "common"
+    Ticket.create(number=number, status=status, priority=number)
+    LuaTicket.create(number=number, status=status, priority=number)
+
+key_sources = Ticket.query.get_key_sources(
+    Ticket.query.get_filters_by_field(status="rare", priority__gte=1)
+)
+planned = Ticket.query.plan_key_sources(key_sources)
+assert [key_source.estimate for key_source in planned] == [2, 199]
+assert (
+    Ticket.query.plan_key_sources(
+        Ticket.query.get_key_sources(
+            Ticket.query.get_filters_by_field(status="missing", priority__gte=1)
+        )
+    )
+    == []
+)
+
+commands = ("zrangestore", "zinterstore", "sinterstore", "hgetall")
+before = command_calls(*commands)
+# the rare status is intersected first, the wide range is never copied
+assert {t.number for t in Ticket.query.filter(status="rare", priority__gte=1)} == {7, 8}
+after = command_calls(*commands)
+assert after["zinterstore"] - before["zinterstore"] == 1
+assert after["zrangestore"] - before["zrangestore"] == 1  # of the 2 scored members
+
+before = command_calls(*commands)
+# nothing matches, so nothing is staged
+assert len(Ticket.query.filter(status="missing", priority__gte=1)) == 0
+assert Ticket.query.filter(status="missing", priority__gte=1).count() == 0
+assert command_calls(*commands) == before
+
+assert {t.number for t in LuaTicket.query.filter(status="rare", priority__gte=8)} == {8}
+assert {
+    t.number for t in LuaTicket.query.filter(status="missing", priority__gte=1)
+} == set()
+assert [
+    t.number
+    for t in LuaTicket.query.filter(status="common", priority__lt=10)
+    .exclude(status="rare", priority__gte=0)
+    .order_by("-priority")[:3]
+] == [9, 6, 5]
+
+for model_class in [Ticket, LuaTicket]:
+    for item in model_class.query.iterator():
+        item.delete()
+assert not POPOTO_REDIS_DB.keys("$Query:*")
+
+
+# OR / NOT WITH Q OBJECTS
+for model_class in [Ticket, ClientSideTicket, LuaTicket]:
+    for number in range(12):
+        model_class.create(
+            number=number,
+            status=["open", "closed", "pending"][number % 3],
+            priority=number,
+        )
+
+    def numbers(query_set):
+        return sorted(t.number for t in query_set)
+
+    open_or_urgent = model_class.query.filter(Q(status="open") | Q(priority__gte=10))
+    assert numbers(open_or_urgent) == [0, 3, 6, 9, 10, 11]
+    assert open_or_urgent.count() == 6
+    not_open = model_class.query.filter(~Q(status="open"), priority__lt=5)
+    assert numbers(not_open) == [1, 2, 4]
+    assert numbers(
+        model_class.query.filter(
+            (Q(status="open") & Q(priority__lt=4)) | ~Q(status__in=["open", "closed"])
+        )
+    ) == [0, 2, 3, 5, 8, 11]
+    assert numbers(
+        model_class.query.filter(status="closed").exclude(Q(priority=1) | Q(priority=7))
+    ) == [4, 10]
+    not_open_urgent = model_class.query.exclude(Q(status="open"), priority__gte=3)
+    assert numbers(not_open_urgent) == [0, 1, 2, 4, 5, 7, 8, 10, 11]
+    assert [
+        t.number
+        for t in model_class.query.filter(
+            Q(status="pending") | Q(number__in=[1]), order_by="-priority"
+        )[:3]
+    ] == [11, 8, 5]
+    assert numbers(model_class.query.filter(Q(status__in=[]) | Q(priority=4))) == [4]
+    assert model_class.query.filter(Q(status="missing") | Q(status__in=[])).count() == 0
+    assert model_class.query.count(~Q()) == 0
+
+    for item in model_class.query.iterator():
+        item.delete()
+
+assert Q(status="open", priority=1) == Q(priority=1, status="open")
+try:
+    Ticket.query.filter(Q(colour="red") | Q(status="open"))
+    raise AssertionError("invalid filter params must raise")
+except QueryException:
+    pass
+try:
+    Ticket.query.filter(Q(status="open", limit=1))
+    raise AssertionError("query options are not filters")
+except QueryException:
+    pass
+
+Ticket.create(number=1, status="open", priority=1)
+before = command_calls("sunionstore", "sdiffstore")
+assert len(Ticket.query.filter(Q(status="open") | ~Q(status="closed"))) == 1
+after = command_calls("sunionstore", "sdiffstore")
+assert after["sunionstore"] - before["sunionstore"] == 1
+assert after["sdiffstore"] - before["sdiffstore"] == 1
+Ticket.query.get(number=1, status="open").delete()
+assert not POPOTO_REDIS_DB.keys("$Query:*")
+
+
+# BULK UPDATE
+class Assignee(popoto.Model):
+    name = popoto.KeyField()
+
+
+class Task(popoto.Model):
+    number = popoto.KeyField(type=int)
+    status = popoto.KeyField()
+    priority = popoto.SortedField(type=int)
+    note = popoto.Field(null=True)
+    assignee = popoto.Relationship(model=Assignee)
+
+    class Meta:
+        cache_ttl = 30
+
+
+alice, bob = Assignee.create(name="alice"), Assignee.create(name="bob")
+for number in range(10):
+    Task.create(number=number, status="open", priority=number, assignee=alice)
+assert len(Task.query.filter(priority__lt=5)) == 5  # cached
+
+# writes to related models expire cached results too
+assert not POPOTO_REDIS_DB.exists(Ticket._meta.db_generation_key.redis_key)
+
+
+def assigned_tasks():
+    return Task.query.filter(priority__lt=5).select_related("assignee")
+
+
+assert len(assigned_tasks()) == 5
+before = command_calls("hgetall")
+assert len(assigned_tasks()) == 5
+after = command_calls("hgetall")
+assert after["hgetall"] - before["hgetall"] == 1  # cached, but for the assignee
+Assignee.create(name="carol").delete()
+assert len(assigned_tasks()) == 5
+assert command_calls("hgetall")["hgetall"] - after["hgetall"] == 5 + 1
+
+# plain fields are written without touching any index
+before = command_calls("hset", "hgetall", "hmget", "zadd", "sadd")
+assert Task.query.filter(priority__lt=5).update(note="triaged") == 5
+after = command_calls("hset", "hgetall", "hmget", "zadd", "sadd")
+assert after["hset"] - before["hset"] == 5  # inside the update script
+assert after["hgetall"] == before["hgetall"] and after["hmget"] == before["hmget"]
+assert after["zadd"] == before["zadd"] and after["sadd"] == before["sadd"]
+assert [t.note for t in Task.query.filter(order_by="priority")] == ["triaged"] * 5 + [
+    None
+] * 5
+
+# sorted and relationship indexes follow the new values
+assert Task.query.filter(priority__lt=3).update(priority=100, assignee=bob) == 3
+assert len(Task.query.filter(priority__lt=5)) == 2  # the cache was invalidated
+assert Task.query.filter(priority=100).count() == 3
+assert Task.query.filter(assignee=bob).count() == 3
+assert Task.query.filter(assignee=alice).count() == 7
+assert Task.query.get(number=0, status="open").note == "triaged"
+
+# KeyFields change the db key, those objects are re-saved
+assert Task.query.filter(number__in=[0, 1]).update(status="closed") == 2
+assert Task.query.filter(status="closed").count() == 2
+assert Task.query.filter(status="open").count() == 8
+assert Task.query.count() == 10
+assert Task.query.get(number=0, status="closed").priority == 100
+
+try:
+    Task.query.all().update(colour="red")
+    raise AssertionError("unknown fields must raise")
+except QueryException:
+    pass
+try:
+    Task.query.all()[:3].update(note="x")
+    raise AssertionError("sliced querysets cannot be updated")
+except QueryException:
+    pass
+assert Task.query.filter(status="missing").update(note="x") == 0
+
+# BULK DELETE
+assert len(Task.query.filter(assignee=alice)) == 7  # cached
+before = command_calls("hgetall", "unlink")
+assert Task.query.filter(assignee=alice, priority__gte=5).delete(batch_size=2) == 5
+after = command_calls("hgetall", "unlink")
+assert after["hgetall"] == before["hgetall"]  # only index fields are read
+assert after["unlink"] - before["unlink"] == 3  # one per batch
+assert len(Task.query.filter(assignee=alice)) == 2  # the cache was invalidated
+assert Task.query.count() == 5
+assert Task.query.filter(priority__gte=5).count() == 3  # the sorted index is clean
+assert Task.query.filter(status="open").count() == 3
+assert Task.query.filter(assignee=alice).delete() == 2
+assert Task.query.filter(assignee=alice).delete() == 0
+try:
+    Task.query.all()[:3].delete()
+    raise AssertionError("sliced querysets cannot be deleted")
+except QueryException:
+    pass
+
+assert Assignee.query.all().delete() == 2
+assert Task.query.all().delete() == 3  # related objects are not read, even if deleted
+assert POPOTO_REDIS_DB.keys("*Task*") == [b"$Generation:Task"]  # no stale indexes
+assert Task.query.count() == 0 and Task.query.filter(assignee=bob).count() == 0
+assert not POPOTO_REDIS_DB.keys("$Query:*")
+
+
+# AGGREGATES OVER SORTEDFIELD SCORES
+class Toy(popoto.Model):
+    name = popoto.KeyField()
+    category = popoto.KeyField()
+    price = popoto.SortedField(type=float)
+    stock = popoto.SortedField(type=int, sort_by="category")
+    released = popoto.SortedField(type=date)
+
+
+for number in range(20):
+    Toy.create(
+        name=f"toy{number}",
+        category=["a", "b"][number % 2],
+        price=number * 1.5,
+        stock=number,
+        released=date(2020, 1, 1 + number),
+    )
+
+before = command_calls("hgetall", "hmget", "zrange")
+assert Toy.query.aggregate(
+    Min("price"), Max("price"), Sum("price"), Avg("price"), Count()
+) == {
+    "price__min": 0.0,
+    "price__max": 28.5,
+    "price__sum": 285.0,
+    "price__avg": 14.25,
+    "count": 20,
+}
+after = command_calls("hgetall", "hmget", "zrange")
+assert after["hgetall"] == before["hgetall"] and after["hmget"] == before["hmget"]
+assert after["zrange"] - before["zrange"] == 4  # min, max, a chunk per Lua sum
+
+# ranges on the aggregated field itself, other filters and excludes
+assert Toy.query.filter(price__gte=3, price__lt=9).aggregate(
+    Min("price"), Max("price"), total=Sum("price"), n=Count()
+) == {"price__min": 3.0, "price__max": 7.5, "total": 21.0, "n": 4}
+assert Toy.query.filter(category="b", price__gte=3).exclude(name="toy3").aggregate(
+    Sum("stock"), Count()
+) == {"stock__sum": 96, "count": 8}
+
+# partitioned fields aggregate the partition named in the filters
+assert Toy.query.filter(category="a").aggregate(
+    Min("stock"), Max("stock"), Sum("stock"), Max("released")
+) == {
+    "stock__min": 0,
+    "stock__max": 18,
+    "stock__sum": 90,
+    "released__max": date(2020, 1, 19),
+}
+try:
+    Toy.query.aggregate(Sum("stock"))
+    raise AssertionError("partitioned fields need the partition values")
+except QueryException:
+    pass
+for invalid_aggregate in [Sum("released"), Min("name"), "price"]:
+    try:
+        Toy.query.aggregate(invalid_aggregate)
+        raise AssertionError(f"{invalid_aggregate} must raise")
+    except QueryException:
+        pass
+
+assert Toy.query.filter(category="c").aggregate(Min("price"), Count()) == {
+    "price__min": None,
+    "count": 0,
+}
+assert Toy.query.all().delete() == 20
+assert Toy.query.aggregate(Avg("price"), Count("price")) == {
+    "price__avg": None,
+    "price__count": 0,
+}
+assert not POPOTO_REDIS_DB.keys("$Query:*")
+
+
+# KEYSET PAGINATION
+class Post(popoto.Model):
+    number = popoto.KeyField(type=int)
+    author = popoto.KeyField()
+    created = popoto.SortedField(type=int)
+
+
+for number in range(25):
+    Post.create(number=number, author=["bob", "amy"][number % 2], created=number // 3)
+
+
+def read_all_pages(queryset, **kwargs):
+    numbers, cursor = [], None
+    while True:
+        page = queryset.paginate(after=cursor, **kwargs)
+        numbers += [post.number for post in page]
+        if not page.has_next:
+            return numbers
+        cursor = page.next_cursor
+
+
+# equal scores are kept in member order across pages
+newest_first = read_all_pages(Post.query.all(), order_by="-created", page_size=4)
+assert sorted(newest_first) == list(range(25))
+assert [number // 3 for number in newest_first] == sorted(
+    [number // 3 for number in range(25)], reverse=True
+)
+assert read_all_pages(
+    Post.query.filter(author="bob"), order_by="created", page_size=3
+) == list(range(0, 25, 2))
+assert sorted(
+    read_all_pages(Post.query.filter(created__gte=2, created__lt=5), order_by="created")
+) == list(range(6, 15))
+
+first_page = Post.query.filter(order_by="created").paginate(page_size=10)
+assert len(first_page) == 10 and first_page.has_next
+Post.query.get(number=0, author="bob").delete()  # before the cursor
+second_page = Post.query.all().paginate(
+    order_by="created", after=first_page.next_cursor, page_size=10
+)
+read_numbers = {post.number for post in first_page + second_page}
+assert len(second_page) == 10 and len(read_numbers) == 20  # no repeats
+last_page = Post.query.filter(values=("number",)).paginate(
+    order_by="created", after=second_page.next_cursor
+)
+assert not last_page.has_next
+assert {row["number"] for row in last_page} == set(range(25)) - read_numbers
+assert Post.query.filter(author="nobody").paginate(order_by="created") == []
+
+for invalid_kwargs in [
+    dict(order_by="author"),
+    dict(order_by="created", after="not a cursor"),
+    dict(order_by="-created", after=first_page.next_cursor),
+]:
+    try:
+        Post.query.all().paginate(**invalid_kwargs)
+        raise AssertionError(f"{invalid_kwargs} must raise")
+    except QueryException:
+        pass
+
+assert Post.query.all().delete() == 24
+
+# many tied scores: pages continue from the cursor's rank, ties in byte order
+class Rank(popoto.Model):
+    player = popoto.KeyField()
+    points = popoto.SortedField(type=int)
+
+
+players = [f"{prefix}{i}" for i in range(150) for prefix in ("a", "B", "é", "_")]
+Rank.bulk_create([dict(player=player, points=len(player) % 2) for player in players])
+by_points_and_bytes = [
+    player
+    for _, _, player in sorted(
+        (len(player) % 2, f"Rank:{player}".encode(), player) for player in players
+    )
+]
+
+
+def read_all_players(**kwargs):
+    players, cursor = [], None
+    while True:
+        page = Rank.query.all().paginate(order_by="points", after=cursor, **kwargs)
+        players += [rank.player for rank in page]
+        if not page.has_next:
+            return players
+        cursor = page.next_cursor
+
+
+assert read_all_players(page_size=7) == by_points_and_bytes
+page = Rank.query.all().paginate(order_by="-points", page_size=50)
+Rank.query.get(player=page[-1].player).delete()  # the cursor's member is gone
+next_page = Rank.query.all().paginate(
+    order_by="-points", after=page.next_cursor, page_size=50
+)
+assert [rank.player for rank in page + next_page] == by_points_and_bytes[::-1][:100]
+assert Rank.query.all().delete() == len(players) - 1
+assert not POPOTO_REDIS_DB.keys("$Query:*")
+
+
+# EXPLAIN AND THE SLOW QUERY LOG
+class Report(popoto.Model):
+    number = popoto.KeyField(type=int)
+    status = popoto.KeyField()
+    priority = popoto.SortedField(type=int)
+
+    class Meta:
+        slow_query_threshold = 0  # log every query
+
+
+for number in range(30):
+    Report.create(
+        number=number, status=["open", "closed", "pending"][number % 3], priority=number
+    )
+
+explained = Report.query.explain(status="open", priority__gte=10)
+assert explained["mode"] == "server-side filters"
+assert explained["rows"] == 6
+assert {
+    predicate["filter"]: (predicate["estimated"], predicate["actual"])
+    for predicate in explained["predicates"]
+} == {
+    "status {'status': 'open'}": (10, 10),
+    "priority {'priority__gte': 10}": (20, 20),
+}
+# the smaller set is intersected first
+assert explained["plan"] == [
+    "set $KeyF:Report:status:open",
+    "sorted set $SortF:Report:priority [10, +inf]",
+]
+assert [command.split()[0] for command in explained["commands"]].count("HGETALL") == 6
+assert explained["round_trips"] == 3  # estimates, intersection, hashes
+assert explained["bytes_sent"] > 0 and explained["bytes_received"] > 0
+assert set(explained["timings"]) == {"redis", "fetch", "decode", "total"}
+assert explained["warnings"] == []
+
+explained = Report.query.filter(
+    Q(status__startswith="op") | Q(priority__lt=3)
+).explain()
+assert explained["rows"] == 12
+assert "KEYS Report:*:op*" in explained["commands"]
+assert "KEYS scan, the cost grows with the whole keyspace" in explained["warnings"]
+assert Report.query.explain(status="missing", priority__gte=10)["plan"] == [
+    "nothing can match"
+]
+
+# explain() profiles inside an outer profile
+with QueryProfile() as outer_profile:
+    assert Report.query.count(status="open") == 10
+    with QueryProfile() as inner_profile:
+        explained = Report.query.explain(status="open", priority__gte=10)
+assert explained["rows"] == 6
+assert inner_profile.commands[-len(explained["commands"]) :] == explained["commands"]
+assert outer_profile.commands == ["SCARD $KeyF:Report:status:open"] + (
+    inner_profile.commands
+)
+assert "execute_command" not in vars(POPOTO_REDIS_DB)
+assert "pipeline" not in vars(POPOTO_REDIS_DB)
+
+# only commands sent by the profiled thread, while the profile is open, are recorded
+other_thread = threading.Thread(target=lambda: Report.query.count(status="closed"))
+with QueryProfile() as profile:
+    other_thread.start()
+    other_thread.join()
+    pipeline = POPOTO_REDIS_DB.pipeline()
+    Report.query.count(status="pending")
+assert profile.commands == ["SCARD $KeyF:Report:status:pending"]
+pipeline.scard("$KeyF:Report:status:open").execute()
+assert profile.round_trips == 1
+
+
+class LogRecords(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+slow_queries = LogRecords()
+logging.getLogger("POPOTO.SlowQuery").addHandler(slow_queries)
+assert len(Report.query.filter(status="closed")) == 10
+assert len(slow_queries.records) == 1
+assert "Report query" in slow_queries.records[0].getMessage()
+assert "returned 10 rows" in slow_queries.records[0].getMessage()
+Report.query.filter(status="closed").count()
+Report.query.filter(status="closed").aggregate(Max("priority"))
+Report.query.filter(status="closed").paginate(order_by="priority", page_size=5)
+assert len(list(Report.query.filter(status="closed").iterator(chunk_size=4))) == 10
+Report.query.filter(status="closed").update(priority=1)
+assert [record.getMessage().split()[2] for record in slow_queries.records[1:]] == [
+    "count",
+    "aggregate",
+    "paginate",
+    "iterator",
+    "update",
+]
+assert "yielded 10 rows" in slow_queries.records[4].getMessage()
+logging.getLogger("POPOTO.SlowQuery").removeHandler(slow_queries)
+
+assert Report.query.all().delete() == 30
+assert not POPOTO_REDIS_DB.keys("$Query:*")
@@ -6,7 +6,10 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 
 from src.popoto.redis_db import POPOTO_REDIS_DB
-from src.popoto import Model, KeyField, Field, Relationship
+from src.popoto import Model, KeyField, Field, Relationship, IdentityMap
+from src.popoto.models.profiling import QueryProfile
+from src.popoto.models.base import ModelException
+from src.popoto.models.query import QueryException
 
 
 class StarSign(Model):
@@ -51,9 +54,127 @@ for person in [bk, kr, mw]:
 assert len(Membership.query.filter(group=dc)) == 3
 # assert bk in Membership.query.filter(group__name="Destiny's Child")
 
+# LAZY RELATED OBJECTS
+with QueryProfile() as profile:
+    memberships = list(Membership.query.filter(group=dc))
+    assert profile.round_trips == 2  # keys, then hashes. no related objects
+    assert memberships[0].group.name == "Destiny's Child"  # read on first access
+    assert profile.round_trips == 3
+    memberships[0].joined_at = date(1997, 1, 1)
+    memberships[0].save()  # the other related object is not read to save
+assert profile.commands.count(f"HGETALL {memberships[0].person.db_key.redis_key}") == 0
+assert Membership.query.filter(person=memberships[0].person)[0].joined_at.year == 1997
+
+with QueryProfile() as profile:
+    memberships = Membership.query.filter(group=dc).select_related("person", "group")
+    star_signs = {membership.person.star_sign.name for membership in memberships}
+assert star_signs == {"Virgo", "Aquarius", "Leo"}
+assert profile.round_trips == 3 + 3  # query, related objects, then each star sign
+try:
+    Membership.query.all().select_related("joined_at")
+    raise AssertionError("select_related() takes Relationship fields")
+except QueryException:
+    pass
+
+# REVERSE RELATIONSHIPS
+assert {membership.person.name for membership in dc.membership_set} == {
+    "Beyoncé Knowles",
+    "Kelly Rowland",
+    "Michelle Williams",
+}
+with QueryProfile() as profile:
+    star_signs = StarSign.query.all().prefetch_related("person_set")
+    people = {sign.name: [p.name for p in sign.person_set] for sign in star_signs}
+    assert star_signs[0].person_set[0].star_sign is star_signs[0]
+assert profile.round_trips == 2 + 2  # the star signs, then SMEMBERS and HGETALL
+assert people["Virgo"] == ["Beyoncé Knowles"]
+
+
+class Album(Model):
+    title = KeyField()
+
+
+class Track(Model):
+    title = KeyField()
+    album = Relationship(model=Album, related_name="tracks")
+
+
+Track.create(title="Survivor", album=Album.create(title="Survivor"))
+album = Album.query.all().prefetch_related("tracks")[0]
+assert [track.title for track in album.tracks] == ["Survivor"]
+assert album.tracks.count() == 1
+try:
+    Album.query.all().prefetch_related("track_set")
+    raise AssertionError("prefetch_related() takes related names")
+except QueryException:
+    pass
+
+# related names must not hide other attributes of the related model
+for related_names in [("singles", "tracks"), ("singles", "title"), ("singles", "save")]:
+    try:
+
+        class Single(Model):
+            title = KeyField()
+            album = Relationship(model=Album, related_name=related_names[0])
+            b_side_album = Relationship(model=Album, related_name=related_names[1])
+
+        raise AssertionError(f"related_name {related_names[1]} is taken")
+    except ModelException:
+        pass
+try:
+
+    class Remix(Model):
+        title = KeyField()
+        album = Relationship(model=Album)
+        b_side_album = Relationship(model=Album)
+
+    raise AssertionError("the default related_name remix_set is taken")
+except ModelException:
+    pass
+
+# IDENTITY MAP
+with IdentityMap() as identity_map:
+    with QueryProfile() as profile:
+        memberships = list(Membership.query.filter(group=dc))
+        assert len({id(membership.group) for membership in memberships}) == 1
+    assert profile.commands.count(f"HGETALL {dc.db_key.redis_key}") == 1
+    assert Group.query.get(name="Destiny's Child") is memberships[0].group
+    with QueryProfile() as profile:
+        list(Membership.query.filter(group=dc).select_related("group"))
+    assert profile.round_trips == 2  # the group is already loaded
+    with IdentityMap():
+        assert Group.query.get(name="Destiny's Child") is not memberships[0].group
+    assert len(identity_map) == 1 + 3  # group, memberships
+assert Group.query.get(name="Destiny's Child") is not Group.query.get(
+    name="Destiny's Child"
+)
+
+# bulk updates and deletes evict the objects they change
+with IdentityMap() as identity_map:
+    membership = Membership.query.get(person=bk, group=dc)
+    Membership.query.filter(group=dc).update(joined_at=date(1990, 1, 1))
+    assert membership.db_key.redis_key not in identity_map
+    assert Membership.query.get(person=bk, group=dc).joined_at.year == 1990
+    dc = Group.query.get(name="Destiny's Child")
+    Group.create(name="Girls Tyme")
+    Group.query.filter(name="Girls Tyme").update(name="Destiny's Child")
+    assert dc.db_key.redis_key not in identity_map
+    Group.query.filter(name="Destiny's Child").delete()
+    assert Group.query.get(name="Destiny's Child") is None
+Group.create(name="Destiny's Child")
+
+# updates move objects out of the relationship sets of deleted related objects
+gemini = StarSign.create(name="Gemini")
+Person.create(name="Kelendria Rowland", star_sign=gemini)
+gemini_set_key = f"$RelationshipF:Person:star_sign:{gemini.db_key.redis_key}"
+assert POPOTO_REDIS_DB.scard(gemini_set_key) == 1
+gemini.delete()
+Person.query.filter(name="Kelendria Rowland").update(star_sign=aquarius)
+assert POPOTO_REDIS_DB.scard(gemini_set_key) == 0
+assert Person.query.filter(star_sign=aquarius).count() == 2
 
 pipeline = POPOTO_REDIS_DB.pipeline()
-for model_class in [Membership, Group, Person, StarSign]:
+for model_class in [Membership, Group, Person, StarSign, Track, Album]:
     for item in model_class.query.all():
         pipeline = item.delete(pipeline)
     pipeline.execute()
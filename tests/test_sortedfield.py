@@ -133,3 +133,110 @@ assert list(values_result[4].keys()) == ["timestamp", "price"]
 
 for sam in SortedAssetsModel.objects.all():
     sam.delete()
+
+
+# ORDER_BY AND LIMIT ON A SORTEDFIELD RUN IN REDIS
+class Quote(popoto.Model):
+    exchange = popoto.KeyField()
+    symbol = popoto.KeyField()
+    price = popoto.SortedField(type=float)
+    volume = popoto.SortedField(type=int, sort_by="exchange")
+
+
+pipeline = POPOTO_REDIS_DB.pipeline()
+for i in range(200):
+    pipeline = Quote.create(
+        pipeline=pipeline,
+        exchange=["binance", "kraken"][i % 2],
+        symbol=f"SYM{i}",
+        price=float(i),
+        volume=1000 - i,
+    )
+pipeline.execute()
+
+
+def count_hgetall_calls():
+    return (
+        POPOTO_REDIS_DB.info("commandstats").get("cmdstat_hgetall", {}).get("calls", 0)
+    )
+
+
+hgetall_calls = count_hgetall_calls()
+top_quotes = Quote.query.filter(price__gte=10, order_by="-price", limit=20)
+assert [q.price for q in top_quotes] == [float(i) for i in range(199, 179, -1)]
+assert count_hgetall_calls() - hgetall_calls == 20
+
+hgetall_calls = count_hgetall_calls()
+page = Quote.query.filter(exchange="kraken", price__lt=100).order_by("price")[10:15]
+assert [q.price for q in page] == [21.0, 23.0, 25.0, 27.0, 29.0]
+assert count_hgetall_calls() - hgetall_calls == 5
+
+assert [q.price for q in Quote.query.all(order_by="price", limit=3)] == [0.0, 1.0, 2.0]
+assert [
+    q.symbol
+    for q in Quote.query.filter(exchange="binance")
+    .exclude(symbol="SYM0")
+    .order_by("-volume")[:2]
+] == ["SYM2", "SYM4"]
+assert [
+    q["volume"]
+    for q in Quote.query.filter(
+        exchange="binance", volume__lt=900, order_by="volume", values=("volume",)
+    )[:2]
+] == [802, 804]
+assert not POPOTO_REDIS_DB.keys("$Query:*")
+
+for item in Quote.query.iterator():
+    item.delete()
+
+
+# __range, AND __in ACROSS SORT_BY PARTITIONS
+class Trade(popoto.Model):
+    exchange = popoto.KeyField()
+    number = popoto.KeyField(type=int)
+    size = popoto.SortedField(type=int, sort_by="exchange")
+
+
+class LuaTrade(popoto.Model):
+    exchange = popoto.KeyField()
+    number = popoto.KeyField(type=int)
+    size = popoto.SortedField(type=int, sort_by="exchange")
+
+    class Meta:
+        lua_queries = True
+
+
+for model_class in [Trade, LuaTrade]:
+    for number in range(30):
+        model_class.create(
+            exchange=["binance", "kraken", "bitmex"][number % 3],
+            number=number,
+            size=number,
+        )
+
+    assert {
+        t.number
+        for t in model_class.query.filter(exchange="kraken", size__range=(4, 10))
+    } == {4, 7, 10}
+    kraken_or_bitmex = model_class.query.filter(
+        exchange__in=["kraken", "bitmex"], size__range=(10, 19)
+    )
+    assert sorted(t.number for t in kraken_or_bitmex) == [10, 11, 13, 14, 16, 17, 19]
+    assert kraken_or_bitmex.count() == 7
+    assert [
+        t.number
+        for t in model_class.query.filter(
+            exchange__in=["binance", "kraken"], size__gte=20
+        ).order_by("-size")[:3]
+    ] == [28, 27, 25]
+    assert (
+        model_class.query.filter(exchange__in=["kraken", "nowhere"], size__lt=5).count()
+        == 2
+    )
+    assert model_class.query.filter(
+        exchange__in=["kraken", "bitmex"], size__gte=20
+    ).aggregate(popoto.Max("size"), popoto.Count()) == {"size__max": 29, "count": 7}
+    many_exchanges = ["kraken", *(f"exchange{i}" for i in range(9000))]
+    assert len(model_class.query.filter(exchange__in=many_exchanges, size__gte=20)) == 3
+    assert not POPOTO_REDIS_DB.keys("$Query:*")
+    assert model_class.query.all().delete() == 30